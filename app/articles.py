@@ -1,15 +1,32 @@
 import os
+import hashlib
 import logging
+import threading
+from cache import TTLCache
+from snapshot import SnapshotStore
+from metrics import span
 
 logger = logging.getLogger('app.articles')
 
+# the latest, popular and random feeds are the same for every user so they are shared by all requests in a process
+FEED_CACHE_TTL = int(os.getenv('FEED_CACHE_TTL', 300))
+FEED_CACHE_REFRESH_AHEAD = float(os.getenv('FEED_CACHE_REFRESH_AHEAD', 0.8))
+feed_cache = TTLCache(FEED_CACHE_TTL, FEED_CACHE_REFRESH_AHEAD)
+
+# personalized articles are served from a local snapshot of the recommendations table when a path is set
+PERSONALIZED_SNAPSHOT_PATH = os.getenv('PERSONALIZED_SNAPSHOT_PATH')
+PERSONALIZED_SNAPSHOT_INTERVAL = int(os.getenv('PERSONALIZED_SNAPSHOT_INTERVAL', 300))
+snapshot_store = SnapshotStore(PERSONALIZED_SNAPSHOT_PATH) if PERSONALIZED_SNAPSHOT_PATH else None
+snapshot_refresh_lock = threading.Lock()
+snapshot_refresh_pid = None
+
 class Articles:
-    def __init__(self, bigquery_client):
-        """Instantiates the Articles class for retrieving articles from BigQuery
+    def __init__(self, storage):
+        """Instantiates the Articles class for retrieving articles from BigQuery or SQLite
         Args:
-            bigquery_client: pass existing BigQuery client as an argument
+            storage: pass existing BigQueryStorage or SQLiteStorage as an argument
         """
-        self.bigquery_client = bigquery_client
+        self.storage = storage
 
     def get_articles(self, user_id):
         """
@@ -18,44 +35,94 @@ class Articles:
         Returns:
             articles: List of dictionaries containing article data
         """
-        latest_articles_table = os.getenv('ARTICLES_TABLE')
-        personalized_articles_table = os.getenv('PERSONALIZED_ARTICLES_TABLE')
-        articles_query = """
-            WITH latest_articles AS (
-                SELECT
-                    * EXCEPT (load_timestamp, article_order)
-                FROM `{}`
-            ),
-            personalized_articles AS (
-                SELECT
-                    'personalized' AS sort,
-                    * EXCEPT (user_id, topic, total_clicks, user_already_clicked, article_order, load_timestamp)
-                FROM `{}`
-                WHERE
-                    user_id = '{}'
-                    AND user_already_clicked = FALSE
-                ORDER BY
-                    total_clicks DESC, publishedAt DESC
-                LIMIT 10
-            )
-            SELECT * FROM latest_articles
-            UNION ALL
-            SELECT * FROM personalized_articles
-        """.format(latest_articles_table, personalized_articles_table, user_id)
-        
-        print('running query: {}'.format(articles_query))
-        logger.info('running query: {}'.format(articles_query))
-
-        # run query and store results in list of dictionaries
-        query_job = self.bigquery_client.query(articles_query)
-        articles = []
-        for row in query_job:
-            articles.append(dict(row))
-
-        # convert datetime objects to strings
-        for index, article in enumerate(articles):
-            article['publishedAt'] = article['publishedAt'].strftime('%Y-%m-%d %H:%M:%S')
-
-        return articles
-
-    
\ No newline at end of file
+        return self.get_shared_articles() + self.get_personalized_articles(user_id)
+
+    def get_shared_articles(self):
+        """Returns the latest, popular and random articles from the process wide feed cache
+        Returns:
+            articles: List of dictionaries containing article data
+        """
+        return self.get_shared_feed()[1]
+
+    def get_shared_feed(self):
+        """Returns the shared articles with a version derived from their content, so every
+        worker computes the same version for the same feed
+        Returns:
+            (version, articles): version string and list of dictionaries containing article data
+        """
+        return feed_cache.get('shared', self.load_shared_feed)
+
+    def load_shared_feed(self):
+        articles = self.query_shared_articles()
+        return feed_version(articles), articles
+
+    def query_shared_articles(self):
+        """Queries the latest, popular and random articles which are the same for every user
+        Returns:
+            articles: List of dictionaries containing article data
+        """
+        with span('{}_query'.format(self.storage.name)):
+            return self.storage.shared_articles()
+
+    def get_personalized_articles(self, user_id):
+        """Returns the personalized articles for a given user from the local snapshot
+        if one is available, otherwise queries storage. SQLite lookups are already local
+        so the snapshot is only used with BigQuery
+        Args:
+            user_id: User ID from the browser cookie
+        Returns:
+            articles: List of dictionaries containing article data
+        """
+        # a first visit has no user_id until the cookie is set
+        if not user_id:
+            return []
+        if snapshot_store is not None and self.storage.name == 'bigquery':
+            self.start_snapshot_refresh()
+            articles = snapshot_store.get(user_id)
+            if articles is not None:
+                return articles
+        return self.query_personalized_articles(user_id)
+
+    def start_snapshot_refresh(self):
+        """Starts the snapshot refresh thread once in each worker process
+        """
+        global snapshot_refresh_pid
+        if snapshot_refresh_pid == os.getpid():
+            return
+        with snapshot_refresh_lock:
+            if snapshot_refresh_pid != os.getpid():
+                snapshot_refresh_pid = os.getpid()
+                snapshot_store.start_refresh(
+                    self.storage.client,
+                    os.getenv('PERSONALIZED_ARTICLES_TABLE'),
+                    PERSONALIZED_SNAPSHOT_INTERVAL
+                )
+
+    def query_personalized_articles(self, user_id):
+        """Queries the personalized articles for a given user
+        Args:
+            user_id: User ID from the browser cookie
+        Returns:
+            articles: List of dictionaries containing article data
+        """
+        with span('{}_query'.format(self.storage.name)):
+            return self.storage.personalized_articles(user_id)
+
+
+def feed_version(articles):
+    """Returns a short content hash of a list of articles, based on their IDs, sorts and publish times
+    """
+    digest = hashlib.sha1()
+    for article in articles:
+        digest.update('{}|{}|{}\n'.format(article.get('article_id'), article.get('sort'), article.get('publishedAt')).encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+def group_by_sort(articles):
+    """Groups articles by their sort field in a single pass
+    Returns:
+        dictionary of sort to the list of articles with that sort, in their original order
+    """
+    articles_by_sort = {}
+    for article in articles:
+        articles_by_sort.setdefault(article['sort'], []).append(article)
+    return articles_by_sort
@@ -0,0 +1,112 @@
+import time
+import threading
+import logging
+
+logger = logging.getLogger('app.cache')
+
+class _Entry:
+    def __init__(self, value, ttl, refresh_ahead, version):
+        loaded_at = time.monotonic()
+        self.value = value
+        self.version = version
+        self.expires_at = loaded_at + ttl
+        self.refresh_at = loaded_at + ttl * refresh_ahead
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+
+
+class TTLCache:
+    def __init__(self, ttl, refresh_ahead=0.8):
+        """Instantiates an in-process cache with a time to live for each key.
+        Concurrent misses for the same key share a single load, and entries past
+        `refresh_ahead` of their TTL are reloaded in a background thread while
+        the current value keeps being served
+        Args:
+            ttl: seconds before an entry expires
+            refresh_ahead: fraction of the TTL after which a background refresh starts
+        """
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._flights = {}
+        self._refreshing = set()
+        self._version = 0
+
+    def get(self, key, loader):
+        """Returns the cached value for a key, calling `loader()` once on a miss
+        Args:
+            key: cache key
+            loader: function without arguments that returns the value to cache
+        Returns:
+            value returned by the loader
+        """
+        return self.get_entry(key, loader).value
+
+    def get_entry(self, key, loader):
+        """Same as `get` but returns the cache entry so callers can read its version
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now < entry.expires_at:
+                if now >= entry.refresh_at and key not in self._refreshing:
+                    self._refreshing.add(key)
+                    threading.Thread(target=self._refresh, args=(key, loader), daemon=True).start()
+                return entry
+
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._flights[key] = flight
+
+        if leader:
+            try:
+                return self._load(key, loader)
+            except Exception as e:
+                flight.error = e
+                raise
+            finally:
+                with self._lock:
+                    del self._flights[key]
+                flight.done.set()
+
+        # another thread is loading this key, wait for its result
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        with self._lock:
+            return self._entries[key]
+
+    def invalidate(self, key=None):
+        """Drops one key, or every key when no key is given
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def _load(self, key, loader):
+        value = loader()
+        with self._lock:
+            self._version += 1
+            entry = _Entry(value, self.ttl, self.refresh_ahead, self._version)
+            self._entries[key] = entry
+        return entry
+
+    def _refresh(self, key, loader):
+        try:
+            self._load(key, loader)
+            logger.info('refreshed cache key %s', key)
+        except Exception as e:
+            # keep serving the current entry until it expires
+            logger.warning('failed to refresh cache key %s: %s', key, e)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
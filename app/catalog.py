@@ -0,0 +1,79 @@
+import threading
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger('app.catalog')
+
+class ArticleCatalog:
+    def __init__(self, max_size=5000):
+        """Instantiates a bounded, thread safe index of article metadata keyed by article_id.
+        The least recently used articles are evicted once `max_size` is reached
+        Args:
+            max_size: maximum number of articles held in memory
+        """
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._articles = OrderedDict()
+
+    def add_many(self, articles):
+        """Adds or refreshes articles in the catalog
+        Args:
+            articles: list of dictionaries with article metadata
+        """
+        with self._lock:
+            for article in articles:
+                self._articles[article['article_id']] = article
+                self._articles.move_to_end(article['article_id'])
+            while len(self._articles) > self.max_size:
+                self._articles.popitem(last=False)
+
+    def get(self, article_id, storage=None):
+        """Returns the metadata for one article
+        Args:
+            article_id: article ID
+            storage: BigQueryStorage or SQLiteStorage used to look up articles missing from the catalog
+        Returns:
+            article: dictionary with article metadata or None if the article is unknown
+        """
+        return self.get_many([article_id], storage).get(article_id)
+
+    def get_many(self, article_ids, storage=None):
+        """Returns the metadata for several articles, looking up all misses in a single query
+        Args:
+            article_ids: list of article IDs
+            storage: BigQueryStorage or SQLiteStorage used to look up articles missing from the catalog
+        Returns:
+            articles: dictionary of article_id to article metadata for the articles found
+        """
+        found = {}
+        with self._lock:
+            for article_id in article_ids:
+                article = self._articles.get(article_id)
+                if article is not None:
+                    self._articles.move_to_end(article_id)
+                    found[article_id] = article
+
+        missing = [article_id for article_id in article_ids if article_id not in found]
+        if missing and storage is not None:
+            looked_up = self.lookup(storage, missing)
+            self.add_many(looked_up)
+            for article in looked_up:
+                found[article['article_id']] = article
+
+        return found
+
+    def lookup(self, storage, article_ids):
+        """Looks up articles that are not in the catalog e.g. when another
+        worker process served the page the click came from
+        Args:
+            storage: BigQueryStorage or SQLiteStorage
+            article_ids: list of article IDs
+        Returns:
+            articles: list of dictionaries with article metadata
+        """
+        articles = {}
+        for article in storage.lookup_articles(article_ids):
+            # an article can appear in more than one feed, keep the first row
+            articles.setdefault(article['article_id'], article)
+
+        return list(articles.values())
@@ -0,0 +1,168 @@
+import os
+import atexit
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from google.cloud import pubsub, bigquery
+import google.auth
+from publisher import EventPipeline
+from storage import BigQueryStorage, SQLiteStorage
+from metrics import span
+
+# tracking events are batched in memory before being handed to the pubsub client
+EVENT_QUEUE_SIZE = int(os.getenv('EVENT_QUEUE_SIZE', 10000))
+EVENT_BATCH_SIZE = int(os.getenv('EVENT_BATCH_SIZE', 100))
+EVENT_BATCH_LATENCY = float(os.getenv('EVENT_BATCH_LATENCY', 0.5))
+EVENT_OVERFLOW = os.getenv('EVENT_OVERFLOW', 'drop_newest')
+# articles are read from 'bigquery' or from the local 'sqlite' database written by the backend
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'bigquery')
+SQLITE_PATH = os.getenv('SQLITE_PATH', '/tmp/news.db')
+# threads shared by requests for concurrent lookups and work moved off the request path
+REQUEST_POOL_SIZE = int(os.getenv('REQUEST_POOL_SIZE', 16))
+
+logger = logging.getLogger('app.clients')
+
+class Clients:
+    def __init__(self):
+        """Instantiates a registry of GCP clients shared by all threads of a worker process.
+        Clients are created lazily on first use and rebuilt in the child after a fork
+        """
+        self._lock = threading.Lock()
+        self._credentials = None
+        self._project_id = None
+        self._publisher_client = None
+        self._bigquery_client = None
+        self._event_pipeline = None
+        self._storage = None
+        self._executor = None
+
+    def reset(self):
+        """Drops all clients so they are rebuilt on next use. gRPC channels and HTTP
+        connection pools must not be shared across a fork, so this runs in the child process
+        """
+        self._lock = threading.Lock()
+        self._credentials = None
+        self._project_id = None
+        self._publisher_client = None
+        self._bigquery_client = None
+        self._event_pipeline = None
+        self._storage = None
+        self._executor = None
+
+    def _resolve_credentials(self):
+        # caller must hold the lock
+        if self._credentials is None:
+            with span('auth'):
+                self._credentials, self._project_id = google.auth.default()
+            logger.info('resolved credentials for project %s', self._project_id)
+
+    def credentials(self):
+        """Returns the default credentials and GCP project ID, resolving them once per process
+        Returns:
+            (credentials, project_id)
+        """
+        if self._credentials is None:
+            with self._lock:
+                self._resolve_credentials()
+        return self._credentials, self._project_id
+
+    def project_id(self):
+        """Returns the GCP project ID for the default credentials
+        """
+        return self.credentials()[1]
+
+    def publisher_client(self):
+        """Returns the shared Pub/Sub publisher client
+        """
+        if self._publisher_client is None:
+            with self._lock:
+                if self._publisher_client is None:
+                    self._resolve_credentials()
+                    batch_settings = pubsub.types.BatchSettings(
+                        max_messages=EVENT_BATCH_SIZE,
+                        max_latency=EVENT_BATCH_LATENCY
+                    )
+                    with span('create_publisher_client'):
+                        self._publisher_client = pubsub.PublisherClient(batch_settings, credentials=self._credentials)
+                    logger.info('created pubsub publisher client')
+        return self._publisher_client
+
+    def bigquery_client(self):
+        """Returns the shared BigQuery client
+        """
+        if self._bigquery_client is None:
+            with self._lock:
+                if self._bigquery_client is None:
+                    self._resolve_credentials()
+                    with span('create_bigquery_client'):
+                        self._bigquery_client = bigquery.Client(project=self._project_id, credentials=self._credentials)
+                    logger.info('created bigquery client')
+        return self._bigquery_client
+
+    def storage(self):
+        """Returns the shared storage layer the articles are read from
+        """
+        if self._storage is None:
+            if STORAGE_BACKEND == 'sqlite':
+                storage = SQLiteStorage(SQLITE_PATH)
+            elif STORAGE_BACKEND == 'bigquery':
+                storage = BigQueryStorage(self.bigquery_client())
+            else:
+                raise ValueError('unknown storage backend: {}'.format(STORAGE_BACKEND))
+            with self._lock:
+                if self._storage is None:
+                    self._storage = storage
+        return self._storage
+
+    def event_pipeline(self):
+        """Returns the shared pipeline for publishing tracking events, starting its thread on first use
+        """
+        if self._event_pipeline is None:
+            publisher_client = self.publisher_client()
+            with self._lock:
+                if self._event_pipeline is None:
+                    self._event_pipeline = EventPipeline(
+                        publisher_client,
+                        self._project_id,
+                        max_queue_size=EVENT_QUEUE_SIZE,
+                        max_batch_size=EVENT_BATCH_SIZE,
+                        max_latency=EVENT_BATCH_LATENCY,
+                        overflow=EVENT_OVERFLOW
+                    )
+                    logger.info('started event pipeline')
+        return self._event_pipeline
+
+    def executor(self):
+        """Returns the thread pool shared by all requests of this worker process
+        """
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=REQUEST_POOL_SIZE, thread_name_prefix='request-pool')
+        return self._executor
+
+    def close(self, timeout=10):
+        """Finishes background work and publishes any queued tracking events before the process exits
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        if self._event_pipeline is not None:
+            self._event_pipeline.close(timeout)
+
+    def warm_up(self):
+        """Creates all clients ahead of the first request. Called from the gunicorn post_fork hook
+        """
+        self.publisher_client()
+        self.storage()
+        self.event_pipeline()
+        self.executor()
+        logger.info('warmed up clients in process %s', os.getpid())
+
+
+clients = Clients()
+
+# gRPC channels and connection pools are not fork safe, so a forked worker starts with an empty registry
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=clients.reset)
+
+atexit.register(clients.close)
@@ -0,0 +1,67 @@
+import os
+import gzip
+import json
+import time
+
+# 'compact' references articles by ID, 'legacy' keeps the original double encoded JSON trackers
+EVENT_FORMAT = os.getenv('EVENT_FORMAT', 'compact')
+# 'gzip' compresses compact payloads, 'none' sends them as plain JSON
+EVENT_COMPRESSION = os.getenv('EVENT_COMPRESSION', 'none')
+
+SCHEMA_VERSION = 2
+SORT_CODES = {'latest': 'l', 'popular': 'p', 'random': 'r', 'personalized': 'z'}
+
+def encode_event(event, legacy_tracker):
+    """Encodes a compact event, or the legacy tracker dictionary when EVENT_FORMAT is 'legacy'
+    Args:
+        event: compact event dictionary
+        legacy_tracker: tracker dictionary in the original format
+    Returns:
+        (data, attributes): message bytes and Pub/Sub message attributes
+    """
+    if EVENT_FORMAT == 'legacy':
+        return json.dumps(json.dumps(legacy_tracker)).encode('utf-8'), {}
+
+    data = json.dumps(event, separators=(',', ':')).encode('utf-8')
+    attributes = {'format': 'compact', 'version': str(SCHEMA_VERSION)}
+    if EVENT_COMPRESSION == 'gzip':
+        data = gzip.compress(data)
+        attributes['encoding'] = 'gzip'
+    return data, attributes
+
+def encode_impression(impression_tracker):
+    """Encodes an impression tracker as a compact event with article IDs grouped by sort
+    Args:
+        impression_tracker: dictionary with user_id, impression_timestamp and articles
+    Returns:
+        (data, attributes): message bytes and Pub/Sub message attributes
+    """
+    articles_by_sort = {}
+    for article in impression_tracker['articles']:
+        sort_code = SORT_CODES.get(article.get('sort'), article.get('sort'))
+        articles_by_sort.setdefault(sort_code, []).append(article['article_id'])
+
+    event = {
+        'v': SCHEMA_VERSION,
+        'u': impression_tracker['user_id'],
+        'ts': int(time.time()),
+        'a': articles_by_sort
+    }
+    return encode_event(event, impression_tracker)
+
+def encode_click(click_tracker):
+    """Encodes a click tracker as a compact event
+    Args:
+        click_tracker: dictionary with user_id, click_timestamp and article_clicked
+    Returns:
+        (data, attributes): message bytes and Pub/Sub message attributes
+    """
+    article = click_tracker['article_clicked']
+    event = {
+        'v': SCHEMA_VERSION,
+        'u': click_tracker['user_id'],
+        'ts': int(time.time()),
+        'a': article['article_id'],
+        's': SORT_CODES.get(article.get('sort'), article.get('sort'))
+    }
+    return encode_event(event, click_tracker)
@@ -0,0 +1,82 @@
+import gzip
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger('app.fragments')
+
+class FragmentCache:
+    def __init__(self, max_size=16):
+        """Instantiates a bounded, thread safe cache of rendered HTML fragments. Fragments are keyed
+        by name and the version of the data they were rendered from, so a new feed version renders
+        new fragments and the old ones age out of the cache
+        Args:
+            max_size: maximum number of fragments kept, least recently used fragments are evicted
+        """
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._fragments = OrderedDict()
+
+    def get(self, name, version, render):
+        """Returns the cached fragment for a name and version, calling `render()` on a miss
+        Args:
+            name: fragment name e.g. 'latest'
+            version: version of the data the fragment is rendered from
+            render: function without arguments that returns the fragment HTML
+        Returns:
+            html: rendered fragment
+        """
+        key = (name, version)
+        with self._lock:
+            html = self._fragments.get(key)
+            if html is not None:
+                self._fragments.move_to_end(key)
+                return html
+
+        # rendering is pure so concurrent misses may render twice but always agree
+        html = render()
+        with self._lock:
+            self._fragments[key] = html
+            self._fragments.move_to_end(key)
+            while len(self._fragments) > self.max_size:
+                self._fragments.popitem(last=False)
+        return html
+
+
+def etag(*parts):
+    """Returns a strong ETag value from the given parts
+    """
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(str(part).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()[:32]
+
+def gzip_response(response, accept_encoding, min_size=1024, compresslevel=6):
+    """Compresses an HTML response in place when the client accepts gzip
+    Args:
+        response: Flask response
+        accept_encoding: request Accept-Encoding header value
+        min_size: smallest body in bytes worth compressing
+        compresslevel: gzip compression level
+    Returns:
+        response
+    """
+    if (response.status_code != 200 or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or not response.mimetype.startswith('text/')):
+        return response
+    response.vary.add('Accept-Encoding')
+    if 'gzip' not in (accept_encoding or '').lower():
+        return response
+
+    body = response.get_data()
+    if len(body) < min_size:
+        return response
+    response.set_data(gzip.compress(body, compresslevel))
+    response.headers['Content-Encoding'] = 'gzip'
+    # the ETag identifies the uncompressed page, mark it weak so it still matches either encoding
+    if response.headers.get('ETag', '').startswith('"'):
+        response.headers['ETag'] = 'W/' + response.headers['ETag']
+    return response
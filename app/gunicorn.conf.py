@@ -0,0 +1,18 @@
+# Gunicorn settings for Cloud Run. See entrypoint in Dockerfile.
+# Use one worker process and 8 threads. For environments with multiple CPU cores,
+# increase the number of workers to be equal to the cores available.
+bind = ':8080'
+workers = 1
+threads = 8
+
+def post_fork(server, worker):
+    """Creates the shared GCP clients in each worker before it accepts requests
+    """
+    from clients import clients
+    clients.warm_up()
+
+def worker_exit(server, worker):
+    """Publishes any queued tracking events before the worker exits
+    """
+    from clients import clients
+    clients.close()
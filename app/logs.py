@@ -0,0 +1,156 @@
+import os
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import datetime
+import threading
+import logging.handlers
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+LOG_MAX_MESSAGE_BYTES = int(os.getenv('LOG_MAX_MESSAGE_BYTES', 2048))
+# comma separated category=rate pairs e.g. 'query=0.1,impression=0.01'
+LOG_SAMPLE_RATES = os.getenv('LOG_SAMPLE_RATES', '')
+
+# attributes every LogRecord has, anything else was passed with `extra` and is written as a field
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'category'}
+
+def parse_sample_rates(value):
+    """Parses 'category=rate' pairs into a dictionary
+    """
+    rates = {}
+    for pair in value.split(','):
+        if '=' in pair:
+            category, rate = pair.split('=', 1)
+            rates[category.strip()] = float(rate)
+    return rates
+
+def category(record):
+    """Returns the category of a record, passed as `extra={'category': ...}` or the logger name
+    """
+    return getattr(record, 'category', None) or record.name
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, sample_rates=None):
+        """Keeps a fraction of the records of each category. Warnings and errors are always kept
+        Args:
+            sample_rates: dictionary of category to the fraction of records kept, unlisted categories are kept
+        """
+        super().__init__()
+        self.sample_rates = sample_rates or {}
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.sample_rates.get(category(record), 1.0)
+        return rate >= 1 or random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    def __init__(self, max_message_bytes=2048):
+        """Formats records as single JSON lines with the fields Cloud Logging reads, truncating long messages
+        Args:
+            max_message_bytes: messages longer than this are truncated
+        """
+        super().__init__()
+        self.max_message_bytes = max_message_bytes
+
+    def format(self, record):
+        message = record.getMessage()
+        if len(message) > self.max_message_bytes:
+            message = '{}... ({} bytes truncated)'.format(message[:self.max_message_bytes], len(message) - self.max_message_bytes)
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            'severity': record.levelname,
+            'logger': record.name,
+            'category': category(record),
+            'message': message,
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value[:self.max_message_bytes] if isinstance(value, str) else value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)[-self.max_message_bytes:]
+        return json.dumps(entry, default=str, separators=(',', ':'))
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue):
+        """Queues records for a background listener without formatting them, dropping records when the queue is full
+        """
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # the listener runs in the same process so the record is formatted there instead of on the request thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class AsyncLogging:
+    def __init__(self):
+        """Routes all logging through a bounded queue to a JSON handler on a background thread
+        """
+        self.handler = None
+        self.listener = None
+        self._lock = threading.Lock()
+
+    def setup(self, level=LOG_LEVEL, sample_rates=None, max_message_bytes=LOG_MAX_MESSAGE_BYTES,
+              queue_size=LOG_QUEUE_SIZE, stream=None):
+        """Replaces the root handlers with a sampled, queue backed JSON handler. Safe to call more than once
+        Args:
+            level: root log level
+            sample_rates: dictionary of category to the fraction of records kept, defaults to LOG_SAMPLE_RATES
+            max_message_bytes: messages longer than this are truncated
+            queue_size: records buffered before new records are dropped
+            stream: output stream, defaults to stderr
+        """
+        with self._lock:
+            if self.listener is not None:
+                return
+            output = logging.StreamHandler(stream or sys.stderr)
+            output.setFormatter(JsonFormatter(max_message_bytes))
+            self.handler = DroppingQueueHandler(queue.Queue(queue_size))
+            self.handler.addFilter(SamplingFilter(
+                parse_sample_rates(LOG_SAMPLE_RATES) if sample_rates is None else sample_rates
+            ))
+            self.listener = logging.handlers.QueueListener(self.handler.queue, output)
+            self.listener.start()
+
+            root = logging.getLogger()
+            for handler in list(root.handlers):
+                root.removeHandler(handler)
+            root.addHandler(self.handler)
+            root.setLevel(level)
+
+    def restart(self):
+        # the listener thread does not survive a fork, start a new one on a fresh queue in the child
+        self._lock = threading.Lock()
+        with self._lock:
+            if self.listener is None:
+                return
+            self.handler.queue = queue.Queue(self.handler.queue.maxsize)
+            self.listener = logging.handlers.QueueListener(self.handler.queue, *self.listener.handlers)
+            self.listener.start()
+
+    def stop(self):
+        """Writes the queued records and stops the listener
+        """
+        with self._lock:
+            if self.listener is not None:
+                self.listener.stop()
+                self.listener = None
+
+
+async_logging = AsyncLogging()
+os.register_at_fork(after_in_child=async_logging.restart)
+atexit.register(async_logging.stop)
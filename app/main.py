@@ -1,18 +1,71 @@
 import os
-from flask import Flask, render_template, make_response, redirect
+import datetime
+from flask import Flask, render_template, make_response, redirect, request
 import logging
 from tracking import check_or_set_user_id, count_hits, track_click_and_get_url, track_impressions
-from articles import Articles
-from google.cloud import pubsub, bigquery
-import google.auth
+from articles import Articles, group_by_sort
+from clients import clients
+from logs import async_logging
+from catalog import ArticleCatalog
+from similarity import Recommender
+from fragments import FragmentCache, etag, gzip_response
+from metrics import instrument, span, registry
 
 app = Flask(__name__)
 
-logging.basicConfig(level=logging.INFO)
+async_logging.setup()
+# request and stage timings are exposed on /metrics
+instrument(app)
 
 app.secret_key = os.getenv('FLASK_SESSION_SECRET')
 app.config['SESSION_TYPE'] = 'filesystem'
 
+# articles shown by this worker, used to resolve the URL for click tracking
+catalog = ArticleCatalog(int(os.getenv('ARTICLE_CATALOG_SIZE', 5000)))
+
+# recommendations from this worker's clicks and a local embedding snapshot, see similarity.py
+SIMILARITY_SNAPSHOT_PATH = os.getenv('SIMILARITY_SNAPSHOT_PATH')
+recommender = Recommender(SIMILARITY_SNAPSHOT_PATH) if SIMILARITY_SNAPSHOT_PATH else None
+
+# the shared article lists are rendered once per feed version, and HTML responses are gzipped
+fragment_cache = FragmentCache(int(os.getenv('FRAGMENT_CACHE_SIZE', 16)))
+GZIP_MIN_SIZE = int(os.getenv('GZIP_MIN_SIZE', 1024))
+
+@app.after_request
+def compress_response(response):
+    return gzip_response(response, request.headers.get('Accept-Encoding'), GZIP_MIN_SIZE)
+
+def submit_timed(stage, function, *args):
+    """Runs a function on the shared request pool, timed as a stage of the current request
+    Returns:
+        future of the function's result
+    """
+    stages = registry.request_stages()
+    def run():
+        with span(stage, stages):
+            return function(*args)
+    return clients.executor().submit(run)
+
+def run_in_background(stage, function, *args):
+    """Runs a function on the shared request pool without waiting for it, logging any error
+    """
+    def log_error(future):
+        if future.exception() is not None:
+            logging.getLogger('app.home').error('%s failed: %s', stage, future.exception())
+    submit_timed(stage, function, *args).add_done_callback(log_error)
+
+def fresh_recommendations(user_id):
+    """Returns up to 10 recommended articles from the user's latest clicks, shown with the article
+    fields stored in the embedding snapshot
+    """
+    recommended_ids = recommender.recommend(user_id, k=30)
+    # snapshots written without article fields can only recommend articles already in the catalog
+    recommended_articles = recommender.articles(recommended_ids) or catalog.get_many(recommended_ids)
+    return [
+        dict(recommended_articles[article_id], sort='personalized')
+        for article_id in recommended_ids if article_id in recommended_articles
+    ][:10]
+
 @app.route('/', methods=['GET'])
 def index():
     return ('Server running', 200)
@@ -21,10 +74,10 @@ def index():
 def home():
     logger = logging.getLogger('app.home')
 
-    # set GCP project and instantiate pubsub client
-    credentials, gcp_project_id = google.auth.default()
-    pubsub_client = pubsub.PublisherClient(credentials=credentials)
-    bigquery_client = bigquery.Client(project=gcp_project_id, credentials=credentials)
+    # use the GCP clients shared by this worker process
+    with span('clients'):
+        storage = clients.storage()
+        event_pipeline = clients.event_pipeline()
 
     # check the user ID or set a new one on the cookie
     user_id = check_or_set_user_id()
@@ -32,47 +85,90 @@ def home():
     # count hits for the current user ID
     user_hits = count_hits()
     
-    # instantiate global articles for tracking and retrieve list of article dictionaries
-    global articles
-    articles_client = Articles(bigquery_client)
-    articles = articles_client.get_articles(user_id)
-
-    # filter articles based on sort field
-    latest_articles = [a for a in articles if a['sort'] == 'latest']
-    popular_articles = [a for a in articles if a['sort'] == 'popular']
-    random_articles = [a for a in articles if a['sort'] == 'random']
-    personalized_articles = [a for a in articles if a['sort'] == 'personalized']
+    # the shared feed, the personalized lookup and fresh recommendations run concurrently,
+    # so the request waits for the slowest of them rather than their sum
+    articles_client = Articles(storage)
+    shared_future = submit_timed('shared_articles', articles_client.get_shared_feed)
+    personalized_future = submit_timed('personalized_articles', articles_client.get_personalized_articles, user_id)
+    fresh_future = submit_timed('recommendations', fresh_recommendations, user_id) if recommender is not None else None
+
+    # add the articles to the catalog for click tracking and group them by sort field
+    feed_version, shared_articles = shared_future.result()
+    articles = shared_articles + personalized_future.result()
+    catalog.add_many(articles)
+    articles_by_sort = group_by_sort(articles)
+    latest_articles = articles_by_sort.get('latest', [])
+    popular_articles = articles_by_sort.get('popular', [])
+    random_articles = articles_by_sort.get('random', [])
+    personalized_articles = articles_by_sort.get('personalized', [])
+
+    # prefer fresh recommendations from the user's latest clicks
+    fresh_articles = fresh_future.result() if fresh_future is not None else []
+    if fresh_articles:
+        # recommended articles may not have been served by this worker yet, so they are added for click tracking
+        catalog.add_many(fresh_articles)
+        personalized_articles = fresh_articles
+        articles = shared_articles + fresh_articles
 
     # use popular articles if personalized articles is empty
     personalized_articles = popular_articles if not personalized_articles else personalized_articles
     
-    # track article impressions
-    track_impressions(gcp_project_id, pubsub_client, articles, user_id)
-
-    # create flask response
-    resp = make_response(
-            render_template(
-                'home.html',
-                title='Home',
-                articles=latest_articles,
-                articles_v2=personalized_articles,
-                articles_random=random_articles,
-                user_hits=user_hits,
-                user_id=user_id
-            )
+    # the page only changes with the shared feed and the user's personalized articles
+    page_etag = etag(feed_version, user_id, *[a['article_id'] for a in personalized_articles])
+    if request.if_none_match.contains_weak(page_etag):
+        # the cached page is shown again, so its impressions are still tracked
+        run_in_background('track_impressions', track_impressions, event_pipeline, articles, user_id)
+        resp = make_response('', 304)
+        resp.set_etag(page_etag)
+        resp.headers['Cache-Control'] = 'private, no-cache'
+        return resp
+
+    # render the shared article lists once per feed version
+    with span('render_template'):
+        articles_html = fragment_cache.get(
+            'latest', feed_version, lambda: render_template('_articles.html', articles=latest_articles)
+        )
+        articles_random_html = fragment_cache.get(
+            'random', feed_version, lambda: render_template('_articles.html', articles=random_articles)
         )
 
+        # create flask response
+        resp = make_response(
+                render_template(
+                    'home.html',
+                    title='Home',
+                    articles_html=articles_html,
+                    articles_v2=personalized_articles,
+                    articles_random_html=articles_random_html,
+                    user_hits=user_hits,
+                    user_id=user_id
+                )
+            )
+    # track article impressions once the page is rendered, off the request path
+    run_in_background('track_impressions', track_impressions, event_pipeline, articles, user_id)
+
+    resp.set_etag(page_etag)
+    resp.headers['Cache-Control'] = 'private, no-cache'
+    published = [a['publishedAt'] for a in articles if a.get('publishedAt')]
+    if published:
+        resp.last_modified = datetime.datetime.strptime(max(published), '%Y-%m-%d %H:%M:%S')
+
     return resp
 
 @app.route('/static/tracking/<article_id>')
 def tracking_article_view(article_id):
-    # instantiate pubsub client
-    credentials, gcp_project_id = google.auth.default()
-    pubsub_client = pubsub.PublisherClient(credentials=credentials)
-    
+    # find the article clicked, looking it up in storage if another worker served the page
+    with span('catalog_lookup'):
+        article = catalog.get(article_id, clients.storage())
+    if article is None:
+        return redirect('/home')
+
     # tracks the article clicked prior to redirecting the user
     user_id = check_or_set_user_id()
-    redirect_url = track_click_and_get_url(gcp_project_id, pubsub_client, article_id, articles, user_id)
+    if recommender is not None:
+        recommender.record_click(user_id, article_id)
+    with span('track_click'):
+        redirect_url = track_click_and_get_url(clients.event_pipeline(), article, user_id)
 
     return redirect(redirect_url)
 
@@ -0,0 +1,190 @@
+import io
+import os
+import time
+import pstats
+import random
+import cProfile
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger('app.metrics')
+
+# fraction of requests that are profiled, and the duration above which a profiled request is reported
+SLOW_REQUEST_SAMPLE_RATE = float(os.getenv('SLOW_REQUEST_SAMPLE_RATE', 0))
+SLOW_REQUEST_THRESHOLD = float(os.getenv('SLOW_REQUEST_THRESHOLD', 1.0))
+# optional directory where the profiles of slow requests are written as .prof files
+SLOW_REQUEST_PROFILE_DIR = os.getenv('SLOW_REQUEST_PROFILE_DIR')
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in pairs) + '}'
+
+
+class Histogram:
+    def __init__(self, name, description, label_names=(), buckets=DEFAULT_BUCKETS):
+        """Instantiates a thread safe histogram with cumulative buckets, rendered in the Prometheus text format
+        Args:
+            name: metric name
+            description: help text
+            label_names: names of the labels of each series
+            buckets: upper bounds of the buckets in seconds
+        """
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['counts'][index] += 1
+                    break
+            series['sum'] += value
+            series['count'] += 1
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.description), '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            series_items = [(label_values, dict(series, counts=list(series['counts']))) for label_values, series in self._series.items()]
+        for label_values, series in sorted(series_items):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series['counts']):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(self.name, format_labels(self.label_names, label_values, ('le', bound)), cumulative))
+            lines.append('{}_bucket{} {}'.format(self.name, format_labels(self.label_names, label_values, ('le', '+Inf')), series['count']))
+            lines.append('{}_sum{} {}'.format(self.name, format_labels(self.label_names, label_values), series['sum']))
+            lines.append('{}_count{} {}'.format(self.name, format_labels(self.label_names, label_values), series['count']))
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        """Holds the metrics of this process. With several gunicorn workers each worker keeps its own metrics
+        """
+        self.request_seconds = Histogram(
+            'http_request_duration_seconds', 'Duration of HTTP requests', ('route', 'method', 'status')
+        )
+        self.stage_seconds = Histogram(
+            'stage_duration_seconds', 'Duration of the stages of a request or job', ('stage',)
+        )
+        self._local = threading.local()
+        self._collectors = {}
+
+    def add_collector(self, name, collect):
+        """Adds metrics owned by another object, e.g. the counters of the event pipeline
+        Args:
+            name: collector name, adding a collector with the same name replaces the previous one
+            collect: function returning the lines of its metrics in the Prometheus text format
+        """
+        self._collectors[name] = collect
+
+    def render(self):
+        """Returns all metrics in the Prometheus text exposition format
+        """
+        lines = self.request_seconds.render() + self.stage_seconds.render()
+        for collect in list(self._collectors.values()):
+            lines += collect()
+        return '\n'.join(lines) + '\n'
+
+    def start_request(self):
+        self._local.stages = []
+
+    def request_stages(self):
+        """Returns the (stage, seconds) pairs timed by the current thread since the request started
+        """
+        return getattr(self._local, 'stages', None)
+
+    @contextmanager
+    def span(self, stage, stages=None):
+        """Times a block and records it in the stage histogram and the current request's stages
+        Args:
+            stage: stage name e.g. 'render_template'
+            stages: list the timing is appended to, defaults to the stages of the request on this thread.
+                Pass `request_stages()` of the request thread to time work done on other threads
+        """
+        if stages is None:
+            stages = getattr(self._local, 'stages', None)
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start_time
+            self.stage_seconds.observe(seconds, stage)
+            if stages is not None:
+                stages.append((stage, seconds))
+
+
+registry = Registry()
+span = registry.span
+
+# only one request is profiled at a time so concurrent profilers never overlap
+_profile_lock = threading.Lock()
+
+def instrument(app, sample_rate=SLOW_REQUEST_SAMPLE_RATE, threshold=SLOW_REQUEST_THRESHOLD,
+               profile_dir=SLOW_REQUEST_PROFILE_DIR):
+    """Times every request of a Flask app, adds the /metrics route and optionally profiles a sample
+    of requests, reporting those slower than `threshold` with their top functions and stages
+    Args:
+        app: Flask app
+        sample_rate: fraction of requests profiled, 0 disables profiling
+        threshold: seconds above which a profiled request is reported
+        profile_dir: optional directory where the profiles of slow requests are written
+    """
+    from flask import g, request, Response
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+        registry.start_request()
+        g.profiler = None
+        if sample_rate and random.random() < sample_rate and _profile_lock.acquire(blocking=False):
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+    @app.after_request
+    def record_request(response):
+        seconds = time.perf_counter() - g.get('request_start', time.perf_counter())
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        registry.request_seconds.observe(seconds, route, request.method, response.status_code)
+        return response
+
+    @app.teardown_request
+    def stop_profiler(exception=None):
+        profiler = g.get('profiler')
+        if profiler is None:
+            return
+        profiler.disable()
+        g.profiler = None
+        _profile_lock.release()
+        seconds = time.perf_counter() - g.get('request_start', time.perf_counter())
+        if seconds >= threshold:
+            report_slow_request(profiler, request.path, seconds, profile_dir)
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+def report_slow_request(profiler, path, seconds, profile_dir=None, top=20):
+    """Logs the stages and the functions with the most cumulative time of a slow request
+    """
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(top)
+    stages = {stage: round(stage_seconds, 4) for stage, stage_seconds in registry.request_stages() or []}
+    logger.warning(
+        'slow request %s took %.3f seconds', path, seconds,
+        extra={'category': 'profile', 'stages': stages, 'profile': output.getvalue()}
+    )
+    if profile_dir:
+        filename = os.path.join(profile_dir, '{}-{}.prof'.format(int(time.time() * 1000), path.strip('/').replace('/', '_') or 'index'))
+        profiler.dump_stats(filename)
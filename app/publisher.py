@@ -1,7 +1,9 @@
 import json
-import base64
+import time
+import queue
 import logging
-from google.cloud import pubsub
+import threading
+from metrics import format_labels, registry
 
 logger = logging.getLogger('app.publisher')
 
@@ -13,18 +15,26 @@ class Publisher:
         """
         self.publisher_client = publisher_client
 
-    def pubsub_publish(self, topic_path, message_data):
+    def pubsub_publish(self, topic_path, message_data, callback=None, attributes=None):
         """Function that publishes a message to a GCP Pub/Sub topic
         Args:
             topic_name: Pub/Sub topic name
-            message_data: JSON message to be published
+            message_data: JSON message to be published, or bytes that are already encoded
+            callback: optional done callback, defaults to `pubsub_callback`
+            attributes: optional dictionary of message attributes
+        Returns:
+            message_future: future for the published message
         """
-        json_data = json.dumps(message_data)
-        data_payload = json_data.encode('utf-8')
-        # print("Publishing message: {}".format(json_data))
+        if isinstance(message_data, bytes):
+            data_payload = message_data
+        else:
+            json_data = json.dumps(message_data)
+            data_payload = json_data.encode('utf-8')
+
+        message_future = self.publisher_client.publish(topic_path, data=data_payload, **(attributes or {}))
+        message_future.add_done_callback(callback or self.pubsub_callback)
 
-        message_future = self.publisher_client.publish(topic_path, data=data_payload)
-        message_future.add_done_callback(self.pubsub_callback)
+        return message_future
 
     def pubsub_callback(self, message_future):
         """Return a callback with errors or an update ID upon publishing messages to Pub/Sub
@@ -32,10 +42,184 @@ class Publisher:
             topic_name: Pub/Sub topic name
             message_future: Pub/Sub message
         """
-        # When timeout is unspecified, the exception method waits indefinitely.
-        if message_future.exception(timeout=30):
-            print("Failed to publish message. exception: {}.".format(message_future.exception()))
-            logger.info("Failed to publish message. exception: {}.".format(message_future.exception()))
+        # the future is already resolved when the callback runs so this does not block the callback thread
+        if message_future.exception():
+            logger.warning('failed to publish message: %s', message_future.exception(), extra={'category': 'publish'})
         else:
-            print("Published message update id: {}".format(message_future.result()))
-            logger.info("Published message update id: {}".format(message_future.result()))
+            logger.debug('published message id: %s', message_future.result(), extra={'category': 'publish'})
+
+
+class EventPipeline:
+    def __init__(self, publisher_client, project_id, max_queue_size=10000, max_batch_size=100,
+                 max_latency=0.5, overflow='drop_newest', block_timeout=0.05):
+        """Instantiates a long lived pipeline that queues tracking events in memory and publishes
+        them to Pub/Sub from a background thread, so publishing never blocks a request
+        Args:
+            publisher_client: Pubsub publisher client
+            project_id: GCP project ID
+            max_queue_size: maximum number of events waiting to be published
+            max_batch_size: number of events that triggers a flush
+            max_latency: seconds after which a partial batch is flushed
+            overflow: what to do when the queue is full, one of
+                'drop_newest' drops the submitted event,
+                'drop_oldest' drops the oldest queued event to make room,
+                'block' waits up to `block_timeout` seconds for room before dropping
+            block_timeout: seconds to wait for room when overflow is 'block'
+        """
+        if overflow not in ('drop_newest', 'drop_oldest', 'block'):
+            raise ValueError('unknown overflow policy: {}'.format(overflow))
+        self.publisher = Publisher(publisher_client)
+        self.publisher_client = publisher_client
+        self.project_id = project_id
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._topic_paths = {}
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._in_flight = 0
+        self._counters = {'queued': 0, 'sent': 0, 'failed': 0, 'dropped': 0}
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='event-pipeline', daemon=True)
+        self._thread.start()
+        # the counters are served on /metrics while the worker runs
+        registry.add_collector('event_pipeline', self.render_metrics)
+
+    def submit(self, topic_name, message_data, attributes=None):
+        """Queues an event for publishing without waiting for Pub/Sub
+        Args:
+            topic_name: Pub/Sub topic name e.g. 'news_impressions'
+            message_data: JSON message to be published, or bytes that are already encoded
+            attributes: optional dictionary of message attributes
+        Returns:
+            True if the event was queued, False if it was dropped
+        """
+        event = (topic_name, message_data, attributes)
+        try:
+            if self.overflow == 'block':
+                self._queue.put(event, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(event)
+        except queue.Full:
+            if self.overflow != 'drop_oldest':
+                self._count('dropped')
+                return False
+            try:
+                self._queue.get_nowait()
+                self._queue.task_done()
+                self._count('dropped')
+            except queue.Empty:
+                pass
+            try:
+                self._queue.put_nowait(event)
+            except queue.Full:
+                self._count('dropped')
+                return False
+        self._count('queued')
+        return True
+
+    def stats(self):
+        """Returns a copy of the counters for queued, sent, failed and dropped events
+        """
+        with self._lock:
+            stats = dict(self._counters)
+            stats['in_flight'] = self._in_flight
+        stats['backlog'] = self._queue.qsize()
+        return stats
+
+    def render_metrics(self):
+        """Returns the counters and the queue sizes in the Prometheus text format
+        """
+        stats = self.stats()
+        lines = [
+            '# HELP tracking_events_total Tracking events by outcome since the worker started',
+            '# TYPE tracking_events_total counter',
+        ]
+        for state in ('queued', 'sent', 'failed', 'dropped'):
+            lines.append('tracking_events_total{} {}'.format(format_labels(('state',), (state,)), stats[state]))
+        lines += [
+            '# HELP tracking_events_pending Tracking events waiting to be published or in flight',
+            '# TYPE tracking_events_pending gauge',
+        ]
+        for state in ('backlog', 'in_flight'):
+            lines.append('tracking_events_pending{} {}'.format(format_labels(('state',), (state,)), stats[state]))
+        return lines
+
+    def flush(self, timeout=10):
+        """Waits until every queued event has been published or failed
+        Args:
+            timeout: maximum seconds to wait
+        Returns:
+            True if the pipeline drained within the timeout
+        """
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+        with self._idle:
+            while self._in_flight:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._idle.wait(remaining)
+            return not self._in_flight and not self._queue.unfinished_tasks
+
+    def close(self, timeout=10):
+        """Publishes the remaining events and stops the background thread
+        """
+        drained = self.flush(timeout)
+        self._stopping.set()
+        self._thread.join(timeout=1)
+        logger.info('closed event pipeline: %s', self.stats())
+        return drained
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def _topic_path(self, topic_name):
+        if topic_name not in self._topic_paths:
+            self._topic_paths[topic_name] = self.publisher_client.topic_path(self.project_id, topic_name)
+        return self._topic_paths[topic_name]
+
+    def _next_batch(self):
+        # wait for the first event, then collect until the batch is full or the latency budget is spent
+        try:
+            batch = [self._queue.get(timeout=self.max_latency)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.max_latency
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stopping.is_set():
+            batch = self._next_batch()
+            if not batch:
+                continue
+            with self._lock:
+                self._in_flight += len(batch)
+            for topic_name, message_data, attributes in batch:
+                try:
+                    self.publisher.pubsub_publish(self._topic_path(topic_name), message_data, self._on_done, attributes)
+                except Exception as e:
+                    logger.warning('failed to publish event to %s: %s', topic_name, e)
+                    self._on_done(None)
+                finally:
+                    self._queue.task_done()
+
+    def _on_done(self, message_future):
+        failed = message_future is None or message_future.exception() is not None
+        with self._idle:
+            self._counters['failed' if failed else 'sent'] += 1
+            self._in_flight -= 1
+            if not self._in_flight:
+                self._idle.notify_all()
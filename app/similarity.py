@@ -0,0 +1,200 @@
+import os
+import time
+import threading
+import logging
+from collections import OrderedDict, deque
+from urllib.parse import urlparse
+import numpy
+
+logger = logging.getLogger('app.similarity')
+
+class SimilarityIndex:
+    def __init__(self, article_ids, embeddings, topics=None, centroids=None, articles=None, approximate_threshold=20000, n_probe=3):
+        """Instantiates a top-k dot product index over L2 normalized article embeddings.
+        Windows larger than `approximate_threshold` are searched approximately by only
+        scoring the articles in the `n_probe` topics closest to the query
+        Args:
+            article_ids: list of article IDs, one per embedding row
+            embeddings: float array with one row per article
+            topics: optional topic ID of each article from the topic model
+            centroids: optional topic centroids, required for approximate search
+            articles: optional dictionary of article_id to the fields shown on the site
+            approximate_threshold: number of articles above which the approximate search is used
+            n_probe: number of topics scored by the approximate search
+        """
+        self.article_ids = list(article_ids)
+        self.rows = {article_id: row for row, article_id in enumerate(self.article_ids)}
+        self.embeddings = normalize(numpy.asarray(embeddings, dtype=numpy.float32))
+        self.articles = articles or {}
+        self.n_probe = n_probe
+        self.lists = None
+        if topics is not None and centroids is not None and len(self.article_ids) > approximate_threshold:
+            self.centroids = normalize(numpy.asarray(centroids, dtype=numpy.float32))
+            topics = numpy.asarray(topics)
+            self.lists = [numpy.flatnonzero(topics == topic) for topic in range(len(self.centroids))]
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        """Loads an index from a local .npz snapshot written by the backend topic model
+        """
+        with numpy.load(path, allow_pickle=False) as snapshot:
+            article_ids = snapshot['article_ids'].tolist()
+            return cls(
+                article_ids,
+                snapshot['embeddings'],
+                snapshot['topics'] if 'topics' in snapshot else None,
+                snapshot['centroids'] if 'centroids' in snapshot else None,
+                snapshot_articles(snapshot, article_ids),
+                **kwargs
+            )
+
+    def __len__(self):
+        return len(self.article_ids)
+
+    def vector(self, article_ids):
+        """Returns the normalized mean embedding of the given articles, or None if none are indexed
+        """
+        rows = [self.rows[article_id] for article_id in article_ids if article_id in self.rows]
+        if not rows:
+            return None
+        return normalize(self.embeddings[rows].mean(axis=0))
+
+    def search(self, vector, k=10, exclude=()):
+        """Returns the IDs of the k articles most similar to a normalized vector
+        Args:
+            vector: normalized query vector
+            k: number of articles to return
+            exclude: article IDs to leave out, e.g. articles the user already clicked
+        Returns:
+            article_ids: list ordered by decreasing similarity
+        """
+        if self.lists is not None:
+            probes = numpy.argsort(self.centroids @ vector)[::-1][:self.n_probe]
+            candidates = numpy.concatenate([self.lists[topic] for topic in probes])
+        else:
+            candidates = numpy.arange(len(self.article_ids))
+        if not len(candidates):
+            return []
+
+        scores = self.embeddings[candidates] @ vector
+        count = min(k + len(exclude), len(candidates))
+        top = numpy.argpartition(-scores, count - 1)[:count]
+        top = top[numpy.argsort(-scores[top])]
+        exclude = set(exclude)
+        article_ids = [self.article_ids[candidates[row]] for row in top]
+        return [article_id for article_id in article_ids if article_id not in exclude][:k]
+
+
+class ClickHistory:
+    def __init__(self, max_users=100000, max_clicks=20):
+        """Instantiates a bounded, thread safe record of the latest clicks of each user
+        Args:
+            max_users: maximum number of users kept, least recently active users are evicted
+            max_clicks: number of latest clicks kept per user
+        """
+        self.max_users = max_users
+        self.max_clicks = max_clicks
+        self._lock = threading.Lock()
+        self._clicks = OrderedDict()
+
+    def add(self, user_id, article_id):
+        with self._lock:
+            clicks = self._clicks.get(user_id)
+            if clicks is None:
+                clicks = self._clicks[user_id] = deque(maxlen=self.max_clicks)
+            self._clicks.move_to_end(user_id)
+            clicks.append(article_id)
+            while len(self._clicks) > self.max_users:
+                self._clicks.popitem(last=False)
+
+    def get(self, user_id):
+        with self._lock:
+            return list(self._clicks.get(user_id, ()))
+
+
+class Recommender:
+    def __init__(self, snapshot_path, history=None, check_interval=60):
+        """Serves recommendations from the clicks seen by this worker and a local embedding
+        snapshot, reloading the snapshot when a new file is swapped in
+        Args:
+            snapshot_path: local path of the .npz embedding snapshot
+            history: ClickHistory, a new one is created by default
+            check_interval: seconds between checks for a new snapshot file
+        """
+        self.snapshot_path = snapshot_path
+        self.history = history or ClickHistory()
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._index = None
+        self._snapshot_mtime = None
+        self._checked_at = 0
+
+    def index(self):
+        """Returns the current SimilarityIndex, or None if no snapshot exists
+        """
+        now = time.monotonic()
+        if now - self._checked_at >= self.check_interval:
+            with self._lock:
+                if now - self._checked_at >= self.check_interval:
+                    self._checked_at = now
+                    self._reload()
+        return self._index
+
+    def _reload(self):
+        try:
+            mtime = os.stat(self.snapshot_path).st_mtime
+        except FileNotFoundError:
+            return
+        if mtime != self._snapshot_mtime:
+            self._index = SimilarityIndex.load(self.snapshot_path)
+            self._snapshot_mtime = mtime
+            logger.info('loaded embedding snapshot %s with %s articles', self.snapshot_path, len(self._index))
+
+    def articles(self, article_ids):
+        """Returns the fields of the given articles stored in the snapshot
+        Returns:
+            dictionary of article_id to article, empty for snapshots written without article fields
+        """
+        index = self.index()
+        if index is None:
+            return {}
+        return {article_id: index.articles[article_id] for article_id in article_ids if article_id in index.articles}
+
+    def record_click(self, user_id, article_id):
+        self.history.add(user_id, article_id)
+
+    def recommend(self, user_id, k=10):
+        """Returns the IDs of up to k unclicked articles closest to the user's recent clicks
+        """
+        index = self.index()
+        clicks = self.history.get(user_id)
+        if index is None or not clicks:
+            return []
+        vector = index.vector(clicks)
+        if vector is None:
+            return []
+        return index.search(vector, k, exclude=clicks)
+
+
+def snapshot_articles(snapshot, article_ids):
+    """Returns the article fields stored in a snapshot keyed by article_id, or None for
+    snapshots written before the fields were added
+    """
+    if 'title' not in snapshot:
+        return None
+    fields = [field for field in ('title', 'description', 'content', 'url', 'urlToImage', 'published') if field in snapshot]
+    columns = {field: snapshot[field].tolist() for field in fields}
+    articles = {}
+    for row, article_id in enumerate(article_ids):
+        article = {'article_id': article_id}
+        for field in fields:
+            article['publishedAt' if field == 'published' else field] = columns[field][row]
+        article['url_host'] = urlparse(article.get('url', '')).netloc
+        articles[article_id] = article
+    return articles
+
+def normalize(vectors):
+    """L2 normalizes a vector or the rows of a matrix
+    """
+    norms = numpy.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / numpy.maximum(norms, 1e-12)
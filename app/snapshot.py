@@ -0,0 +1,219 @@
+import os
+import mmap
+import json
+import time
+import fcntl
+import struct
+import threading
+import logging
+
+logger = logging.getLogger('app.snapshot')
+
+# file layout: header, fixed size index entries sorted by user_id, then a blob of user_ids and JSON rows
+#   header: magic, version string length, entry count
+#   entry:  key offset, key length, data offset, data length (offsets relative to the start of the blob)
+MAGIC = b'NEWSSNP1'
+HEADER = struct.Struct('<8sHI')
+ENTRY = struct.Struct('<IHII')
+
+def write_snapshot(path, rows_by_user, version):
+    """Writes personalized articles keyed by user_id to a snapshot file. The file is written
+    next to `path` and renamed into place so readers never see a partial snapshot
+    Args:
+        path: local path of the snapshot file
+        rows_by_user: dictionary of user_id to a list of article dictionaries
+        version: string identifying the source data e.g. the table modified time
+    """
+    version_bytes = version.encode('utf-8')
+    keys = sorted(rows_by_user)
+    entries = []
+    blob = bytearray(version_bytes)
+    for key in keys:
+        key_bytes = key.encode('utf-8')
+        data_bytes = json.dumps(rows_by_user[key], separators=(',', ':')).encode('utf-8')
+        key_offset = len(blob)
+        blob += key_bytes
+        data_offset = len(blob)
+        blob += data_bytes
+        entries.append(ENTRY.pack(key_offset, len(key_bytes), data_offset, len(data_bytes)))
+
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(version_bytes), len(entries)))
+        f.write(b''.join(entries))
+        f.write(blob)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+    logger.info('wrote snapshot %s with %s users', path, len(keys))
+
+
+class Snapshot:
+    def __init__(self, path):
+        """Opens a snapshot file as a read only memory map shared by all processes on the host
+        Args:
+            path: local path of the snapshot file
+        """
+        with open(path, 'rb') as f:
+            self.inode = os.fstat(f.fileno()).st_ino
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version_length, self.count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError('{} is not a personalized articles snapshot'.format(path))
+        self._blob_start = HEADER.size + self.count * ENTRY.size
+        self.version = self._map[self._blob_start:self._blob_start + version_length].decode('utf-8')
+
+    def _entry(self, index):
+        return ENTRY.unpack_from(self._map, HEADER.size + index * ENTRY.size)
+
+    def _key(self, key_offset, key_length):
+        start = self._blob_start + key_offset
+        return self._map[start:start + key_length]
+
+    def get(self, user_id):
+        """Binary searches the index for a user_id
+        Args:
+            user_id: User ID from the browser cookie
+        Returns:
+            articles: List of dictionaries, empty if the user has no recommendations
+        """
+        target = user_id.encode('utf-8')
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            key_offset, key_length, data_offset, data_length = self._entry(middle)
+            key = self._key(key_offset, key_length)
+            if key < target:
+                low = middle + 1
+            elif key > target:
+                high = middle
+            else:
+                start = self._blob_start + data_offset
+                return json.loads(self._map[start:start + data_length])
+        return []
+
+    def close(self):
+        self._map.close()
+
+
+class SnapshotStore:
+    def __init__(self, path, check_interval=30):
+        """Serves lookups from the current snapshot file and reopens it when a new snapshot
+        is swapped in. Old maps are left to the garbage collector since other threads
+        may still be reading from them
+        Args:
+            path: local path of the snapshot file
+            check_interval: seconds between checks for a new snapshot file
+        """
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._checked_at = 0
+
+    def current(self):
+        """Returns the current Snapshot, or None if no snapshot file exists
+        """
+        now = time.monotonic()
+        if now - self._checked_at >= self.check_interval:
+            with self._lock:
+                if now - self._checked_at >= self.check_interval:
+                    self._checked_at = now
+                    self._reopen()
+        return self._snapshot
+
+    def _reopen(self):
+        try:
+            inode = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            self._snapshot = None
+            return
+        if self._snapshot is None or self._snapshot.inode != inode:
+            self._snapshot = Snapshot(self.path)
+            logger.info('opened snapshot %s version %s with %s users', self.path, self._snapshot.version, self._snapshot.count)
+
+    def get(self, user_id):
+        """Returns the personalized articles for a user, or None if no snapshot is available.
+        A new visitor has no user_id yet and gets no articles
+        """
+        if not user_id:
+            return []
+        snapshot = self.current()
+        if snapshot is None:
+            return None
+        return snapshot.get(user_id)
+
+    def refresh(self, bigquery_client, table):
+        """Exports the personalized articles table to the snapshot file if the table changed
+        since the current snapshot was written. A lock file makes sure only one worker
+        process on the host runs the export
+        Args:
+            bigquery_client: BigQuery client
+            table: fully qualified personalized articles table
+        """
+        version = bigquery_client.get_table(table).modified.isoformat()
+        snapshot = self.current()
+        if snapshot is not None and snapshot.version == version:
+            return False
+
+        with open('{}.lock'.format(self.path), 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # another worker is exporting this version
+                return False
+            export_snapshot(bigquery_client, table, self.path, version)
+
+        with self._lock:
+            self._checked_at = time.monotonic()
+            self._reopen()
+        return True
+
+    def start_refresh(self, bigquery_client, table, interval):
+        """Starts a daemon thread that calls `refresh` every `interval` seconds
+        """
+        def refresh_loop():
+            while True:
+                try:
+                    self.refresh(bigquery_client, table)
+                except Exception as e:
+                    logger.warning('failed to refresh snapshot %s: %s', self.path, e)
+                time.sleep(interval)
+
+        thread = threading.Thread(target=refresh_loop, daemon=True)
+        thread.start()
+        return thread
+
+
+def export_snapshot(bigquery_client, table, path, version):
+    """Queries the top 10 unclicked personalized articles for every user and writes them to a snapshot
+    Args:
+        bigquery_client: BigQuery client
+        table: fully qualified personalized articles table
+        path: local path of the snapshot file
+        version: string identifying the source data
+    """
+    export_query = """
+        SELECT
+            user_id,
+            'personalized' AS sort,
+            * EXCEPT (user_id, topic, total_clicks, user_already_clicked, article_order, load_timestamp)
+        FROM `{}`
+        WHERE
+            user_already_clicked = FALSE
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY total_clicks DESC, publishedAt DESC) <= 10
+        ORDER BY
+            user_id, total_clicks DESC, publishedAt DESC
+    """.format(table)
+
+    logger.info('exporting snapshot from %s', table)
+
+    rows_by_user = {}
+    for row in bigquery_client.query(export_query):
+        article = dict(row)
+        user_id = article.pop('user_id')
+        article['publishedAt'] = article['publishedAt'].strftime('%Y-%m-%d %H:%M:%S')
+        rows_by_user.setdefault(user_id, []).append(article)
+
+    write_snapshot(path, rows_by_user, version)
@@ -0,0 +1,231 @@
+import os
+import logging
+import sqlite3
+import threading
+from urllib.parse import urlparse
+from google.cloud import bigquery
+
+logger = logging.getLogger('app.storage')
+
+# columns of the articles shown on the site
+ARTICLE_COLUMNS = 'article_id, title, author, description, content, url, urlToImage, publishedAt'
+
+class BigQueryStorage:
+    name = 'bigquery'
+
+    def __init__(self, bigquery_client):
+        """Instantiates the storage layer for reading articles from the BigQuery tables and views
+        Args:
+            bigquery_client: BigQuery client
+        """
+        self.client = bigquery_client
+
+    def shared_articles(self):
+        """Queries the latest, popular and random articles which are the same for every user
+        Returns:
+            articles: List of dictionaries containing article data
+        """
+        latest_articles_table = os.getenv('ARTICLES_TABLE')
+        articles_query = """
+            SELECT
+                * EXCEPT (load_timestamp, article_order)
+            FROM `{}`
+        """.format(latest_articles_table)
+
+        logger.info('querying shared articles from %s', latest_articles_table, extra={'category': 'query'})
+
+        return self.run_query(articles_query)
+
+    def personalized_articles(self, user_id, limit=10):
+        """Queries the personalized articles for a given user
+        Args:
+            user_id: User ID from the browser cookie
+            limit: maximum number of articles
+        Returns:
+            articles: List of dictionaries containing article data
+        """
+        personalized_articles_table = os.getenv('PERSONALIZED_ARTICLES_TABLE')
+        articles_query = """
+            SELECT
+                'personalized' AS sort,
+                * EXCEPT (user_id, topic, total_clicks, user_already_clicked, article_order, load_timestamp)
+            FROM `{}`
+            WHERE
+                user_id = @user_id
+                AND user_already_clicked = FALSE
+            ORDER BY
+                total_clicks DESC, publishedAt DESC
+            LIMIT {}
+        """.format(personalized_articles_table, int(limit))
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ScalarQueryParameter('user_id', 'STRING', user_id)]
+        )
+
+        logger.info('querying personalized articles from %s', personalized_articles_table, extra={'category': 'query'})
+
+        return self.run_query(articles_query, job_config)
+
+    def lookup_articles(self, article_ids):
+        """Queries articles by ID e.g. when another worker process served the page a click came from
+        Args:
+            article_ids: list of article IDs
+        Returns:
+            articles: List of dictionaries containing article data, an article loaded more than once appears once per load
+        """
+        # the base articles table also holds personalized articles and articles that left the shared feeds
+        articles_table = os.getenv('ARTICLES_LOOKUP_TABLE', '{}.news.articles'.format(self.client.project))
+        # the feed an article was shown in is not stored, clicks on looked up articles are tracked as latest
+        lookup_query = """
+            SELECT
+                'latest' AS sort,
+                * EXCEPT (load_timestamp, article_order),
+                NET.HOST(url) AS url_host
+            FROM `{}`
+            WHERE
+                article_id IN UNNEST(@article_ids)
+        """.format(articles_table)
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ArrayQueryParameter('article_ids', 'STRING', article_ids)]
+        )
+
+        logger.info('looking up %s articles missing from the catalog', len(article_ids), extra={'category': 'query'})
+
+        return self.run_query(lookup_query, job_config)
+
+    def run_query(self, query, job_config=None):
+        """Runs a query and returns the rows as a list of dictionaries
+        Args:
+            query: SQL query text
+            job_config: optional QueryJobConfig e.g. for query parameters
+        Returns:
+            articles: List of dictionaries containing article data
+        """
+        # run query and store results in list of dictionaries
+        query_job = self.client.query(query, job_config=job_config)
+        articles = []
+        for row in query_job:
+            articles.append(dict(row))
+
+        # convert datetime objects to strings
+        for article in articles:
+            if hasattr(article['publishedAt'], 'strftime'):
+                article['publishedAt'] = article['publishedAt'].strftime('%Y-%m-%d %H:%M:%S')
+
+        return articles
+
+
+class SQLiteStorage:
+    name = 'sqlite'
+
+    def __init__(self, path, feed_size=10, window_days=7):
+        """Instantiates the storage layer for reading articles from the SQLite database written by the
+        backend, see backend/storage.py for its tables and indexes. The feeds and personalized articles
+        are computed from the articles, clicks and article_topics tables by indexed queries
+        Args:
+            path: local path of the database file
+            feed_size: number of articles in each shared feed and in the personalized articles
+            window_days: days of clicks and articles considered for the popular and random feeds
+        """
+        self.path = path
+        self.feed_size = feed_size
+        self.window = '-{} days'.format(window_days)
+        # sqlite connections are not shared between threads, each thread opens its own read only connection
+        self._local = threading.local()
+
+    def connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect('file:{}?mode=ro'.format(self.path), uri=True)
+            connection.row_factory = sqlite3.Row
+            self._local.connection = connection
+        return connection
+
+    def shared_articles(self):
+        """Queries the latest articles, the most clicked articles and random articles of the window
+        Returns:
+            articles: List of dictionaries containing article data
+        """
+        articles_query = """
+            SELECT * FROM (
+                SELECT 'latest' AS sort, {0} FROM articles
+                ORDER BY publishedAt DESC LIMIT :size
+            )
+            UNION ALL
+            SELECT * FROM (
+                SELECT 'popular' AS sort, {0} FROM articles
+                JOIN (
+                    SELECT article_id, COUNT(*) AS total_clicks FROM clicks
+                    WHERE click_timestamp >= datetime('now', :window)
+                    GROUP BY article_id
+                ) USING (article_id)
+                ORDER BY total_clicks DESC, publishedAt DESC LIMIT :size
+            )
+            UNION ALL
+            SELECT * FROM (
+                SELECT 'random' AS sort, {0} FROM articles
+                WHERE publishedAt >= datetime('now', :window)
+                ORDER BY RANDOM() LIMIT :size
+            )
+        """.format(ARTICLE_COLUMNS)
+
+        logger.info('querying shared articles from %s', self.path, extra={'category': 'query'})
+
+        return self.run_query(articles_query, {'size': self.feed_size, 'window': self.window})
+
+    def personalized_articles(self, user_id, limit=10):
+        """Queries the most clicked articles in the topics of the user's clicks that the user has not clicked yet
+        Args:
+            user_id: User ID from the browser cookie
+            limit: maximum number of articles
+        Returns:
+            articles: List of dictionaries containing article data
+        """
+        articles_query = """
+            WITH user_clicks AS (
+                SELECT DISTINCT article_id FROM clicks WHERE user_id = :user_id
+            )
+            SELECT
+                'personalized' AS sort, {}
+            FROM articles
+            JOIN article_topics USING (article_id)
+            WHERE
+                article_topics.dominant_topic IN (
+                    SELECT dominant_topic FROM article_topics WHERE article_id IN (SELECT article_id FROM user_clicks)
+                )
+                AND article_id NOT IN (SELECT article_id FROM user_clicks)
+            ORDER BY
+                (SELECT COUNT(*) FROM clicks WHERE clicks.article_id = articles.article_id) DESC,
+                articles.publishedAt DESC
+            LIMIT :limit
+        """.format(', '.join('articles.{}'.format(column.strip()) for column in ARTICLE_COLUMNS.split(',')))
+
+        logger.info('querying personalized articles from %s', self.path, extra={'category': 'query'})
+
+        return self.run_query(articles_query, {'user_id': user_id, 'limit': limit})
+
+    def lookup_articles(self, article_ids):
+        """Queries articles by ID e.g. when another worker process served the page a click came from
+        Args:
+            article_ids: list of article IDs
+        Returns:
+            articles: List of dictionaries containing article data
+        """
+        # the feed an article was shown in is not stored, clicks on looked up articles are tracked as latest
+        lookup_query = """
+            SELECT 'latest' AS sort, {} FROM articles WHERE article_id IN ({})
+        """.format(ARTICLE_COLUMNS, ', '.join('?' * len(article_ids)))
+
+        logger.info('looking up %s articles missing from the catalog', len(article_ids), extra={'category': 'query'})
+
+        return self.run_query(lookup_query, list(article_ids))
+
+    def run_query(self, query, parameters):
+        """Runs a query and returns the rows as a list of dictionaries, with the url_host the
+        BigQuery views add
+        """
+        articles = []
+        for row in self.connection().execute(query, parameters):
+            article = dict(row)
+            article['url_host'] = urlparse(article['url'] or '').netloc
+            articles.append(article)
+        return articles
@@ -1,9 +1,8 @@
 import uuid
-import json
 import datetime
 import logging
 from flask import session, request, make_response, after_this_request, redirect
-from publisher import Publisher
+from events import encode_impression, encode_click
 
 logger = logging.getLogger('app.tracking')
 
@@ -16,15 +15,13 @@ def check_or_set_user_id():
     # check if user_id exists on cookie otherwise generate a new one (not encrypted on cookie)
     user_id = request.cookies.get('user_id')
     if user_id:
-        print("Found user_id: {}".format(user_id))
-        logger.info("Found user_id: {}".format(user_id))
+        logger.debug('found user_id on cookie', extra={'category': 'user'})
         resp = make_response()
         session['user_id'] = user_id
         return user_id
     else:
         user_uuid = uuid.uuid4()
-        print("Generating new ID: {}".format(user_uuid))
-        logger.info("Generating new ID: {}".format(user_uuid))
+        logger.debug('generating new user_id', extra={'category': 'user'})
         encoded_user_uuid = str(user_uuid).encode('utf-8')
         resp = make_response(redirect('/home'))
         resp.set_cookie('user_id', encoded_user_uuid)
@@ -46,18 +43,16 @@ def count_hits():
     if not hits:
         session['hits'] = 1
     else:
-        print("Hits from this user: {}".format(str(session['hits'])))
-        logger.info("Hits from this user: {}".format(str(session['hits'])))
+        logger.debug('hits from this user: %s', session['hits'], extra={'category': 'user'})
         session['hits'] += 1
 
     return hits
 
-def track_impressions(project_id, pubsub_client, articles, user_id):
+def track_impressions(event_pipeline, articles, user_id):
     """Tracks articles that were presented to a given user regardless of whether they were clicked
 
     Args:
-        project_id: GCP project ID
-        pubsub_client: Pubsub publisher client
+        event_pipeline: EventPipeline used to publish tracking events
         articles: list of dictionaries with article metadata
         user_id: ID of the user
     """
@@ -72,39 +67,22 @@ def track_impressions(project_id, pubsub_client, articles, user_id):
                 article_impression_tracking[field] = article[field]
         impression_tracker['articles'].append(article_impression_tracking)
 
-    print("""
-    *********************
-    impression tracker: {}
-    *********************
-    """.format(json.dumps(impression_tracker))
-    )
-    logger.info("""
-    *********************
-    impression tracker: {}
-    *********************
-    """.format(json.dumps(impression_tracker))
-    )
-
-    # publish message to pubsub topic
-    publisher = Publisher(pubsub_client)
-    publisher_path = pubsub_client.topic_path(project_id, 'news_impressions')
-    publisher.pubsub_publish(publisher_path, json.dumps(impression_tracker))
+    logger.info('tracked %s impressions', len(impression_tracker['articles']), extra={'category': 'impression'})
+
+    # queue message for the pubsub topic
+    data, attributes = encode_impression(impression_tracker)
+    event_pipeline.submit('news_impressions', data, attributes)
 
     return 204
 
-def track_click_and_get_url(project_id, pubsub_client, article_id, articles, user_id):
-    """Tracks a link click based on article ID and returns the article URL
+def track_click_and_get_url(event_pipeline, article_dict, user_id):
+    """Tracks a link click and returns the article URL
 
     Args:
-        project_id: GCP project ID
-        pubsub_client: Pubsub publisher client
-        article_id: article ID which can be mapped to article metadata
-        articles: list of dictionaries with article metadata
+        event_pipeline: EventPipeline used to publish tracking events
+        article_dict: dictionary with metadata for the article clicked
         user_id: ID of the user
     """
-
-    # find the dictionary for the article clicked in the list of article dictionaries
-    article_dict = next(item for item in articles if item['article_id'] == article_id)
     article_url = article_dict['url'] 
 
     # populate click tracker dictionary
@@ -119,22 +97,10 @@ def track_click_and_get_url(project_id, pubsub_client, article_id, articles, use
 
     click_tracker['article_clicked'] = article_click_tracking
 
-    print("""
-    *********************
-    click tracker: {}
-    *********************
-    """.format(json.dumps(click_tracker))
-    )
-    logger.info("""
-    *********************
-    click tracker: {}
-    *********************
-    """.format(json.dumps(click_tracker))
-    )
-
-    # publish message to pubsub topic
-    publisher = Publisher(pubsub_client)
-    publisher_path = pubsub_client.topic_path(project_id, 'news_clicks')
-    publisher.pubsub_publish(publisher_path, json.dumps(click_tracker))
+    logger.info('tracked click on article %s', article_click_tracking.get('article_id'), extra={'category': 'click'})
+
+    # queue message for the pubsub topic
+    data, attributes = encode_click(click_tracker)
+    event_pipeline.submit('news_clicks', data, attributes)
 
     return article_url
\ No newline at end of file
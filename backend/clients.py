@@ -0,0 +1,139 @@
+import os
+import time
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from metrics import span
+
+logger = logging.getLogger('app.clients')
+
+# tables are kept in 'bigquery' or in a local 'sqlite' database at SQLITE_PATH, see storage.py
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'bigquery')
+SQLITE_PATH = os.getenv('SQLITE_PATH', '/tmp/news.db')
+
+class Clients:
+    def __init__(self):
+        """Instantiates a registry of GCP clients shared by all threads of a worker process.
+        Client libraries are imported and clients are created on first use, so a cold start
+        only pays for the clients of the route that is called
+        """
+        self._lock = threading.Lock()
+        self._client_locks = {name: threading.Lock() for name in self.FACTORIES}
+        self._clients = {}
+        self._credentials = None
+        self._project_id = None
+        self.timings = {}
+
+    def reset(self):
+        """Drops all clients so they are rebuilt on next use. gRPC channels and HTTP
+        connection pools must not be shared across a fork, so this runs in the child process
+        """
+        self.__init__()
+
+    def credentials(self):
+        """Returns the default credentials and GCP project ID, resolving them once per process
+        Returns:
+            (credentials, project_id)
+        """
+        if self._credentials is None:
+            with self._lock:
+                if self._credentials is None:
+                    start_time = time.monotonic()
+                    with span('auth'):
+                        import google.auth
+                        self._credentials, self._project_id = google.auth.default()
+                    self.timings['auth'] = round(time.monotonic() - start_time, 3)
+                    logger.info('resolved credentials for project %s', self._project_id)
+        return self._credentials, self._project_id
+
+    def project_id(self):
+        return self.credentials()[1]
+
+    def _create_bigquery_client(self):
+        from google.cloud import bigquery
+        credentials, project_id = self.credentials()
+        return bigquery.Client(project=project_id, credentials=credentials)
+
+    def _create_gcs_client(self):
+        from google.cloud import storage
+        credentials, project_id = self.credentials()
+        return storage.Client(project=project_id, credentials=credentials)
+
+    def _create_subscriber_client(self):
+        from google.cloud import pubsub
+        credentials, project_id = self.credentials()
+        return pubsub.SubscriberClient(credentials=credentials)
+
+    def _create_gcsfs_client(self):
+        import gcsfs
+        return gcsfs.GCSFileSystem(project=os.getenv('GCP_PROJECT_ID'))
+
+    def _create_storage(self):
+        from storage import BigQueryStorage, SQLiteStorage
+        if STORAGE_BACKEND == 'sqlite':
+            return SQLiteStorage(SQLITE_PATH, fs=self.get('gcsfs'))
+        if STORAGE_BACKEND != 'bigquery':
+            raise ValueError('unknown storage backend: {}'.format(STORAGE_BACKEND))
+        return BigQueryStorage(self.get('bigquery'))
+
+    FACTORIES = {
+        'bigquery': _create_bigquery_client,
+        'gcs': _create_gcs_client,
+        'subscriber': _create_subscriber_client,
+        'gcsfs': _create_gcsfs_client,
+        'storage': _create_storage,
+    }
+
+    def get(self, name):
+        """Returns the shared client with the given name, creating it on first use
+        Args:
+            name: one of 'bigquery', 'gcs', 'subscriber', 'gcsfs' or 'storage'
+        """
+        client = self._clients.get(name)
+        if client is None:
+            with self._client_locks[name]:
+                client = self._clients.get(name)
+                if client is None:
+                    start_time = time.monotonic()
+                    with span('create_{}_client'.format(name)):
+                        client = self.FACTORIES[name](self)
+                    self._clients[name] = client
+                    self.timings[name] = round(time.monotonic() - start_time, 3)
+                    logger.info('created %s client in %s seconds', name, self.timings[name])
+        return client
+
+    def bigquery_client(self):
+        return self.get('bigquery')
+
+    def gcs_client(self):
+        return self.get('gcs')
+
+    def subscriber_client(self):
+        return self.get('subscriber')
+
+    def gcsfs_client(self):
+        return self.get('gcsfs')
+
+    def storage(self):
+        return self.get('storage')
+
+    def warm_up(self, *names):
+        """Creates the given clients concurrently, so their imports and connection setup overlap
+        Args:
+            names: client names, all clients by default
+        """
+        names = [name for name in (names or self.FACTORIES) if name not in self._clients]
+        if not names:
+            return
+        # credentials are shared by the google clients so they are resolved once up front
+        if any(name != 'gcsfs' for name in names):
+            self.credentials()
+        if len(names) == 1:
+            self.get(names[0])
+            return
+        with ThreadPoolExecutor(max_workers=len(names)) as executor:
+            list(executor.map(self.get, names))
+
+
+clients = Clients()
+os.register_at_fork(after_in_child=clients.reset)
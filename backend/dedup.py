@@ -0,0 +1,121 @@
+import uuid
+import struct
+import logging
+import datetime
+from array import array
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+logger = logging.getLogger('app.dedup')
+
+# namespace for article IDs derived from the normalized article URL
+ARTICLE_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, 'https://newsapi.org/v2/everything')
+
+MAGIC = b'NEWSSEEN'
+HEADER = struct.Struct('<8sI')
+
+def normalize_url(url):
+    """Normalizes an article URL so the same story fetched twice maps to the same ID.
+    Drops the fragment, tracking parameters and trailing slashes and lowercases the host
+    """
+    parts = urlsplit(url.strip())
+    query = urlencode(sorted(
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not key.lower().startswith('utm_')
+    ))
+    path = parts.path.rstrip('/') or '/'
+    return urlunsplit(('https', parts.netloc.lower(), path, query, ''))
+
+def article_id(article):
+    """Returns a deterministic article ID from the normalized URL, or from the title and
+    publish time for articles without a URL
+    """
+    if article.get('url'):
+        name = normalize_url(article['url'])
+    else:
+        name = '{}|{}'.format(article.get('title'), article.get('publishedAt'))
+    return str(uuid.uuid5(ARTICLE_NAMESPACE, name))
+
+
+class SeenIndex:
+    def __init__(self, retention_days=30):
+        """Instantiates an index of article IDs that were already loaded. Each ID is stored as a
+        64 bit key with the day it was first seen, and keys older than `retention_days` are evicted on save
+        Args:
+            retention_days: days an article ID is remembered
+        """
+        self.retention_days = retention_days
+        self._first_seen = {}
+
+    @staticmethod
+    def key(article_id):
+        return int(uuid.UUID(article_id).hex[:16], 16)
+
+    def __len__(self):
+        return len(self._first_seen)
+
+    def __contains__(self, article_id):
+        return self.key(article_id) in self._first_seen
+
+    def filter_new(self, articles):
+        """Returns the articles whose IDs are not in the index, without adding them
+        Args:
+            articles: list of dictionaries with an article_id
+        Returns:
+            articles: list of unseen articles, also deduplicated within the list
+        """
+        new_articles, batch_keys = [], set()
+        for article in articles:
+            key = self.key(article['article_id'])
+            if key in self._first_seen or key in batch_keys:
+                continue
+            batch_keys.add(key)
+            new_articles.append(article)
+        return new_articles
+
+    def add(self, articles, day=None):
+        """Adds article IDs to the index
+        Args:
+            articles: list of dictionaries with an article_id
+            day: day number the articles were seen, defaults to today
+        """
+        day = day or datetime.date.today().toordinal()
+        for article in articles:
+            self._first_seen.setdefault(self.key(article['article_id']), day)
+
+    def load(self, open_file, path):
+        """Loads the index from a file, leaving it empty if the file does not exist
+        Args:
+            open_file: function that opens a path e.g. `open` or `gcsfs_client.open`
+            path: path of the index file
+        """
+        try:
+            with open_file(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            logger.info('no dedup index found at %s', path)
+            return self
+
+        magic, count = HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ValueError('{} is not a dedup index'.format(path))
+        keys, days = array('Q'), array('I')
+        keys.frombytes(data[HEADER.size:HEADER.size + count * 8])
+        days.frombytes(data[HEADER.size + count * 8:HEADER.size + count * 12])
+        self._first_seen = dict(zip(keys, days))
+        logger.info('loaded dedup index %s with %s articles', path, count)
+        return self
+
+    def save(self, open_file, path):
+        """Evicts expired keys and writes the index to a file
+        Args:
+            open_file: function that opens a path e.g. `open` or `gcsfs_client.open`
+            path: path of the index file
+        """
+        oldest_day = datetime.date.today().toordinal() - self.retention_days
+        self._first_seen = {key: day for key, day in self._first_seen.items() if day >= oldest_day}
+        keys, days = array('Q', self._first_seen.keys()), array('I', self._first_seen.values())
+        with open_file(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, len(keys)))
+            f.write(keys.tobytes())
+            f.write(days.tobytes())
+        logger.info('saved dedup index %s with %s articles', path, len(keys))
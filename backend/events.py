@@ -0,0 +1,39 @@
+import gzip
+import json
+import datetime
+
+# must match SORT_CODES in app/events.py
+SORT_NAMES = {'l': 'latest', 'p': 'popular', 'r': 'random', 'z': 'personalized'}
+
+def decode_message(data, attributes=None):
+    """Decodes a tracking message published by the app into a row for the tracking tables.
+    Compact events are expanded to the legacy row layout without the article titles and
+    publish times, which can be joined from `news.articles` by article_id
+    Args:
+        data: message bytes
+        attributes: Pub/Sub message attributes
+    Returns:
+        row: dictionary for an impression or click row
+    """
+    attributes = attributes or {}
+    if attributes.get('encoding') == 'gzip':
+        data = gzip.decompress(data)
+
+    message = json.loads(data.decode('utf-8'))
+    if attributes.get('format') != 'compact':
+        # legacy trackers are JSON strings encoded a second time
+        return json.loads(message) if isinstance(message, str) else message
+
+    timestamp = datetime.datetime.utcfromtimestamp(message['ts']).strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(message['a'], dict):
+        articles = []
+        for sort_code, article_ids in message['a'].items():
+            for article_id in article_ids:
+                articles.append({'article_id': article_id, 'sort': SORT_NAMES.get(sort_code, sort_code)})
+        return {'user_id': message['u'], 'impression_timestamp': timestamp, 'articles': articles}
+
+    return {
+        'user_id': message['u'],
+        'click_timestamp': timestamp,
+        'article_clicked': {'article_id': message['a'], 'sort': SORT_NAMES.get(message['s'], message['s'])}
+    }
@@ -1,43 +1,51 @@
-import os
-import logging
+import time
+import uuid
 import json
+import logging
 import datetime
-from google.cloud import bigquery
+from concurrent.futures import ThreadPoolExecutor
+from writer import write_ndjson, ndjson_extension
+from orchestration import retry_with_backoff
+from metrics import span
 
 logger = logging.getLogger('app.loader')
 
 class Loader:
-    def __init__(self, bq_client, gcs_client, gcsfs_client):
-        """Instantiates the BigQuery Loader class for loading data from storage buckets to BigQuery tables
+    def __init__(self, storage, gcs_client, gcsfs_client, compress=False):
+        """Instantiates the Loader class for loading data from storage buckets to BigQuery or SQLite tables
         
         Args:
-            bq_client: BigQuery client
+            storage: BigQueryStorage or SQLiteStorage the files are loaded to
             gcs_client: Google Cloud Storage client
             gcsfs_client: GCS File System client
+            compress: gzip the NDJSON files written to buckets
         """
-        self.bq_client = bq_client
+        self.storage = storage
         self.gcs_client = gcs_client
         self.gcsfs_client = gcsfs_client
+        self.compress = compress
 
     def load_file_to_bucket(self, articles, bucket_path):
         """Takes newline dilimited JSON and loads to GCS bucket
+
+        Args:
+            articles: iterable of article dictionaries, e.g. a generator
+            bucket_path: GCS bucket path
         """
         filename_time = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
-        filename = 'news-{}'.format(filename_time)
+        filename = 'news-{}{}'.format(filename_time, ndjson_extension(self.compress))
 
-        output_file = self.gcsfs_client.open('{}/{}.ndjson'.format(bucket_path, filename), 'w')
-        
-        for item in articles:
-            output_file.write(json.dumps(item))
-            output_file.write('\n')
+        with span('loader.write_file'):
+            row_count, bytes_written = write_ndjson(
+                self.gcsfs_client, '{}/{}'.format(bucket_path, filename), articles, compress=self.compress
+            )
 
-        print('wrote file {}.ndjson to bucket'.format(filename))
-        logger.info('wrote file {}.ndjson to bucket'.format(filename))
+        logger.info('wrote file %s with %s articles and %s bytes to bucket', filename, row_count, bytes_written)
 
         return 'Retrieved news data', 200
 
     def load_from_bucket(self, source_bucket_name, destination_bucket_name, dataset_id, table_id):
-        """Loads data from Google Cloud Storage to BigQuery. Expected file format is NDJSON
+        """Loads data from Google Cloud Storage to BigQuery one file at a time. Expected file format is NDJSON
 
         Args:
             source_bucket_name: source bucket name
@@ -45,45 +53,132 @@ class Loader:
             dataset_id: BigQuery dataset ID
             table_id: BigQuery table ID
         """
-        # configure BQ details
-        job_config = bigquery.LoadJobConfig()
-        job_config.source_format = bigquery.SourceFormat.NEWLINE_DELIMITED_JSON
-        dataset_ref = self.bq_client.dataset(dataset_id)
-
         # configure GCS details
-        print('source bucket: {}'.format(source_bucket_name))
-        logger.info('source bucket: {}'.format(source_bucket_name))
+        logger.info('source bucket: %s', source_bucket_name)
         source_bucket = self.gcs_client.get_bucket(source_bucket_name)
 
-        print('destination bucket: {}'.format(destination_bucket_name))
-        logger.info('destination bucket: {}'.format(destination_bucket_name))
+        logger.info('destination bucket: %s', destination_bucket_name)
         destination_bucket = self.gcs_client.get_bucket(destination_bucket_name)
 
         # list files in source bucket
         for blob in source_bucket.list_blobs():
             filename = blob.name
-            print('found file: {}'.format(filename))
-            logger.info('found file: {}'.format(filename))
+            logger.info('found file: %s', filename)
             file_uri = 'gs://{}/{}'.format(source_bucket_name, filename)
 
-            # load file to BQ
-            load_job = self.bq_client.load_table_from_uri(file_uri, dataset_ref.table(table_id), job_config=job_config)
-            print('starting job {}'.format(load_job.job_id))
-            logger.info('starting job {}'.format(load_job.job_id))
-            load_job.result()
-            destination_table = self.bq_client.get_table(dataset_ref.table(table_id))
-            print('table {} has {} rows'.format(destination_table.table_id, destination_table.num_rows))
-            logger.info('table {} has {} rows'.format(destination_table.table_id, destination_table.num_rows))
+            # load file to the table
+            rows = self.storage.load_files([file_uri], 'ndjson', dataset_id, table_id)
+            logger.info('loaded %s rows to table %s', rows, table_id)
 
             # transfer file to processed bucket
             source_blob = source_bucket.blob(filename)
             destination_blob = source_bucket.copy_blob(source_blob, destination_bucket, filename)
-            print('transfered file to processed bucket: {}'.format(filename))
-            logger.info('transfered file to processed bucket: {}'.format(filename))
+            logger.info('transfered file to processed bucket: %s', filename)
 
             # delete file from staging bucket
             source_blob.delete()
-            print('deleted file from staging bucket: {}'.format(filename))
-            logger.info('deleted file from staging bucket: {}'.format(filename))
+            logger.info('deleted file from staging bucket: %s', filename)
+
+        return 'Completed loading files to BigQuery', 200
+
+    def bulk_load_from_bucket(self, source_bucket_name, destination_bucket_name, dataset_id, table_id, max_workers=16,
+                              move_deadline=60):
+        """Loads every file in the source bucket to the table with a single load per format, and moves
+        each load's files to the destination bucket with parallel copy and delete calls as soon as it
+        succeeds. Files ending in `.parquet` are loaded as Parquet, all other files as NDJSON.
+
+        Before a load starts, a manifest with its job ID and files is written to `_loads/<table_id>/`
+        in the destination bucket, and it is deleted once every file is moved. A retry or a later run
+        first finishes the loads of the remaining manifests: the storage returns the rows of a load
+        that already succeeded without loading its files again, and the files are then moved
+
+        Args:
+            source_bucket_name: source bucket name
+            destination_bucket_name: destination bucket name
+            dataset_id: BigQuery dataset ID
+            table_id: BigQuery table ID
+            max_workers: number of threads used to move files
+            move_deadline: seconds during which a failed move of a loaded file is retried
+        Returns:
+            (message, status, stats): stats has the files, bytes, rows and seconds of the run
+        """
+        start_time = time.monotonic()
+
+        source_bucket = self.gcs_client.bucket(source_bucket_name)
+        destination_bucket = self.gcs_client.bucket(destination_bucket_name)
+        manifest_prefix = '_loads/{}/'.format(table_id)
+
+        # snapshot the pending files so files written during the load are left for the next run
+        with span('loader.list_files'):
+            manifest_blobs = list(self.gcs_client.list_blobs(destination_bucket_name, prefix=manifest_prefix))
+            blobs = list(self.gcs_client.list_blobs(source_bucket_name))
+        stats = {'files': len(blobs), 'bytes': sum(blob.size or 0 for blob in blobs), 'rows': 0, 'seconds': 0.0}
+        if not blobs and not manifest_blobs:
+            logger.info('no files found in bucket %s', source_bucket_name)
+            return 'No files to load', 200, stats
+
+        # loads of a previous attempt come first and keep their job IDs, their files are not part of a new load
+        blobs_by_name = {blob.name: blob for blob in blobs}
+        loads = []
+        for manifest_blob in manifest_blobs:
+            manifest = json.loads(manifest_blob.download_as_string())
+            pending_blobs = [blobs_by_name.pop(name) for name in manifest['files'] if name in blobs_by_name]
+            logger.info('resuming load %s with %s files left to move', manifest['job_id'], len(pending_blobs))
+            loads.append((manifest_blob, manifest, pending_blobs, True))
+
+        # one new load per source format
+        blobs_by_format = {}
+        for blob in blobs_by_name.values():
+            file_format = 'parquet' if blob.name.endswith('.parquet') else 'ndjson'
+            blobs_by_format.setdefault(file_format, []).append(blob)
+        for file_format, format_blobs in blobs_by_format.items():
+            job_id = 'load_{}_{}_{}'.format(table_id, file_format, uuid.uuid4().hex)
+            manifest = {'job_id': job_id, 'format': file_format, 'files': [blob.name for blob in format_blobs]}
+            loads.append((destination_bucket.blob('{}{}.json'.format(manifest_prefix, job_id)), manifest, format_blobs, False))
+
+        unmoved = 0
+        for manifest_blob, manifest, load_blobs, resumed in loads:
+            # the manifest is written before the load so a load is never started without a record of its files
+            if not resumed:
+                manifest_blob.upload_from_string(json.dumps(manifest), content_type='application/json')
+            file_uris = ['gs://{}/{}'.format(source_bucket_name, name) for name in manifest['files']]
+            with span('loader.load_job'):
+                stats['rows'] += self.storage.load_files(
+                    file_uris, manifest['format'], dataset_id, table_id, job_id=manifest['job_id']
+                )
+
+            with span('loader.move_files'):
+                moved = self.move_files(load_blobs, source_bucket, destination_bucket, max_workers, move_deadline)
+            if moved < len(load_blobs):
+                unmoved += len(load_blobs) - moved
+            else:
+                manifest_blob.delete()
+
+        if unmoved:
+            logger.error(
+                'could not move %s loaded files from bucket %s, the next run moves them without loading them again',
+                unmoved, source_bucket_name
+            )
+
+        stats['seconds'] = round(time.monotonic() - start_time, 3)
+        logger.info('loaded %(files)s files, %(bytes)s bytes, %(rows)s rows in %(seconds)s seconds', stats)
+
+        return 'Completed loading files to {}'.format(table_id), 200, stats
+
+    def move_files(self, blobs, source_bucket, destination_bucket, max_workers=16, move_deadline=60):
+        """Moves loaded files to the destination bucket with parallel copy and delete calls, retrying
+        failed moves rather than repeating the load
+        Returns:
+            number of files moved
+        """
+        def move_blob(blob):
+            def move():
+                source_bucket.copy_blob(blob, destination_bucket, blob.name)
+                blob.delete()
+                return blob.name, 200
+            return retry_with_backoff(move, deadline=time.monotonic() + move_deadline)[1] == 200
 
-        return 'Completed loading files to BigQuery', 200
\ No newline at end of file
+        if not blobs:
+            return 0
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return sum(executor.map(move_blob, blobs))
@@ -2,34 +2,100 @@ import os
 import json
 import time
 import datetime
-import gcsfs
 import logging
-import papermill
-from flask import Flask, request
-from news import News
+import itertools
+import threading
+
+# the time the service started importing, used for the startup report
+IMPORT_STARTED = time.monotonic()
+
+from flask import Flask, request, jsonify
 from subscriber import Subscriber
 from loader import Loader
-from google.cloud import pubsub, bigquery, storage
-import google.auth
+from dedup import SeenIndex
+from orchestration import RollingStage, retry_with_backoff, run_pipelines, succeeded
+from recommender import TopicWorker
+from clients import clients
+from logs import async_logging
+from metrics import instrument, span
 
 app = Flask(__name__)
 
-logging.basicConfig(level=logging.INFO)
+async_logging.setup()
+# request and stage timings are exposed on /metrics
+instrument(app)
 
 GCP_PROJECT_ID = os.getenv('GCP_PROJECT_ID')
 ENV = os.getenv('ENV')
-credentials, gcp_project_id = google.auth.default()
-bigquery_client = bigquery.Client(project=gcp_project_id, credentials=credentials)
-gcs_client = storage.Client(project=gcp_project_id, credentials=credentials)
-subscriber_client = pubsub.SubscriberClient(credentials=credentials)
-gcsfs_client = gcsfs.GCSFileSystem(project=GCP_PROJECT_ID)
-loader = Loader(bigquery_client, gcs_client, gcsfs_client)
-subscriber = Subscriber(subscriber_client, gcsfs_client)
+# GCP clients are created on first use by the routes that need them, see clients.py
+# files written to buckets are gzip compressed NDJSON unless disabled
+COMPRESS_FILES = os.getenv('COMPRESS_FILES', 'true').lower() == 'true'
+# tracking files are written as 'ndjson' or 'parquet'
+TRACKING_FILE_FORMAT = os.getenv('TRACKING_FILE_FORMAT', 'ndjson')
+
+# tracking subscriptions are drained in large pulls until empty or out of time
+TRACKING_PULL_BATCH = int(os.getenv('TRACKING_PULL_BATCH', 1000))
+TRACKING_TIME_BUDGET = int(os.getenv('TRACKING_TIME_BUDGET', 240))
+TRACKING_FILE_MAX_BYTES = int(os.getenv('TRACKING_FILE_MAX_BYTES', 64 * 1024 * 1024))
+TRACKING_FILE_MAX_SECONDS = int(os.getenv('TRACKING_FILE_MAX_SECONDS', 60))
+
+# news domains are split into shards that are paged through concurrently
+NEWS_MAX_WORKERS = int(os.getenv('NEWS_MAX_WORKERS', 4))
+NEWS_DOMAINS_PER_QUERY = int(os.getenv('NEWS_DOMAINS_PER_QUERY', 10))
+NEWS_MAX_PAGES = int(os.getenv('NEWS_MAX_PAGES', 5))
+# base URL of the news API, e.g. a local stub server for benchmarks
+NEWS_API_URL = os.getenv('NEWS_API_URL', 'https://newsapi.org')
+
+# index of article IDs already loaded, e.g. gs://bucket/dedup/articles.idx
+# kept in the processed bucket by default, files in the articles bucket are all loaded to the articles table
+DEDUP_INDEX_PATH = os.getenv(
+    'DEDUP_INDEX_PATH',
+    'gs://{}/dedup/articles.idx'.format(os.getenv('ARTICLES_PROCESSED_BUCKET')) if os.getenv('ARTICLES_PROCESSED_BUCKET') else None
+)
+DEDUP_RETENTION_DAYS = int(os.getenv('DEDUP_RETENTION_DAYS', 30))
+
+# seconds during which failed BigQuery loads are retried with exponential backoff
+LOAD_DEADLINE = int(os.getenv('LOAD_DEADLINE', 120))
+
+# seconds from the start of the import to the first response of each route
+first_responses = {}
+first_responses_lock = threading.Lock()
+
+def loader():
+    return Loader(clients.storage(), clients.gcs_client(), clients.gcsfs_client(), compress=COMPRESS_FILES)
+
+def subscriber():
+    return Subscriber(clients.subscriber_client(), clients.gcsfs_client(), compress=COMPRESS_FILES, file_format=TRACKING_FILE_FORMAT)
+
+@app.after_request
+def record_first_response(response):
+    route = request.url_rule.rule if request.url_rule is not None else None
+    if route is not None and route not in first_responses:
+        with first_responses_lock:
+            if route not in first_responses:
+                first_responses[route] = round(time.monotonic() - IMPORT_STARTED, 3)
+                logging.getLogger('app.startup').info('startup report: %s', startup_report(), extra={'category': 'startup'})
+    return response
+
+def startup_report():
+    """Returns the import time, the time spent creating each client and the time to the first response of each route
+    """
+    return {
+        'import_seconds': IMPORT_SECONDS,
+        'client_seconds': dict(clients.timings),
+        'first_response_seconds': dict(first_responses)
+    }
 
 @app.route('/', methods=['GET'])
 def index():
     return ('Backend server running', 200)
 
+@app.route('/startup', methods=['GET'])
+def startup():
+    """This route reports where the time of this instance's cold start went
+    """
+    return jsonify(startup_report()), 200
+
 
 @app.route('/get_and_load_news', methods=['POST'])
 def get_and_load_news():
@@ -37,20 +103,31 @@ def get_and_load_news():
     """
 
     logger = logging.getLogger('app.get_and_load_news')
-    print('requesting news')
     logger.info('requesting news')
 
+    # create the clients this route needs concurrently, the news client is only imported here
+    clients.warm_up('storage', 'gcs', 'gcsfs')
+    from news import News
+    gcsfs_client = clients.gcsfs_client()
+    news_loader = loader()
+
     # Get news data from newsapi
     if ENV=='prod':
         secrets_bucket_name = os.getenv('SECRETS_BUCKET')
-        secrets_bucket = gcs_client.get_bucket(secrets_bucket_name)
+        secrets_bucket = clients.gcs_client().get_bucket(secrets_bucket_name)
         secret_blob = secrets_bucket.get_blob('news-api-key.json').download_as_string()
         secret_json = json.loads(secret_blob.decode('utf-8'))
         api_key = secret_json['key']
     else:
         api_key = os.getenv('NEWS_API_KEY')
     
-    news_client = News(api_key)
+    news_client = News(
+        api_key,
+        base_url=NEWS_API_URL,
+        max_workers=NEWS_MAX_WORKERS,
+        domains_per_query=NEWS_DOMAINS_PER_QUERY,
+        max_pages=NEWS_MAX_PAGES
+    )
     date_filter = (datetime.date.today() - datetime.timedelta(1)).strftime('%Y-%m-%d')
     news_domains = """
         abcnews.go.com, apnews.com, aljazeera.com, axios.com, bbc.co.uk, bloomberg.com, 
@@ -62,30 +139,39 @@ def get_and_load_news():
         huffingtonpost.com, thenextweb.com, theverge.com, wsj.com, washingtonpost.com, 
         time.com, usatoday.com, news.vice.com, wired.com
     """
-    news_response = news_client.get_news(date_filter, news_domains)
-    formatted_news = news_client.format_articles(news_response)
+    with span('news.fetch'):
+        formatted_news = news_client.format_articles(news_client.iter_news(date_filter, news_domains))
+
+    # skip articles that were loaded by a previous run
+    seen_index = SeenIndex(DEDUP_RETENTION_DAYS)
+    with span('news.dedup'):
+        if DEDUP_INDEX_PATH:
+            seen_index.load(gcsfs_client.open, DEDUP_INDEX_PATH)
+        new_news = seen_index.filter_new(formatted_news)
+    logger.info('found %s new articles out of %s', len(new_news), len(formatted_news))
+    if not new_news:
+        return 'No new articles to load', 200
 
     # Load to GCS
     bucket_path = os.getenv('ARTICLES_BUCKET')
-    loader.load_file_to_bucket(articles=formatted_news, bucket_path=bucket_path)
-
-    # load to BQ
-    retries = 3
-    count = 1
-    articles_load_job_status = None
-    while (articles_load_job_status != 200 or count < retries):
-        time.sleep(10)
-        print('loading news (attempt: {}'.format(count))
-        logger.info('loading news (attempt: {}'.format(count))
-        dataset_id, articles_table_id = 'news', 'articles'
-        articles_bucket = os.getenv('ARTICLES_BUCKET')
-        articles_processed_bucket = os.getenv('ARTICLES_PROCESSED_BUCKET')
-        articles_load_job_status = loader.load_from_bucket(articles_bucket, articles_processed_bucket, dataset_id, articles_table_id)
-        print('loading news status {}'.format(articles_load_job_status[1]))
-        logger.info('loading news status {}'.format(articles_load_job_status[1]))
-        if articles_load_job_status[1] == 200:
-            return 'Retrieved news and loaded data to BigQuery', 200
-        count += 1
+    news_loader.load_file_to_bucket(articles=new_news, bucket_path=bucket_path)
+
+    # load to BQ, retrying with backoff until the load job completes or the deadline passes
+    logger.info('loading news')
+    dataset_id, articles_table_id = 'news', 'articles'
+    articles_bucket = os.getenv('ARTICLES_BUCKET')
+    articles_processed_bucket = os.getenv('ARTICLES_PROCESSED_BUCKET')
+    articles_load_job_status = retry_with_backoff(
+        lambda: news_loader.bulk_load_from_bucket(articles_bucket, articles_processed_bucket, dataset_id, articles_table_id),
+        deadline=time.monotonic() + LOAD_DEADLINE
+    )
+    logger.info('loading news status %s', articles_load_job_status[1])
+    if articles_load_job_status[1] == 200:
+        # only remember articles once they are loaded so a failed run retries them
+        if DEDUP_INDEX_PATH:
+            seen_index.add(new_news)
+            seen_index.save(gcsfs_client.open, DEDUP_INDEX_PATH)
+        return 'Retrieved news and loaded data to BigQuery', 200
     return 'Unable to retrieve and load news', 204
 
 
@@ -94,68 +180,130 @@ def get_and_load_tracking():
     """This route will retrieve messages from the Pubsub topic and load to BigQuery
     """
     logger = logging.getLogger('app.get_and_load_tracking')
-    print('retrieving tracking messages')
     logger.info('retrieving tracking messages')
 
-    # subscribe to impressions topic to retrieve messages and write to bucket
-    impressions_bucket = os.getenv('IMPRESSIONS_BUCKET')
-    subscription_path = subscriber_client.subscription_path(gcp_project_id, 'news_impressions')
-    impressions_filename = 'impression-{}'.format(datetime.datetime.now().strftime('%Y%m%d-%H%M%S'))
-    impressions_messages = subscriber.get_messages(subscription_path, impressions_bucket, impressions_filename)
-    print('impressions tracking status: {}'.format(impressions_messages))
-    logger.info('impressions tracking status: {}'.format(impressions_messages))
-
-    # subscribe to clicks topic to retrieve messages and write to bucket
-    clicks_bucket = os.getenv('CLICKS_BUCKET')
-    subscription_path = subscriber_client.subscription_path(gcp_project_id, 'news_clicks')
-    clicks_filename = 'clicks-{}'.format(datetime.datetime.now().strftime('%Y%m%d-%H%M%S'))
-    clicks_messages = subscriber.get_messages(subscription_path, clicks_bucket, clicks_filename)
-    print('click tracking status: {}'.format(clicks_messages))
-    logger.info('click tracking status: {}'.format(clicks_messages))
+    # create the clients this route needs concurrently
+    clients.warm_up('subscriber', 'storage', 'gcs', 'gcsfs')
+    subscriber_client = clients.subscriber_client()
+    tracking_subscriber = subscriber()
+    tracking_loader = loader()
 
     dataset_id = 'tracking'
-    impressions_table_id, clicks_table_id = 'impressions', 'clicks'
-    impressions_bucket = os.getenv('IMPRESSIONS_BUCKET')
-    impressions_processed_bucket = os.getenv('IMPRESSIONS_PROCESSED_BUCKET')
-    clicks_bucket = os.getenv('CLICKS_BUCKET')
-    clicks_processed_bucket = os.getenv('CLICKS_PROCESSED_BUCKET')
-    
-    retries, count = 3, 1
-    clicks_status = None
-    while (clicks_status != 200 or count < retries):
-        time.sleep(10)
-        print('loading impression tracking (attempt: {}'.format(count))
-        logger.info('loading impression tracking (attempt: {}'.format(count))
-        impressions_load_job = loader.load_from_bucket(impressions_bucket, impressions_processed_bucket, dataset_id, impressions_table_id)
-        clicks_load_job = loader.load_from_bucket(clicks_bucket, clicks_processed_bucket, dataset_id, clicks_table_id)
-        clicks_status = clicks_load_job[1]
-        print('loading tracking status {}'.format(clicks_status))
-        logger.info('loading tracking status {}'.format(clicks_status))
-        if clicks_status == 200:
-            return 'Retrieved tracking and loaded data to BigQuery', 200
-        count += 1
+    run_time = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+    # retried drains share the time budget of the first attempt
+    drain_deadline = time.monotonic() + TRACKING_TIME_BUDGET
+
+    rolling_loads = []
+
+    def tracking_pipeline(subscription_name, file_prefix, bucket, processed_bucket, table_id):
+        # drain the subscription to files in the bucket, loading the files rolled out so far while the drain continues
+        subscription_path = subscriber_client.subscription_path(clients.project_id(), subscription_name)
+        attempts = itertools.count(1)
+        # loads of a bucket run one at a time, each loads every file written before it started
+        loads = RollingStage(
+            lambda: tracking_loader.bulk_load_from_bucket(bucket, processed_bucket, dataset_id, table_id),
+            deadline=drain_deadline + LOAD_DEADLINE
+        )
+        rolling_loads.append(loads)
+
+        def drain():
+            # every attempt writes files with new names, so a retry never overwrites a file whose messages were acknowledged
+            filename = '{}-{}-{}'.format(file_prefix, run_time, next(attempts))
+            return tracking_subscriber.drain_messages(
+                subscription_path, bucket, filename,
+                batch_size=TRACKING_PULL_BATCH,
+                time_budget=max(0, drain_deadline - time.monotonic()),
+                max_file_bytes=TRACKING_FILE_MAX_BYTES,
+                max_file_seconds=TRACKING_FILE_MAX_SECONDS,
+                on_file=loads.trigger,
+                table_id=table_id
+            )
+
+        # the last load picks up the files of the end of the drain and any earlier load that failed
+        return [drain, loads.finish]
+
+    # impressions and clicks run concurrently so the route takes as long as the slowest pipeline
+    try:
+        results = run_pipelines(
+            {
+                'impressions': tracking_pipeline(
+                    'news_impressions', 'impression',
+                    os.getenv('IMPRESSIONS_BUCKET'), os.getenv('IMPRESSIONS_PROCESSED_BUCKET'), 'impressions'
+                ),
+                'clicks': tracking_pipeline(
+                    'news_clicks', 'clicks',
+                    os.getenv('CLICKS_BUCKET'), os.getenv('CLICKS_PROCESSED_BUCKET'), 'clicks'
+                )
+            },
+            deadline_seconds=TRACKING_TIME_BUDGET + LOAD_DEADLINE
+        )
+    finally:
+        for loads in rolling_loads:
+            loads.close()
+    for name, stage_results in results.items():
+        logger.info('%s tracking status: %s', name, [result[:2] for result in stage_results])
+
+    if succeeded(results):
+        return 'Retrieved tracking and loaded data to BigQuery', 200
     return 'Unable to retrieve and load tracking', 204
 
 
+# the topic model runs in a long lived worker that keeps the encoder loaded between runs,
+# it is created by the first recommendations request
+notebook_bucket = os.getenv('NOTEBOOK_BUCKET')
+topic_worker = None
+topic_worker_lock = threading.Lock()
+
+def get_topic_worker():
+    global topic_worker
+    with topic_worker_lock:
+        if topic_worker is None:
+            clients.warm_up('storage', 'gcsfs')
+            project_id = clients.project_id()
+            topic_worker = TopicWorker(
+                clients.storage(),
+                store_directory=os.getenv('EMBEDDING_STORE_DIR', '/tmp/embeddings'),
+                articles_table=os.getenv('TOPIC_ARTICLES_TABLE', '{}.news.articles'.format(project_id)),
+                topics_table=os.getenv('TOPICS_TABLE', '{}.topics.article_topics'.format(project_id)),
+                audit_fs=clients.gcsfs_client(),
+                audit_path='gs://{}/out'.format(notebook_bucket) if os.getenv('RECOMMENDATIONS_AUDIT') == 'true' else None,
+                snapshot_path=os.getenv('EMBEDDINGS_SNAPSHOT_PATH')
+            )
+        return topic_worker
+
+
 @app.route('/get_recommendations', methods=['POST'])
 def get_recommendations():
-    """This route will run the topic model used to populate the recommended articles for all users
+    """This route will run the topic model used to populate the recommended articles for all users.
+    Pass `?wait=false` to return as soon as the job is queued
     """
     logger = logging.getLogger('app.get_recommendations')
-    print('Updating topic model and recommendations')
     logger.info('Updating topic model and recommendations')
 
-    notebook_bucket = os.getenv('NOTEBOOK_BUCKET')
-    run_time = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+    worker = get_topic_worker()
+    job_id = worker.submit()
+    if request.args.get('wait', 'true') == 'false':
+        return jsonify(worker.status(job_id)), 202
 
-    papermill.execute_notebook(
-        'gs://{}/prod/topic-prod.ipynb'.format(notebook_bucket),
-        'gs://{}/out/topic-out-{}.ipynb'.format(notebook_bucket, run_time),
-        kernel_name = 'python3'
-    )
+    job = worker.wait(job_id)
+    logger.info('topic model job %s with timings %s', job['status'], job['timings'])
+    if job['status'] == 'done':
+        return 'Ran topic model and updated recommendations', 200
+    return 'Unable to run topic model: {}'.format(job['error']), 500
+
+
+@app.route('/get_recommendations/<job_id>', methods=['GET'])
+def get_recommendations_status(job_id):
+    """This route returns the status and stage timings of a topic model job
+    """
+    job = get_topic_worker().status(job_id)
+    if job is None:
+        return 'Unknown job', 404
+    return jsonify(job), 200
+
+
+IMPORT_SECONDS = round(time.monotonic() - IMPORT_STARTED, 3)
 
-    return 'Ran topic model and updated recommendations', 200
-    
 
 if __name__ == '__main__':
     PORT = int(os.getenv('PORT')) if os.getenv('PORT') else 8081
@@ -1,72 +1,141 @@
 import logging
 import requests
 import datetime
-import uuid
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from dedup import article_id
 
 logger = logging.getLogger('app.news')
 
 class News:
-    def __init__(self, api_key):
-        """Instantiates the Articles class for retrieving articles from BigQuery
+    def __init__(self, api_key, base_url='https://newsapi.org', max_workers=4, domains_per_query=10,
+                 max_pages=5, page_size=100, timeout=10):
+        """Instantiates the News class for retrieving articles from newsapi.org
         Args:
-            gcs_client: pass existing GCS client as an argument
-            api_key: key for newsapi.org 
+            api_key: key for newsapi.org
+            base_url: newsapi.org base URL, can point to a local stub server for tests
+            max_workers: maximum number of concurrent requests
+            domains_per_query: number of domains in each sharded query
+            max_pages: maximum number of pages requested per query
+            page_size: articles per page, newsapi.org allows up to 100
+            timeout: seconds before a request times out
         """
         self.api_key = api_key
+        self.base_url = base_url
+        self.max_workers = max_workers
+        self.domains_per_query = domains_per_query
+        self.max_pages = max_pages
+        self.page_size = page_size
+        self.timeout = timeout
 
-    def get_news(self, date_filter, news_domains):
-        """Retrieves news data from newsapi.org and returns the response JSON
+        # a single pooled session reuses connections across pages and shards
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get_page(self, date_filter, news_domains, page):
+        """Retrieves one page of news data from newsapi.org
         Args:
             date_filter: date range for newsapi filtering
-            news_domains: domains to include in results
+            news_domains: comma separated domains to include in results
+            page: page number starting at 1
         Return:
-            response.json() from request
+            parsed response JSON
         """
-
-        url_base = 'https://newsapi.org'
         url_path = '/v2/everything'
         url_params = {
             'from': date_filter,
             'language': 'en',
-            'apiKey': self.api_key,
-            'pageSize': 100,
+            'pageSize': self.page_size,
+            'page': page,
             'sortBy': 'publishedAt',
             'domains': news_domains
             }
-        print('requesting news for endpoint: {}, params: {}'.format(url_path, url_params))
-        logger.info('requesting news for endpoint: {}, params: {}'.format(url_path, url_params))
+        logger.info('requesting news for endpoint: %s, params: %s', url_path, url_params)
 
         url_params['apiKey'] = self.api_key
-        request_url = str(url_base + url_path)
-        response = requests.get(request_url, params=url_params)
+        response = self.session.get(self.base_url + url_path, params=url_params, timeout=self.timeout)
+        # an error page is not JSON, raise it as a request error so only its shard is skipped
+        response.raise_for_status()
+        response_json = response.json()
+
+        logger.info('status: %s', str(response_json['status']))
 
-        print('status: {}'.format(str(response.json()['status'])))
-        logger.info('status: {}'.format(str(response.json()['status'])))
+        return response_json
 
-        return response.json()
+    def get_shard(self, date_filter, news_domains):
+        """Pages through the results for one shard of domains
+        Args:
+            date_filter: date range for newsapi filtering
+            news_domains: comma separated domains to include in results
+        Return:
+            articles: list of article dictionaries from the response JSON
+        """
+        articles = []
+        for page in range(1, self.max_pages + 1):
+            response_json = self.get_page(date_filter, news_domains, page)
+            if response_json['status'] != 'ok':
+                break
+            articles.extend(response_json['articles'])
+            if len(articles) >= response_json.get('totalResults', 0) or len(response_json['articles']) < self.page_size:
+                break
+        return articles
+
+    def iter_news(self, date_filter, news_domains):
+        """Retrieves news for the domains split into shards that are queried concurrently,
+        and yields articles as each shard completes
+        Args:
+            date_filter: date range for newsapi filtering
+            news_domains: comma separated domains to include in results
+        Yields:
+            article dictionaries from the response JSON
+        """
+        domains = [domain.strip() for domain in news_domains.split(',') if domain.strip()]
+        shards = [
+            ', '.join(domains[index:index + self.domains_per_query])
+            for index in range(0, len(domains), self.domains_per_query)
+        ]
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self.get_shard, date_filter, shard) for shard in shards]
+            for future in futures:
+                try:
+                    for article in future.result():
+                        yield article
+                except requests.RequestException as e:
+                    logger.warning('failed to retrieve news shard: %s', e)
+
+    def get_news(self, date_filter, news_domains):
+        """Retrieves news data from newsapi.org and returns the response JSON
+        Args:
+            date_filter: date range for newsapi filtering
+            news_domains: domains to include in results
+        Return:
+            response JSON with the articles from every shard and page
+        """
+        articles = list(self.iter_news(date_filter, news_domains))
+        return {'status': 'ok', 'totalResults': len(articles), 'articles': articles}
 
     def format_articles(self, response):
         """Takes response JSON and formats to newline delimited JSON
         Args:
-            response: JSON response from newsapi
+            response: JSON response from newsapi, or an iterable of articles e.g. from `iter_news`
         Return:
             articles: list of dictionaries with data for each article
         """
 
         articles = []
         current_time = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        response_articles = response['articles'] if isinstance(response, dict) else response
         # populate article list with details for each article
-        for index, article in enumerate(response['articles']):
+        for index, article in enumerate(response_articles):
             details = {}
-            details['article_id'] = str(uuid.uuid4())
+            details['article_id'] = article_id(article)
             details['article_order'] = index
             details['load_timestamp'] = current_time
             for column in ['title', 'author', 'description', 'content', 'url', 'urlToImage', 'publishedAt']:
                 details[column] = article[column]
             articles.append(details)
 
-        print('articles: {}'.format(articles))
-
         return articles
-
-    
\ No newline at end of file
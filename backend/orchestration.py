@@ -0,0 +1,107 @@
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('app.orchestration')
+
+def retry_with_backoff(stage, deadline, initial_delay=1, max_delay=30, multiplier=2):
+    """Runs a stage until it returns a 200 status, waiting with exponential backoff between
+    attempts. Exceptions count as failed attempts
+
+    Args:
+        stage: function without arguments returning a tuple whose second item is a status code
+        deadline: time.monotonic() value after which no new attempt is started
+        initial_delay: seconds to wait after the first failed attempt
+        max_delay: maximum seconds to wait between attempts
+        multiplier: factor applied to the delay after each failed attempt
+    Returns:
+        result of the last attempt, or ('<error>', 500) if the last attempt raised
+    """
+    delay = initial_delay
+    attempt = 1
+    while True:
+        try:
+            result = stage()
+            if result[1] == 200:
+                return result
+            logger.info('attempt %s returned status %s', attempt, result[1])
+        except Exception as e:
+            logger.info('attempt %s failed: %s', attempt, e)
+            result = (str(e), 500)
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return result
+        time.sleep(min(delay, remaining))
+        delay = min(delay * multiplier, max_delay)
+        attempt += 1
+
+class RollingStage:
+    def __init__(self, stage, deadline):
+        """Runs a stage in a background thread each time it is triggered, one run at a time, e.g. to
+        load each file a drain rolls out while the drain continues. Triggers that arrive while a
+        run is waiting to start are coalesced into that run
+
+        Args:
+            stage: function without arguments returning a tuple whose second item is a status code
+            deadline: time.monotonic() value after which failed runs are no longer retried
+        """
+        self.stage = stage
+        self.deadline = deadline
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._queued = None
+
+    def trigger(self, *args):
+        """Queues a run unless one is already waiting to start, arguments are ignored so the
+        method can be passed as a callback
+        """
+        with self._lock:
+            if self._queued is None or self._queued.running() or self._queued.done():
+                self._queued = self._executor.submit(retry_with_backoff, self.stage, self.deadline)
+
+    def finish(self):
+        """Runs the stage once more after the runs already triggered and returns its result
+        """
+        self.trigger()
+        with self._lock:
+            queued = self._queued
+        return queued.result()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+def run_pipelines(pipelines, deadline_seconds, max_workers=None):
+    """Runs several pipelines concurrently. Each pipeline is a list of stages that run in order,
+    and a stage starts as soon as the previous stage of its own pipeline succeeded, so one
+    pipeline's GCS writes overlap with another pipeline's BigQuery loads
+
+    Args:
+        pipelines: dictionary of pipeline name to a list of stage functions, see `retry_with_backoff`
+        deadline_seconds: seconds after which failing stages are no longer retried
+        max_workers: number of threads, defaults to one per pipeline
+    Returns:
+        results: dictionary of pipeline name to the list of stage results
+    """
+    deadline = time.monotonic() + deadline_seconds
+
+    def run_pipeline(name, stages):
+        results = []
+        for index, stage in enumerate(stages):
+            start_time = time.monotonic()
+            result = retry_with_backoff(stage, deadline)
+            logger.info('%s stage %s finished with status %s in %.2f seconds', name, index, result[1], time.monotonic() - start_time)
+            results.append(result)
+            if result[1] != 200:
+                break
+        return results
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(pipelines)) as executor:
+        futures = {name: executor.submit(run_pipeline, name, stages) for name, stages in pipelines.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+def succeeded(results):
+    """Returns True if every stage of every pipeline returned a 200 status
+    """
+    return all(stage_results and stage_results[-1][1] == 200 for stage_results in results.values())
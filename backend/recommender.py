@@ -0,0 +1,142 @@
+import time
+import uuid
+import queue
+import logging
+import datetime
+import threading
+from metrics import registry
+
+logger = logging.getLogger('app.recommender')
+
+class TopicWorker:
+    def __init__(self, storage, store_directory, articles_table, topics_table, window_days=7,
+                 n_clusters=20, audit_fs=None, audit_path=None, snapshot_path=None):
+        """Instantiates a long lived worker that runs the topic model from a job queue. The
+        encoder and embedding store are loaded once and kept warm between jobs
+        Args:
+            storage: BigQueryStorage or SQLiteStorage holding the articles and topics tables
+            store_directory: local directory of the embedding store
+            articles_table: fully qualified articles table
+            topics_table: fully qualified topics table
+            window_days: days of articles to cluster
+            n_clusters: number of topics
+            audit_fs: optional filesystem with an fsspec style `open` for audit notebooks
+            audit_path: optional path prefix for audit notebooks e.g. gs://bucket/out
+            snapshot_path: optional path of the embedding snapshot exported for the app, written with `audit_fs`
+        """
+        self.storage = storage
+        self.store_directory = store_directory
+        self.articles_table = articles_table
+        self.topics_table = topics_table
+        self.window_days = window_days
+        self.n_clusters = n_clusters
+        self.audit_fs = audit_fs
+        self.audit_path = audit_path
+        self.snapshot_path = snapshot_path
+        self.topics = None
+        self.encoder = None
+        self.store = None
+        self._model_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._jobs = {}
+        self._thread = threading.Thread(target=self._run, name='topic-worker', daemon=True)
+        self._thread.start()
+
+    def load_model(self):
+        """Imports TensorFlow and loads the encoder and embedding store once
+        Returns:
+            seconds spent loading, 0 if the model was already loaded
+        """
+        with self._model_lock:
+            if self.encoder is not None:
+                return 0
+            start_time = time.monotonic()
+            # TensorFlow is only imported by the worker so other routes do not pay for it
+            import topics
+            self.topics = topics
+            self.encoder = topics.Encoder()
+            self.store = topics.EmbeddingStore(self.store_directory)
+            seconds = round(time.monotonic() - start_time, 3)
+            logger.info('loaded topic model in %s seconds', seconds)
+            return seconds
+
+    def submit(self):
+        """Queues a topic model run
+        Returns:
+            job_id: ID used to look up the job status
+        """
+        job_id = str(uuid.uuid4())
+        # keep the most recent jobs only
+        for old_job_id in list(self._jobs)[:-100]:
+            if self._jobs[old_job_id]['done'].is_set():
+                del self._jobs[old_job_id]
+        self._jobs[job_id] = {'job_id': job_id, 'status': 'queued', 'timings': {}, 'error': None, 'done': threading.Event()}
+        self._queue.put(job_id)
+        return job_id
+
+    def status(self, job_id):
+        """Returns the status, timings and error of a job, or None for an unknown job
+        """
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        return {key: value for key, value in job.items() if key != 'done'}
+
+    def wait(self, job_id, timeout=None):
+        """Waits until a job finished and returns its status
+        """
+        self._jobs[job_id]['done'].wait(timeout)
+        return self.status(job_id)
+
+    def _run(self):
+        while True:
+            job = self._jobs[self._queue.get()]
+            job['status'] = 'running'
+            start_time = time.monotonic()
+            try:
+                job['timings']['load_model'] = self.load_model()
+                news_df = self.topics.run(
+                    self.storage, self.store, self.encoder,
+                    self.articles_table, self.topics_table,
+                    window_days=self.window_days, n_clusters=self.n_clusters,
+                    timings=job['timings']
+                )
+                job['articles'] = len(news_df)
+                if self.snapshot_path:
+                    self.topics.export_snapshot(self.store, news_df, self.audit_fs, self.snapshot_path)
+                if self.audit_path:
+                    self.write_audit_notebook(job, news_df)
+                job['status'] = 'done'
+            except Exception as e:
+                logger.exception('topic model job %s failed', job['job_id'])
+                job['status'] = 'failed'
+                job['error'] = str(e)
+            finally:
+                job['timings']['total'] = round(time.monotonic() - start_time, 3)
+                for stage, seconds in job['timings'].items():
+                    registry.stage_seconds.observe(seconds, 'topics.{}'.format(stage))
+                logger.info('topic model job %s %s with timings %s', job['job_id'], job['status'], job['timings'])
+                job['done'].set()
+
+    def write_audit_notebook(self, job, news_df):
+        """Writes a notebook recording the run, its stage timings and a sample of each topic
+        """
+        import nbformat
+        from nbformat.v4 import new_notebook, new_markdown_cell
+
+        run_time = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+        cells = [
+            new_markdown_cell('# News Topic Modeling\n\nRun `{}` at {}'.format(job['job_id'], run_time)),
+            new_markdown_cell('## Stage timings\n\n' + '\n'.join(
+                '- {}: {} seconds'.format(stage, seconds) for stage, seconds in job['timings'].items()
+            ))
+        ]
+        for cluster, cluster_df in news_df.sort_values(by=['distance']).groupby('cluster'):
+            cells.append(new_markdown_cell('## Topic {} ({} articles)\n\n'.format(cluster, len(cluster_df)) + '\n'.join(
+                '- {}'.format(str(text)[:200]) for text in cluster_df['text'].head(5)
+            )))
+
+        path = '{}/topic-out-{}.ipynb'.format(self.audit_path, run_time)
+        with self.audit_fs.open(path, 'w') as f:
+            nbformat.write(new_notebook(cells=cells), f)
+        logger.info('wrote audit notebook %s', path)
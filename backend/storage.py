@@ -0,0 +1,416 @@
+import io
+import gzip
+import json
+import logging
+import itertools
+import datetime
+import threading
+
+logger = logging.getLogger('app.storage')
+
+# rows inserted per executemany call during a bulk ingest
+INGEST_CHUNK_SIZE = 10000
+
+def table_name(table):
+    """Returns the local table name for a BigQuery table reference, e.g. project.news.articles -> articles
+    """
+    return table.strip('`').split('.')[-1]
+
+
+class BigQueryStorage:
+    name = 'bigquery'
+
+    def __init__(self, bq_client):
+        """Instantiates the storage layer backed by BigQuery tables
+        Args:
+            bq_client: BigQuery client
+        """
+        self.bq_client = bq_client
+
+    def load_job_config(self, file_format):
+        """Returns the load job configuration for a file format
+
+        Args:
+            file_format: 'ndjson' or 'parquet'
+        """
+        # the BigQuery library is imported on first use so importing the loader stays cheap at startup
+        from google.cloud import bigquery
+
+        job_config = bigquery.LoadJobConfig()
+        if file_format == 'parquet':
+            job_config.source_format = bigquery.SourceFormat.PARQUET
+            # load lists of articles as repeated records rather than wrapper structs
+            parquet_options = bigquery.format_options.ParquetOptions()
+            parquet_options.enable_list_inference = True
+            job_config.parquet_options = parquet_options
+        else:
+            job_config.source_format = bigquery.SourceFormat.NEWLINE_DELIMITED_JSON
+        return job_config
+
+    def load_files(self, file_uris, file_format, dataset_id, table_id, job_id=None):
+        """Appends files in Cloud Storage to a table with load jobs of up to 10,000 source URIs each
+        Args:
+            file_uris: list of gs:// URIs
+            file_format: 'ndjson' or 'parquet'
+            dataset_id: BigQuery dataset ID
+            table_id: BigQuery table ID
+            job_id: optional ID of the load. Loading again with the ID of a load that succeeded returns
+                its rows without loading the files a second time
+        Returns:
+            number of rows loaded
+        """
+        table_ref = self.bq_client.dataset(dataset_id).table(table_id)
+        job_config = self.load_job_config(file_format)
+        rows = 0
+        for index in range(0, len(file_uris), 10000):
+            chunk_job_id = '{}_{}'.format(job_id, index // 10000) if job_id else None
+            load_job = self.start_load_job(file_uris[index:index + 10000], table_ref, job_config, chunk_job_id)
+            logger.info('starting %s job %s for %s files', file_format, load_job.job_id, len(file_uris[index:index + 10000]))
+            load_job.result()
+            rows += load_job.output_rows or 0
+        return rows
+
+    def start_load_job(self, file_uris, table_ref, job_config, job_id=None):
+        """Starts a load job. When a job with `job_id` already exists it is returned if it succeeded
+        or is still running, and a failed job is started again under the ID with a numbered suffix
+        """
+        if job_id is None:
+            return self.bq_client.load_table_from_uri(file_uris, table_ref, job_config=job_config)
+
+        from google.api_core.exceptions import Conflict
+
+        for attempt in itertools.count():
+            attempt_job_id = '{}_retry{}'.format(job_id, attempt) if attempt else job_id
+            try:
+                return self.bq_client.load_table_from_uri(file_uris, table_ref, job_id=attempt_job_id, job_config=job_config)
+            except Conflict:
+                load_job = self.bq_client.get_job(attempt_job_id)
+                if load_job.state != 'DONE' or load_job.error_result is None:
+                    logger.info('load job %s already exists, the files are not loaded again', attempt_job_id)
+                    return load_job
+
+    def query_window_articles(self, articles_table, window_days):
+        """Queries the articles published in the window for the topic model
+        Returns:
+            dataframe with article_id, publishedAt, text and the fields shown on the site
+        """
+        query = """
+            SELECT
+                article_id,
+                publishedAt,
+                CONCAT(title, '. ', description, '. ', content) AS text,
+                title,
+                description,
+                content,
+                url,
+                urlToImage
+            FROM `{}`
+            WHERE
+              title IS NOT NULL
+              AND description IS NOT NULL
+              AND content IS NOT NULL
+              AND DATE(publishedAt) >= DATE_SUB(CURRENT_DATE(), INTERVAL {} DAY)
+            -- an article fetched by several runs has one row per load, keep the latest
+            QUALIFY ROW_NUMBER() OVER (PARTITION BY article_id ORDER BY load_timestamp DESC) = 1
+        """.format(articles_table, window_days)
+        return self.bq_client.query(query).to_dataframe()
+
+    def write_topics(self, topics_df, topics_table, merge=False, window_days=7):
+        """Writes article topics. Without `merge` the table is replaced, otherwise the rows are merged
+        into the table by article_id and articles that left the window are deleted
+        Args:
+            topics_df: dataframe with the columns of the topics table
+            topics_table: fully qualified topics table
+            merge: merge the rows instead of replacing the table
+            window_days: days of articles kept in the topics table
+        """
+        from google.cloud import bigquery
+
+        job_config = bigquery.LoadJobConfig(
+            schema=[
+                bigquery.SchemaField("article_id", bigquery.enums.SqlTypeNames.STRING),
+                bigquery.SchemaField("publishedAt", bigquery.enums.SqlTypeNames.TIMESTAMP),
+                bigquery.SchemaField("text", bigquery.enums.SqlTypeNames.STRING),
+                bigquery.SchemaField("dominant_topic", bigquery.enums.SqlTypeNames.INT64),
+                bigquery.SchemaField("topic_perc_contrib", bigquery.enums.SqlTypeNames.FLOAT64),
+                bigquery.SchemaField("keywords", bigquery.enums.SqlTypeNames.STRING),
+            ],
+            write_disposition="WRITE_TRUNCATE",
+        )
+        if not merge:
+            job = self.bq_client.load_table_from_dataframe(topics_df, topics_table, job_config=job_config)
+            return job.result()
+
+        # load the changed rows to a staging table and merge them into the topics table
+        staging_table = '{}_staging'.format(topics_table)
+        self.bq_client.load_table_from_dataframe(topics_df, staging_table, job_config=job_config).result()
+        merge_query = """
+            MERGE `{0}` T
+            USING (
+                SELECT * FROM `{1}`
+                WHERE TRUE
+                QUALIFY ROW_NUMBER() OVER (PARTITION BY article_id) = 1
+            ) S
+            ON T.article_id = S.article_id
+            WHEN MATCHED THEN
+                UPDATE SET dominant_topic = S.dominant_topic, topic_perc_contrib = S.topic_perc_contrib
+            WHEN NOT MATCHED THEN
+                INSERT ROW;
+            DELETE FROM `{0}`
+            WHERE DATE(publishedAt) < DATE_SUB(CURRENT_DATE(), INTERVAL {2} DAY);
+        """.format(topics_table, staging_table, window_days)
+        return self.bq_client.query(merge_query).result()
+
+
+# tables of the embedded database, named after the BigQuery tables they replace.
+# Tracking rows are flattened to one row per article so they can be indexed by article_id
+SQLITE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS articles (
+        article_id TEXT PRIMARY KEY,
+        title TEXT,
+        author TEXT,
+        description TEXT,
+        content TEXT,
+        url TEXT,
+        urlToImage TEXT,
+        publishedAt TEXT,
+        article_order INTEGER,
+        load_timestamp TEXT
+    );
+    CREATE INDEX IF NOT EXISTS articles_published ON articles (publishedAt);
+    CREATE TABLE IF NOT EXISTS impressions (
+        user_id TEXT,
+        impression_timestamp TEXT,
+        article_id TEXT,
+        sort TEXT
+    );
+    CREATE INDEX IF NOT EXISTS impressions_user ON impressions (user_id);
+    CREATE INDEX IF NOT EXISTS impressions_article ON impressions (article_id);
+    CREATE TABLE IF NOT EXISTS clicks (
+        user_id TEXT,
+        click_timestamp TEXT,
+        article_id TEXT,
+        sort TEXT
+    );
+    CREATE INDEX IF NOT EXISTS clicks_user ON clicks (user_id, article_id);
+    CREATE INDEX IF NOT EXISTS clicks_article ON clicks (article_id, click_timestamp);
+    CREATE TABLE IF NOT EXISTS article_topics (
+        article_id TEXT PRIMARY KEY,
+        publishedAt TEXT,
+        text TEXT,
+        dominant_topic INTEGER,
+        topic_perc_contrib REAL,
+        keywords TEXT
+    );
+    CREATE INDEX IF NOT EXISTS article_topics_topic ON article_topics (dominant_topic);
+    CREATE INDEX IF NOT EXISTS article_topics_published ON article_topics (publishedAt);
+    CREATE TABLE IF NOT EXISTS load_jobs (
+        job_id TEXT PRIMARY KEY,
+        rows INTEGER
+    );
+"""
+
+TABLE_COLUMNS = {
+    'articles': ['article_id', 'title', 'author', 'description', 'content', 'url', 'urlToImage',
+                 'publishedAt', 'article_order', 'load_timestamp'],
+    'impressions': ['user_id', 'impression_timestamp', 'article_id', 'sort'],
+    'clicks': ['user_id', 'click_timestamp', 'article_id', 'sort'],
+    'article_topics': ['article_id', 'publishedAt', 'text', 'dominant_topic', 'topic_perc_contrib', 'keywords'],
+}
+
+TIMESTAMP_COLUMNS = {'publishedAt', 'load_timestamp', 'impression_timestamp', 'click_timestamp'}
+
+def format_timestamp(value):
+    """Returns a timestamp as 'YYYY-MM-DD HH:MM:SS' in UTC, so timestamps sort and compare as text
+    """
+    if value is None:
+        return None
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(datetime.timezone.utc)
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    return str(value).replace('T', ' ').rstrip('Z')[:19]
+
+def expand_rows(table, row):
+    """Yields the table rows for one record of a file loaded to `table`. Impressions are split into
+    one row per article and the clicked article is flattened
+    """
+    if table == 'impressions':
+        for article in row.get('articles') or []:
+            yield dict(article, user_id=row.get('user_id'), impression_timestamp=row.get('impression_timestamp'))
+    elif table == 'clicks':
+        yield dict(row.get('article_clicked') or {}, user_id=row.get('user_id'), click_timestamp=row.get('click_timestamp'))
+    else:
+        yield row
+
+def read_records(f, path, file_format):
+    """Yields the records of an NDJSON or Parquet file, gzipped NDJSON is detected by the .gz extension
+    """
+    if file_format == 'parquet':
+        # pyarrow is only needed for Parquet input so it is imported on first use
+        import pyarrow.parquet
+        parquet_file = pyarrow.parquet.ParquetFile(f)
+        for index in range(parquet_file.num_row_groups):
+            columns = parquet_file.read_row_group(index).to_pydict()
+            names = list(columns)
+            for values in zip(*(columns[name] for name in names)):
+                yield dict(zip(names, values))
+        return
+    if path.endswith('.gz'):
+        f = gzip.GzipFile(fileobj=f)
+    for line in io.TextIOWrapper(f, encoding='utf-8'):
+        if line.strip():
+            yield json.loads(line)
+
+
+class SQLiteStorage:
+    name = 'sqlite'
+
+    def __init__(self, path, fs=None):
+        """Instantiates the storage layer backed by an embedded SQLite database, with the tables
+        indexed by user_id, article_id and publishedAt. The database is opened in WAL mode so
+        the app can read while the backend loads files
+        Args:
+            path: local path of the database file
+            fs: optional filesystem with an fsspec style `open` for the loaded files e.g. gcsfs,
+                local files are read when not set
+        """
+        import sqlite3
+        self.path = path
+        self.fs = fs
+        # writes are serialized by SQLite anyway, a single connection keeps bulk loads in one transaction
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript(SQLITE_SCHEMA)
+
+    def open(self, path):
+        return self.fs.open(path, 'rb') if self.fs is not None else open(path, 'rb')
+
+    def insert(self, table, records):
+        """Inserts records in chunks, replacing articles and topics with the same article_id
+        Args:
+            table: local table name
+            records: iterable of dictionaries, e.g. the records of a file
+        Returns:
+            number of rows inserted
+        """
+        columns = TABLE_COLUMNS[table]
+        statement = 'INSERT OR REPLACE INTO {} ({}) VALUES ({})'.format(table, ', '.join(columns), ', '.join('?' * len(columns)))
+        rows = 0
+        chunk = []
+        for record in records:
+            for row in expand_rows(table, record):
+                chunk.append(tuple(
+                    format_timestamp(row.get(column)) if column in TIMESTAMP_COLUMNS else row.get(column)
+                    for column in columns
+                ))
+            if len(chunk) >= INGEST_CHUNK_SIZE:
+                self._connection.executemany(statement, chunk)
+                rows += len(chunk)
+                chunk = []
+        if chunk:
+            self._connection.executemany(statement, chunk)
+            rows += len(chunk)
+        return rows
+
+    def load_files(self, file_uris, file_format, dataset_id, table_id, job_id=None):
+        """Bulk inserts NDJSON or Parquet files into a table in a single transaction
+        Args:
+            file_uris: list of file paths or URIs readable by `fs`
+            file_format: 'ndjson' or 'parquet'
+            dataset_id: dataset ID, unused since all tables share one database
+            table_id: table name
+            job_id: optional ID of the load, recorded in the load_jobs table in the same transaction.
+                Loading again with the ID of a recorded load returns its rows without inserting them again
+        Returns:
+            number of rows loaded
+        """
+        rows = 0
+        with self._lock, self._connection:
+            if job_id is not None:
+                loaded = self._connection.execute('SELECT rows FROM load_jobs WHERE job_id = ?', (job_id,)).fetchone()
+                if loaded is not None:
+                    logger.info('load %s was already inserted, the files are not loaded again', job_id)
+                    return loaded[0]
+            for file_uri in file_uris:
+                with self.open(file_uri) as f:
+                    rows += self.insert(table_id, read_records(f, file_uri, file_format))
+            if job_id is not None:
+                self._connection.execute('INSERT INTO load_jobs (job_id, rows) VALUES (?, ?)', (job_id, rows))
+        logger.info('inserted %s rows from %s files into %s', rows, len(file_uris), table_id)
+        return rows
+
+    def query_window_articles(self, articles_table, window_days):
+        """Queries the articles published in the window for the topic model
+        Returns:
+            dataframe with article_id, publishedAt, text and the fields shown on the site
+        """
+        import pandas
+        query = """
+            SELECT
+                article_id,
+                publishedAt,
+                title || '. ' || description || '. ' || content AS text,
+                title,
+                description,
+                content,
+                url,
+                urlToImage
+            FROM {}
+            WHERE
+              title IS NOT NULL
+              AND description IS NOT NULL
+              AND content IS NOT NULL
+              AND publishedAt >= date('now', ?)
+        """.format(table_name(articles_table))
+        with self._lock:
+            return pandas.read_sql_query(query, self._connection, params=('-{} days'.format(window_days),), parse_dates=['publishedAt'])
+
+    def write_topics(self, topics_df, topics_table, merge=False, window_days=7):
+        """Writes article topics. Without `merge` the table is replaced, otherwise the rows are upserted
+        by article_id and articles that left the window are deleted
+        Args:
+            topics_df: dataframe with the columns of the topics table
+            topics_table: fully qualified topics table
+            merge: merge the rows instead of replacing the table
+            window_days: days of articles kept in the topics table
+        """
+        table = table_name(topics_table)
+        records = topics_df.astype(object).where(topics_df.notnull(), None).to_dict('records')
+        with self._lock, self._connection:
+            if merge:
+                self._connection.execute('DELETE FROM {} WHERE publishedAt < date(\'now\', ?)'.format(table), ('-{} days'.format(window_days),))
+            else:
+                self._connection.execute('DELETE FROM {}'.format(table))
+            return self.insert(table, records)
+
+
+def bulk_load(path, table, files, file_format=None):
+    """Loads local NDJSON or Parquet files into a SQLite database, e.g. to seed a development database
+    Args:
+        path: database file
+        table: 'articles', 'impressions', 'clicks' or 'article_topics'
+        files: list of local file paths
+        file_format: 'ndjson' or 'parquet', detected from each file's extension when not set
+    """
+    storage = SQLiteStorage(path)
+    rows = 0
+    for file_path in files:
+        rows += storage.load_files(
+            [file_path], file_format or ('parquet' if file_path.endswith('.parquet') else 'ndjson'), None, table
+        )
+    return rows
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Bulk loads NDJSON or Parquet files into a SQLite database')
+    parser.add_argument('path', help='database file')
+    parser.add_argument('table', choices=sorted(TABLE_COLUMNS))
+    parser.add_argument('files', nargs='+')
+    parser.add_argument('--format', choices=['ndjson', 'parquet'])
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    logger.info('loaded %s rows into %s', bulk_load(args.path, args.table, args.files, args.format), args.table)
@@ -1,32 +1,42 @@
-import json
+import time
 import logging
+from events import decode_message
+from writer import write_rows, tracking_schema
+from metrics import span
 
 logger = logging.getLogger('app.subscriber')
 
 class Subscriber:
-    def __init__(self, subscriber_client, gcsfs_client):
+    def __init__(self, subscriber_client, gcsfs_client, compress=False, file_format='ndjson'):
         """Instantiates the Subscriber class for accessing messages from a Pubsub subscription
         and writing messages to Cloud Storage
         Args:
             subscriber_client: Pubsub subscriber client
             gcsfs_client: a client for GCSFS
+            compress: gzip the NDJSON files written to buckets
+            file_format: 'ndjson' or 'parquet'
         """
         self.subscriber_client = subscriber_client
         self.gcsfs_client = gcsfs_client
+        self.compress = compress
+        self.file_format = file_format
 
-    def write_messages_to_file(self, message_list, bucket_path, filename):
-        """Write pubsub messages to NDJSON file to be loaded to BigQuery
+    def write_messages_to_file(self, message_list, bucket_path, filename, table_id=None):
+        """Write pubsub messages to an NDJSON or Parquet file to be loaded to BigQuery
         Args:
-            message_list: list of dictionaries to be converted to NDJSON file
+            message_list: iterable of decoded tracking rows to be written to the file
             bucket_path: GCS bucket path e.g. "gs://bucket_path"
             filename: name of the resulting file without extension
+            table_id: tracking table of the messages, 'impressions' or 'clicks', sets the Parquet schema
         """
-        
-        with self.gcsfs_client.open('{}/{}.ndjson'.format(bucket_path, filename), 'w') as f:
-            for item in message_list:
-                f.write(item+'\n')
+        schema = tracking_schema(table_id) if self.file_format == 'parquet' else None
+        with span('subscriber.write_file'):
+            path, row_count, bytes_written = write_rows(
+                self.gcsfs_client, '{}/{}'.format(bucket_path, filename), message_list,
+                file_format=self.file_format, compress=self.compress, schema=schema
+            )
 
-        return 'Messages written to file', 200
+        return 'Messages written to file', 200, bytes_written
 
     def get_messages(self, subscription_path, bucket_name, filename):
         """Retrieves messages from a Pubsub topic and writes to bucket
@@ -50,10 +60,9 @@ class Subscriber:
             ack_ids = []
             message_list = []
             for received_message in response.received_messages:
-                print('Received message ID: {} | published {}'.format(received_message.message.message_id, received_message.message.publish_time))
-                logger.info('Received message ID: {} | published {}'.format(received_message.message.message_id, received_message.message.publish_time))
+                logger.debug('received message ID: %s | published %s', received_message.message.message_id, received_message.message.publish_time, extra={'category': 'message'})
                 ack_ids.append(received_message.ack_id)
-                decoded_message = json.loads(received_message.message.data.decode('utf-8'))
+                decoded_message = decode_message(received_message.message.data, dict(received_message.message.attributes))
                 message_list.append(decoded_message)
 
             bucket_path = 'gs://{}'.format(bucket_name)
@@ -61,10 +70,8 @@ class Subscriber:
             # only write files with messages
             if message_list:
                 self.write_messages_to_file(message_list, bucket_path, filename)
-                print('wrote file {} to bucket {}'.format(filename, bucket_path))
-                logger.info('wrote file {} to bucket {}'.format(filename, bucket_path))
+                logger.info('wrote file %s to bucket %s', filename, bucket_path)
             else:
-                print('no messages found')
                 logger.info('no messages found')
 
             # Acknowledges the received messages so they will not be sent again.
@@ -77,9 +84,106 @@ class Subscriber:
 
             return 'Received and acknowledged {} messages'.format(len(response.received_messages)), 200
 
-        except Exception as e:
-            print(e)
-            logger.info(e)
+        except Exception:
+            logger.exception('failed to get messages')
 
             return 'Failed to get messages', 400
 
+    def drain_messages(self, subscription_path, bucket_name, file_prefix, batch_size=1000, time_budget=240,
+                       max_file_bytes=64 * 1024 * 1024, max_file_seconds=60, on_file=None,
+                       table_id=None):
+        """Pulls messages in large batches until the subscription is empty or the time budget
+        runs out. Messages are written to a new file whenever the current one reaches
+        `max_file_bytes` or `max_file_seconds`, and each file's messages are acknowledged
+        only after the file has been written
+
+        Args:
+            subscription_path: a Pubsub subscription path
+            bucket_name: Cloud Storage bucket name
+            file_prefix: prefix of the resulting files, a part number is appended
+            batch_size: maximum messages per pull request
+            time_budget: seconds after which no more messages are pulled
+            max_file_bytes: message bytes after which the current file is written
+            max_file_seconds: seconds after which the current file is written
+            on_file: optional function called with the filename once a file is written and its
+                messages acknowledged, e.g. to start loading it while the drain continues
+            table_id: tracking table of the messages, 'impressions' or 'clicks', sets the Parquet schema
+        """
+        # imported on first use so importing the subscriber stays cheap at startup
+        from google.api_core import exceptions
+
+        bucket_path = 'gs://{}'.format(bucket_name)
+        deadline = time.monotonic() + time_budget
+        # held messages must outlive the time until their file is written
+        ack_deadline = min(600, max_file_seconds + 60)
+        pending = {'messages': [], 'ack_ids': [], 'bytes': 0, 'started': time.monotonic()}
+        files = []
+        received, acknowledged = 0, 0
+
+        def write_pending():
+            filename = '{}-{:04d}'.format(file_prefix, len(files))
+            self.write_messages_to_file(pending['messages'], bucket_path, filename, table_id)
+            logger.info('wrote file %s with %s messages to bucket %s', filename, len(pending['messages']), bucket_path)
+            files.append(filename)
+
+            # acknowledge only the messages in the file that was written
+            with span('subscriber.acknowledge'):
+                for index in range(0, len(pending['ack_ids']), 1000):
+                    self.subscriber_client.acknowledge(
+                        request={
+                            'subscription': subscription_path,
+                            'ack_ids': pending['ack_ids'][index:index + 1000]
+                        }
+                    )
+            acknowledged_count = len(pending['ack_ids'])
+            pending.update({'messages': [], 'ack_ids': [], 'bytes': 0, 'started': time.monotonic()})
+            if on_file is not None:
+                on_file(filename)
+            return acknowledged_count
+
+        try:
+            while time.monotonic() < deadline:
+                try:
+                    with span('subscriber.pull'):
+                        response = self.subscriber_client.pull(
+                            request={
+                                'subscription': subscription_path,
+                                'max_messages': batch_size
+                            },
+                            timeout=min(30, max(1, deadline - time.monotonic()))
+                        )
+                except exceptions.DeadlineExceeded:
+                    break
+                if not response.received_messages:
+                    break
+
+                ack_ids = [received_message.ack_id for received_message in response.received_messages]
+                self.subscriber_client.modify_ack_deadline(
+                    request={
+                        'subscription': subscription_path,
+                        'ack_ids': ack_ids,
+                        'ack_deadline_seconds': ack_deadline
+                    }
+                )
+                with span('subscriber.decode'):
+                    for received_message in response.received_messages:
+                        pending['messages'].append(decode_message(received_message.message.data, dict(received_message.message.attributes)))
+                        pending['bytes'] += len(received_message.message.data)
+                pending['ack_ids'].extend(ack_ids)
+                received += len(ack_ids)
+
+                if pending['bytes'] >= max_file_bytes or time.monotonic() - pending['started'] >= max_file_seconds:
+                    acknowledged += write_pending()
+
+            if pending['messages']:
+                acknowledged += write_pending()
+            elif not files:
+                logger.info('no messages found')
+
+            return 'Received {} and acknowledged {} messages in {} files'.format(received, acknowledged, len(files)), 200
+
+        except Exception:
+            # unacknowledged messages are redelivered once their ack deadline expires
+            logger.exception('failed to drain messages')
+
+            return 'Failed to drain messages after acknowledging {} of {}'.format(acknowledged, received), 400
@@ -0,0 +1,31 @@
+import os
+import sys
+import importlib.util
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_DIR = os.path.join(os.path.dirname(BACKEND_DIR), 'app')
+
+# the backend modules import each other by module name as they do when the service runs from backend/
+sys.path.insert(0, BACKEND_DIR)
+
+def load_app_module(name):
+    """Imports a module of the app service under the name `app_<name>`, as the app and backend
+    have modules with the same names e.g. events.py
+    """
+    spec = importlib.util.spec_from_file_location('app_{}'.format(name), os.path.join(APP_DIR, '{}.py'.format(name)))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class LocalFileSystem:
+    """Local files behind the fsspec style `open` the writers and storage use with gcsfs
+    """
+    def open(self, path, mode='rb'):
+        return open(path, mode)
+
+
+@pytest.fixture
+def local_fs():
+    return LocalFileSystem()
@@ -0,0 +1,47 @@
+import pytest
+import events
+from conftest import load_app_module
+
+SORTS = ['latest', 'popular', 'random', 'personalized']
+
+@pytest.fixture(params=['none', 'gzip'])
+def app_events(request, monkeypatch):
+    module = load_app_module('events')
+    monkeypatch.setattr(module, 'EVENT_FORMAT', 'compact')
+    monkeypatch.setattr(module, 'EVENT_COMPRESSION', request.param)
+    return module
+
+def test_sort_codes_match():
+    assert events.SORT_NAMES == {code: sort for sort, code in load_app_module('events').SORT_CODES.items()}
+
+def test_impression_round_trip(app_events):
+    articles = [{'article_id': 'a{}'.format(index), 'sort': sort} for index, sort in enumerate(SORTS)]
+    data, attributes = app_events.encode_impression(
+        {'user_id': 'user', 'impression_timestamp': '2020-01-01 00:00:00', 'articles': articles}
+    )
+
+    row = events.decode_message(data, attributes)
+
+    assert row['user_id'] == 'user'
+    assert sorted(row['articles'], key=lambda article: article['article_id']) == articles
+    assert len(row['impression_timestamp']) == len('2020-01-01 00:00:00')
+
+@pytest.mark.parametrize('sort', SORTS)
+def test_click_round_trip(app_events, sort):
+    data, attributes = app_events.encode_click(
+        {'user_id': 'user', 'click_timestamp': '2020-01-01 00:00:00', 'article_clicked': {'article_id': 'a1', 'sort': sort}}
+    )
+
+    row = events.decode_message(data, attributes)
+
+    assert row['user_id'] == 'user'
+    assert row['article_clicked'] == {'article_id': 'a1', 'sort': sort}
+
+def test_legacy_round_trip(monkeypatch):
+    app_events = load_app_module('events')
+    monkeypatch.setattr(app_events, 'EVENT_FORMAT', 'legacy')
+    tracker = {'user_id': 'user', 'click_timestamp': '2020-01-01 00:00:00', 'article_clicked': {'article_id': 'a1', 'sort': 'latest'}}
+
+    data, attributes = app_events.encode_click(tracker)
+
+    assert events.decode_message(data, attributes) == tracker
@@ -0,0 +1,47 @@
+import os
+import sys
+import pytest
+from news import News
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'bench'))
+from newsapi_stub import NewsApiStub
+from workload import Corpus
+
+DOMAINS = ', '.join('site{}.com'.format(index) for index in range(5))
+
+@pytest.fixture
+def news_api(request):
+    stub = NewsApiStub(Corpus(size=100), latency=0, results_per_query=250, **getattr(request, 'param', {})).start()
+    yield stub
+    stub.stop()
+
+def test_domains_are_sharded(news_api):
+    news = News('key', base_url=news_api.url, domains_per_query=2, page_size=100)
+
+    list(news.iter_news('2021-01-01', DOMAINS))
+
+    shards = sorted({domains for domains, page in news_api.queries})
+    assert shards == ['site0.com, site1.com', 'site2.com, site3.com', 'site4.com']
+
+def test_pages_until_all_results(news_api):
+    news = News('key', base_url=news_api.url, domains_per_query=10, page_size=100)
+
+    articles = list(news.iter_news('2021-01-01', DOMAINS))
+
+    assert len(articles) == 250
+    assert sorted(page for domains, page in news_api.queries) == [1, 2, 3]
+
+def test_pages_stop_at_max_pages(news_api):
+    news = News('key', base_url=news_api.url, domains_per_query=10, page_size=100, max_pages=2)
+
+    assert len(list(news.iter_news('2021-01-01', DOMAINS))) == 200
+
+@pytest.mark.parametrize('news_api', [{'failing_domains': ['site2.com']}], indirect=True)
+def test_failing_shard_keeps_other_shards(news_api):
+    news = News('key', base_url=news_api.url, domains_per_query=2, page_size=100)
+
+    response = news.get_news('2021-01-01', DOMAINS)
+
+    # two of the three shards return all their results
+    assert response['totalResults'] == 500
+    assert len({article['url'] for article in response['articles']}) == 500
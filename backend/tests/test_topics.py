@@ -0,0 +1,102 @@
+import numpy
+import pandas
+import pytest
+from topics import EmbeddingStore, update_embeddings, changed_topics
+
+DIM = 4
+
+def vector(text):
+    # deterministic embedding of a text
+    return numpy.full(DIM, sum(map(ord, text)) % 997, dtype=numpy.float32)
+
+
+class FakeEncoder:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.encoded = []
+
+    def encode(self, sentences, out=None, batch_size=None):
+        if self.fail:
+            raise RuntimeError('encoder failed')
+        self.encoded.extend(sentences)
+        out[:] = [vector(sentence) for sentence in sentences]
+        return out
+
+
+def articles(*days):
+    return pandas.DataFrame({
+        'article_id': ['a{}'.format(day) for day in days],
+        'publishedAt': [pandas.Timestamp('2021-01-{:02d}'.format(day)) for day in days],
+        'text': ['text {}'.format(day) for day in days],
+    })
+
+def test_store_round_trip(tmp_path):
+    store = EmbeddingStore(str(tmp_path), dim=DIM)
+    store.add(['a1', 'a2', 'a3'], ['2021-01-01', '2021-01-02', '2021-01-03'], numpy.stack([vector('1'), vector('2'), vector('3')]))
+    store.reserve(['a4'], ['2021-01-04'])
+    store.truncate(3)
+
+    assert store.evict('2021-01-02') == 1
+    store.save()
+
+    reopened = EmbeddingStore(str(tmp_path), dim=DIM)
+    assert reopened.article_ids == ['a2', 'a3']
+    assert reopened.missing(['a1', 'a2', 'a4']) == ['a1', 'a4']
+    numpy.testing.assert_array_equal(reopened.matrix(['a3', 'a2']), numpy.stack([vector('3'), vector('2')]))
+
+def test_store_grows(tmp_path):
+    store = EmbeddingStore(str(tmp_path), dim=DIM)
+    ids = ['a{}'.format(index) for index in range(1500)]
+    store.add(ids, ['2021-01-01'] * len(ids), numpy.arange(len(ids) * DIM, dtype=numpy.float32).reshape(-1, DIM))
+    store.save()
+
+    reopened = EmbeddingStore(str(tmp_path), dim=DIM)
+    assert reopened.capacity >= 1500
+    numpy.testing.assert_array_equal(reopened.matrix(['a1499'])[0], numpy.arange(1499 * DIM, 1500 * DIM))
+
+def test_update_embeddings_only_embeds_new_articles(tmp_path):
+    store = EmbeddingStore(str(tmp_path), dim=DIM)
+    encoder = FakeEncoder()
+    update_embeddings(articles(1, 2), store, encoder)
+
+    X, is_new = update_embeddings(articles(2, 3), store, encoder)
+
+    assert encoder.encoded == ['text 1', 'text 2', 'text 3']
+    assert list(is_new) == [False, True]
+    numpy.testing.assert_array_equal(X, numpy.stack([vector('text 2'), vector('text 3')]))
+    # a1 left the window
+    assert store.article_ids == ['a2', 'a3']
+
+def test_update_embeddings_releases_rows_when_encoding_fails(tmp_path):
+    store = EmbeddingStore(str(tmp_path), dim=DIM)
+    update_embeddings(articles(1), store, FakeEncoder())
+
+    with pytest.raises(RuntimeError):
+        update_embeddings(articles(1, 2), store, FakeEncoder(fail=True))
+
+    assert store.article_ids == ['a1']
+    X, is_new = update_embeddings(articles(1, 2), store, FakeEncoder())
+    assert list(is_new) == [False, True]
+    numpy.testing.assert_array_equal(X[1], vector('text 2'))
+
+def test_changed_topics():
+    news_df = pandas.DataFrame({'article_id': ['a', 'b', 'c', 'd'], 'cluster': [0, 1, 2, 3], 'distance': [1.0, 1.0, 1.0, 1.0]})
+    previous_topics = {'a': [0, 1.005], 'b': [0, 1.0], 'c': [2, 1.5]}
+
+    changed = changed_topics(news_df, previous_topics, tolerance=0.01)
+
+    # a is within the tolerance, b changed topic, c moved, d is new
+    assert list(changed) == [False, True, True, True]
+
+def test_eviction_is_saved_with_its_data_file(tmp_path):
+    store = EmbeddingStore(str(tmp_path), dim=DIM)
+    update_embeddings(articles(1, 2, 3), store, FakeEncoder())
+
+    # the window moves on and the run fails after the eviction, before the store is saved again
+    with pytest.raises(RuntimeError):
+        update_embeddings(articles(2, 3, 4), store, FakeEncoder(fail=True))
+
+    reopened = EmbeddingStore(str(tmp_path), dim=DIM)
+    assert reopened.article_ids == ['a2', 'a3']
+    numpy.testing.assert_array_equal(reopened.matrix(['a2', 'a3']), numpy.stack([vector('text 2'), vector('text 3')]))
+    assert sorted(path.name for path in tmp_path.glob('*.f32')) == ['embeddings-1.f32']
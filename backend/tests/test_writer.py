@@ -0,0 +1,70 @@
+import gzip
+import json
+import os
+import datetime
+import pytest
+from writer import write_ndjson, write_parquet, write_rows, tracking_schema
+
+ROWS = [{'user_id': 'user{}'.format(index), 'articles': [{'article_id': str(index), 'sort': 'latest'}]} for index in range(100)]
+
+def read_lines(path):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+def test_gzip_round_trip(local_fs, tmp_path):
+    path = str(tmp_path / 'rows.ndjson.gz')
+
+    row_count, bytes_written = write_ndjson(local_fs, path, ROWS, compress=True, block_size=64)
+
+    assert read_lines(path) == ROWS
+    assert row_count == len(ROWS)
+    assert bytes_written == os.path.getsize(path)
+
+def test_generator_input(local_fs, tmp_path):
+    path = str(tmp_path / 'rows.ndjson')
+    consumed = []
+
+    def rows():
+        for row in ROWS:
+            consumed.append(row)
+            yield row
+
+    row_count, bytes_written = write_ndjson(local_fs, path, rows())
+
+    assert consumed == ROWS
+    assert read_lines(path) == ROWS
+    assert (row_count, bytes_written) == (len(ROWS), os.path.getsize(path))
+
+def test_counts_of_empty_input(local_fs, tmp_path):
+    path = str(tmp_path / 'empty.ndjson.gz')
+
+    row_count, bytes_written = write_ndjson(local_fs, path, iter([]), compress=True)
+
+    assert read_lines(path) == []
+    assert (row_count, bytes_written) == (0, os.path.getsize(path))
+
+def test_write_rows_adds_extension(local_fs, tmp_path):
+    path, row_count, bytes_written = write_rows(local_fs, str(tmp_path / 'rows'), ROWS, compress=True)
+
+    assert path.endswith('rows.ndjson.gz')
+    assert read_lines(path) == ROWS
+    assert (row_count, bytes_written) == (len(ROWS), os.path.getsize(path))
+
+def test_parquet_schema_of_sparse_rows(local_fs, tmp_path):
+    pyarrow = pytest.importorskip('pyarrow')
+    import pyarrow.parquet
+    rows = [{'user_id': None, 'impression_timestamp': '2021-01-01 12:00:00', 'articles': []} for _ in range(3)]
+    rows.append({'user_id': 'user', 'impression_timestamp': '2021-01-01 12:00:01', 'articles': [{'article_id': 'a', 'sort': 'latest'}]})
+
+    path = str(tmp_path / 'impressions.parquet')
+
+    row_count, bytes_written = write_parquet(local_fs, path, rows, tracking_schema('impressions'), chunk_size=3)
+
+    # the first row group only has nulls and empty lists, the second is written with the same schema
+    table = pyarrow.parquet.read_table(path)
+    assert table.schema == tracking_schema('impressions')
+    assert pyarrow.parquet.ParquetFile(path).num_row_groups == 2
+    assert table.column('articles').to_pylist()[-1] == [{'article_id': 'a', 'sort': 'latest'}]
+    assert table.column('impression_timestamp').to_pylist()[0] == datetime.datetime(2021, 1, 1, 12, tzinfo=datetime.timezone.utc)
+    assert (row_count, bytes_written) == (4, os.path.getsize(path))
@@ -0,0 +1,472 @@
+import os
+import json
+import time
+import logging
+import itertools
+import contextlib
+import numpy
+from scipy.optimize import linear_sum_assignment
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics.pairwise import euclidean_distances
+
+logger = logging.getLogger('app.topics')
+
+# The model used here is the Universal Sentence Encoder Lite from Tensorflow Hub
+# https://www.tensorflow.org/hub/tutorials/semantic_similarity_with_tf_hub_universal_encoder_lite
+ENCODER_MODULE = 'https://tfhub.dev/google/universal-sentence-encoder-lite/2'
+EMBEDDING_DIM = 512
+# articles per encoder session run, bounds peak memory regardless of the window size
+ENCODER_BATCH_SIZE = int(os.getenv('ENCODER_BATCH_SIZE', 256))
+# 'full' refits k-means on the window warm started from the previous centroids,
+# 'incremental' only updates the previous centroids with the new embeddings
+TOPIC_CLUSTERING = os.getenv('TOPIC_CLUSTERING', 'full')
+# change in distance to the topic centroid below which an article row is not rewritten
+TOPIC_DISTANCE_TOLERANCE = float(os.getenv('TOPIC_DISTANCE_TOLERANCE', 0.01))
+
+class EmbeddingStore:
+    def __init__(self, directory, dim=EMBEDDING_DIM):
+        """Instantiates a store of article embeddings kept in a float32 memmap with an index of
+        article IDs, so each article is only embedded once while it is in the window
+        Args:
+            directory: local directory holding `index.json` and the data file it names, e.g. `embeddings.f32`
+            dim: embedding dimension
+        """
+        self.directory = directory
+        self.dim = dim
+        # compactions write a new data file, its generation is part of the file name and saved in the index
+        self.generation = 0
+        self.embeddings_path = self.data_path(0)
+        self.index_path = os.path.join(directory, 'index.json')
+        self.centroids_path = os.path.join(directory, 'centroids.npy')
+        self.topics_path = os.path.join(directory, 'topics.json')
+        self.article_ids = []
+        self.published = []
+        self.rows = {}
+        self.capacity = 0
+        self.embeddings = None
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    def load(self):
+        """Opens the memmap and index, starting empty if the store does not exist yet
+        """
+        if not os.path.exists(self.index_path):
+            return self
+        with open(self.index_path) as f:
+            index = json.load(f)
+        self.article_ids = index['article_ids']
+        self.published = index['published']
+        self.capacity = index['capacity']
+        self.generation = index.get('generation', 0)
+        self.embeddings_path = self.data_path(self.generation)
+        self.rows = {article_id: row for row, article_id in enumerate(self.article_ids)}
+        if self.capacity:
+            self.embeddings = numpy.memmap(self.embeddings_path, dtype=numpy.float32, mode='r+', shape=(self.capacity, self.dim))
+        # data files of earlier generations are left behind when the process stopped during an eviction
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith('embeddings') and name.endswith('.f32') and path != self.embeddings_path:
+                os.remove(path)
+        logger.info('loaded %s embeddings from %s', len(self.article_ids), self.directory)
+        return self
+
+    def save(self):
+        """Flushes the memmap and writes the index, renaming it into place
+        """
+        if self.embeddings is not None:
+            self.embeddings.flush()
+        tmp_path = '{}.tmp'.format(self.index_path)
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'article_ids': self.article_ids,
+                'published': self.published,
+                'capacity': self.capacity,
+                'generation': self.generation
+            }, f)
+        os.replace(tmp_path, self.index_path)
+
+    def data_path(self, generation):
+        return os.path.join(self.directory, 'embeddings.f32' if not generation else 'embeddings-{}.f32'.format(generation))
+
+    def __len__(self):
+        return len(self.article_ids)
+
+    def missing(self, article_ids):
+        """Returns the article IDs that have no stored embedding
+        """
+        return [article_id for article_id in article_ids if article_id not in self.rows]
+
+    def _grow(self, required):
+        capacity = max(required, self.capacity * 2, 1024)
+        embeddings = numpy.memmap(self.embeddings_path + '.tmp', dtype=numpy.float32, mode='w+', shape=(capacity, self.dim))
+        if self.embeddings is not None:
+            embeddings[:len(self.article_ids)] = self.embeddings[:len(self.article_ids)]
+            del self.embeddings
+        embeddings.flush()
+        os.replace(self.embeddings_path + '.tmp', self.embeddings_path)
+        self.embeddings = numpy.memmap(self.embeddings_path, dtype=numpy.float32, mode='r+', shape=(capacity, self.dim))
+        self.capacity = capacity
+
+    def reserve(self, article_ids, published):
+        """Appends rows for new articles and returns them as a writable view of the memmap,
+        so embeddings can be written in place
+        Args:
+            article_ids: list of article IDs
+            published: list of publish dates as ISO strings, used for eviction
+        Returns:
+            float32 array view with one row per article
+        """
+        start = len(self.article_ids)
+        if start + len(article_ids) > self.capacity:
+            self._grow(start + len(article_ids))
+        for offset, article_id in enumerate(article_ids):
+            self.rows[article_id] = start + offset
+        self.article_ids.extend(article_ids)
+        self.published.extend(published)
+        return self.embeddings[start:start + len(article_ids)]
+
+    def truncate(self, count):
+        """Drops the rows after the first `count`, e.g. rows reserved for embeddings that failed
+        """
+        for article_id in self.article_ids[count:]:
+            del self.rows[article_id]
+        del self.article_ids[count:]
+        del self.published[count:]
+
+    def add(self, article_ids, published, embeddings):
+        """Appends embeddings for new articles
+        Args:
+            article_ids: list of article IDs
+            published: list of publish dates as ISO strings, used for eviction
+            embeddings: float32 array with one row per article
+        """
+        self.reserve(article_ids, published)[:] = embeddings
+
+    def evict(self, oldest):
+        """Drops embeddings of articles published before a date. The kept rows are copied to a new
+        data file and the index is saved pointing to it, so the saved index always matches the
+        data file it names, even when the process stops before the next `save`
+        Args:
+            oldest: ISO date string, articles published earlier are evicted
+        Returns:
+            number of evicted embeddings
+        """
+        keep = [row for row, published in enumerate(self.published) if published >= oldest]
+        evicted = len(self.article_ids) - len(keep)
+        if evicted:
+            generation = self.generation + 1
+            embeddings = numpy.memmap(self.data_path(generation), dtype=numpy.float32, mode='w+', shape=(self.capacity, self.dim))
+            if keep:
+                embeddings[:len(keep)] = self.embeddings[keep]
+            embeddings.flush()
+            previous_path = self.embeddings_path
+            del self.embeddings
+            self.embeddings, self.embeddings_path, self.generation = embeddings, self.data_path(generation), generation
+            self.article_ids = [self.article_ids[row] for row in keep]
+            self.published = [self.published[row] for row in keep]
+            self.rows = {article_id: row for row, article_id in enumerate(self.article_ids)}
+            # the index is the commit point, the previous data file is only removed once nothing refers to it
+            self.save()
+            os.remove(previous_path)
+        return evicted
+
+    def load_topics(self):
+        """Returns the centroids and article topics written by the previous run
+        Returns:
+            (centroids, topics): centroids array or None, and a dictionary of
+            article_id to [topic, distance]
+        """
+        if not os.path.exists(self.centroids_path) or not os.path.exists(self.topics_path):
+            return None, {}
+        with open(self.topics_path) as f:
+            return numpy.load(self.centroids_path), json.load(f)
+
+    def save_topics(self, centroids, topics):
+        """Saves the centroids and article topics for the next run
+        """
+        numpy.save(self.centroids_path, centroids)
+        tmp_path = '{}.tmp'.format(self.topics_path)
+        with open(tmp_path, 'w') as f:
+            json.dump(topics, f)
+        os.replace(tmp_path, self.topics_path)
+
+    def matrix(self, article_ids):
+        """Returns the embeddings for article IDs as an in-memory array in the same order
+        """
+        if not article_ids:
+            return numpy.zeros((0, self.dim), dtype=numpy.float32)
+        return numpy.asarray(self.embeddings[[self.rows[article_id] for article_id in article_ids]])
+
+
+class Encoder:
+    def __init__(self, module_url=ENCODER_MODULE):
+        """Loads the Universal Sentence Encoder Lite and its SentencePiece processor
+        Args:
+            module_url: Tensorflow Hub module URL
+        """
+        # Tensorflow is only needed to encode, so the embedding store and clustering can be used without it
+        import tensorflow.compat.v1 as tf
+        import tensorflow_hub as hub
+        import sentencepiece as spm
+
+        tf.disable_v2_behavior()
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            module = hub.Module(module_url)
+            self.input_placeholder = tf.sparse_placeholder(tf.int64, shape=[None, None])
+            self.encodings = module(
+                inputs=dict(
+                    values=self.input_placeholder.values,
+                    indices=self.input_placeholder.indices,
+                    dense_shape=self.input_placeholder.dense_shape))
+            spm_path_tensor = module(signature='spm_path')
+            self.session = tf.Session(graph=self.graph)
+            self.session.run([tf.global_variables_initializer(), tf.tables_initializer()])
+            spm_path = self.session.run(spm_path_tensor)
+
+        self.sp = spm.SentencePieceProcessor()
+        with tf.io.gfile.GFile(spm_path, mode='rb') as f:
+            self.sp.LoadFromSerializedProto(f.read())
+        logger.info('SentencePiece model loaded at %s.', spm_path)
+
+    def process_to_IDs_in_sparse_format(self, sentences):
+        """Processes sentences with the SentencePiece processor and returns the results in
+        tf.SparseTensor-similar format built with numpy
+        Returns:
+            (values, indices, dense_shape)
+        """
+        ids = [self.sp.EncodeAsIds(x) for x in sentences]
+        lengths = numpy.fromiter((len(x) for x in ids), dtype=numpy.int64, count=len(ids))
+        total = int(lengths.sum())
+        values = numpy.fromiter(itertools.chain.from_iterable(ids), dtype=numpy.int64, count=total)
+        # row is the sentence, col the position of each token within its sentence
+        rows = numpy.repeat(numpy.arange(len(ids), dtype=numpy.int64), lengths)
+        starts = numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+        cols = numpy.arange(total, dtype=numpy.int64) - starts
+        indices = numpy.stack([rows, cols], axis=1)
+        dense_shape = (len(ids), int(lengths.max()) if len(ids) else 0)
+        return (values, indices, dense_shape)
+
+    def encode(self, sentences, out=None, batch_size=None):
+        """Embeds sentences in fixed size batches, writing each batch into a preallocated matrix
+        Args:
+            sentences: list of strings
+            out: optional float32 array with one row per sentence, e.g. a view of an EmbeddingStore
+            batch_size: sentences per session run, defaults to ENCODER_BATCH_SIZE
+        Returns:
+            float32 array of embeddings, one row per sentence
+        """
+        batch_size = batch_size or ENCODER_BATCH_SIZE
+        if out is None:
+            out = numpy.empty((len(sentences), EMBEDDING_DIM), dtype=numpy.float32)
+        for start in range(0, len(sentences), batch_size):
+            batch = sentences[start:start + batch_size]
+            values, indices, dense_shape = self.process_to_IDs_in_sparse_format(batch)
+            out[start:start + len(batch)] = self.session.run(
+                self.encodings,
+                feed_dict={self.input_placeholder.values: values,
+                           self.input_placeholder.indices: indices,
+                           self.input_placeholder.dense_shape: dense_shape})
+        return out
+
+
+def get_articles(storage, articles_table, window_days=7):
+    """Queries the articles published in the window, one row per article_id
+    """
+    news_df = storage.query_window_articles(articles_table, window_days)
+    # the embedding store and the topics merge both expect unique article IDs
+    return news_df.drop_duplicates('article_id', keep='last').reset_index(drop=True)
+
+def update_embeddings(news_df, store, encoder):
+    """Embeds the articles that are not in the store yet and evicts articles older than the window
+    Args:
+        news_df: dataframe with article_id, publishedAt and text
+        store: EmbeddingStore
+        encoder: Encoder
+    Returns:
+        (X, is_new): embeddings for the articles in news_df, one row per article, and
+        a boolean array marking the articles embedded by this run
+    """
+    oldest = news_df['publishedAt'].min()
+    evicted = store.evict(oldest.isoformat()) if len(news_df) else 0
+
+    is_new = news_df['article_id'].isin(store.missing(news_df['article_id'])).to_numpy()
+    new_df = news_df[is_new]
+    if len(new_df):
+        # embed straight into the rows reserved in the store's memmap
+        start = len(store)
+        rows = store.reserve(
+            list(new_df['article_id']),
+            [published.isoformat() for published in new_df['publishedAt']]
+        )
+        try:
+            encoder.encode(list(new_df['text']), out=rows)
+        except Exception:
+            # release the reservation so the next run embeds these articles instead of using empty rows
+            store.truncate(start)
+            raise
+    store.save()
+    logger.info('embedded %s new articles, evicted %s, store holds %s', len(new_df), evicted, len(store))
+
+    return store.matrix(list(news_df['article_id'])), is_new
+
+def match_topics(previous_centroids, centroids):
+    """Returns the permutation that maps new clusters to the previous topic IDs by pairing
+    each new centroid with its closest previous centroid
+    """
+    cost = numpy.linalg.norm(centroids[:, None, :] - previous_centroids[None, :, :], axis=2)
+    new_clusters, previous_topics = linear_sum_assignment(cost)
+    mapping = numpy.empty(len(centroids), dtype=numpy.int64)
+    mapping[new_clusters] = previous_topics
+    return mapping
+
+def cluster_articles(news_df, X, n_clusters=20, previous_centroids=None, is_new=None, mode='full'):
+    """Assigns each article to a topic and adds the distance to its topic centroid. k-means
+    is fitted once and its distances reused, starting from the previous run's centroids when
+    available so topic IDs stay stable across runs
+    Args:
+        news_df: dataframe with one row per article
+        X: embeddings, one row per article
+        n_clusters: number of topics
+        previous_centroids: centroids from the previous run or None
+        is_new: boolean array marking articles embedded by this run, used in incremental mode
+        mode: 'full' or 'incremental'
+    Returns:
+        (news_df, centroids): news_df with cluster and distance columns, and the topic centroids
+    """
+    warm_start = previous_centroids is not None and previous_centroids.shape == (n_clusters, X.shape[1])
+    new_count = int(is_new.sum()) if is_new is not None else 0
+    if mode == 'incremental' and warm_start and new_count < n_clusters:
+        # a mini batch needs at least n_clusters samples, so a run with fewer new articles
+        # keeps the previous centroids and only assigns the articles to them
+        centroids = previous_centroids
+        distances = euclidean_distances(X, centroids)
+    else:
+        if mode == 'incremental' and warm_start:
+            # update the previous centroids with the new embeddings only
+            kmeans = MiniBatchKMeans(n_clusters=n_clusters, init=previous_centroids, n_init=1, random_state=0)
+            kmeans.partial_fit(X[is_new])
+        else:
+            #Applying kmeans to the dataset / Creating the kmeans classifier
+            init = previous_centroids if warm_start else 'k-means++'
+            kmeans = KMeans(n_clusters=n_clusters, init=init, n_init=1 if warm_start else 10, max_iter=100, random_state=0)
+            kmeans.fit(X)
+        centroids = kmeans.cluster_centers_
+        distances = kmeans.transform(X)
+
+    if warm_start and centroids is not previous_centroids:
+        # reorder clusters so each keeps the topic ID of its closest previous centroid
+        mapping = match_topics(previous_centroids, centroids)
+        order = numpy.argsort(mapping)
+        centroids, distances = centroids[order], distances[:, order]
+
+    news_df['cluster'] = numpy.argmin(distances, axis=1)
+    # add distance to nearest cluster
+    news_df['distance'] = numpy.min(distances, axis=1)
+    return news_df, centroids
+
+def changed_topics(news_df, previous_topics, tolerance=TOPIC_DISTANCE_TOLERANCE):
+    """Returns a boolean array marking articles that are new or whose topic or distance changed
+    """
+    changed = []
+    for article_id, cluster, distance in zip(news_df['article_id'], news_df['cluster'], news_df['distance']):
+        previous = previous_topics.get(article_id)
+        changed.append(previous is None or previous[0] != cluster or abs(previous[1] - distance) > tolerance)
+    return numpy.array(changed, dtype=bool)
+
+def write_topics(storage, news_df, topics_table, changed=None, window_days=7):
+    """Writes article topics to storage. Without `changed` the table is replaced, otherwise
+    only the changed rows are merged into the table and articles that left the window are deleted
+    Args:
+        storage: BigQueryStorage or SQLiteStorage
+        news_df: dataframe with article_id, publishedAt, text, cluster and distance
+        topics_table: fully qualified topics table
+        changed: optional boolean array marking the rows to write
+        window_days: days of articles kept in the topics table
+    """
+    # add temporary columns for keywords
+    news_df['keywords'] = numpy.nan
+
+    # rename distance to topic_perc_contrib to fit legacy schema
+    news_df = news_df.rename(columns={'cluster': 'dominant_topic', 'distance': 'topic_perc_contrib'})
+    news_df = news_df[['article_id', 'publishedAt', 'text', 'dominant_topic', 'topic_perc_contrib', 'keywords']]
+    if changed is not None:
+        news_df = news_df[changed]
+        logger.info('merging %s changed article topics into %s', len(news_df), topics_table)
+
+    return storage.write_topics(news_df, topics_table, merge=changed is not None, window_days=window_days)
+
+@contextlib.contextmanager
+def timed(timings, stage):
+    """Records the seconds spent in a block under `stage` when a timings dictionary is given
+    """
+    start_time = time.monotonic()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[stage] = round(time.monotonic() - start_time, 3)
+
+def run(storage, store, encoder, articles_table, topics_table, window_days=7, n_clusters=20, mode=TOPIC_CLUSTERING, timings=None):
+    """Runs the topic model on the articles in the window and writes the article topics
+    Args:
+        storage: BigQueryStorage or SQLiteStorage
+        store: EmbeddingStore
+        encoder: Encoder
+        articles_table: fully qualified articles table e.g. project.news.articles
+        topics_table: fully qualified topics table e.g. project.topics.article_topics
+        window_days: days of articles to cluster
+        n_clusters: number of topics
+        mode: 'full' or 'incremental' clustering
+        timings: optional dictionary that receives the seconds spent in each stage
+    Returns:
+        news_df: dataframe with the topic of each article in the window
+    """
+    with timed(timings, 'query'):
+        news_df = get_articles(storage, articles_table, window_days)
+    with timed(timings, 'embed'):
+        X, is_new = update_embeddings(news_df, store, encoder)
+
+    with timed(timings, 'cluster'):
+        previous_centroids, previous_topics = store.load_topics()
+        news_df, centroids = cluster_articles(news_df, X, n_clusters, previous_centroids, is_new, mode)
+
+    # the first run replaces the table, later runs only write the rows that changed
+    with timed(timings, 'write'):
+        changed = changed_topics(news_df, previous_topics) if previous_topics else None
+        write_topics(storage, news_df, topics_table, changed, window_days)
+
+    store.save_topics(centroids, {
+        article_id: [int(cluster), float(distance)]
+        for article_id, cluster, distance in zip(news_df['article_id'], news_df['cluster'], news_df['distance'])
+    })
+    return news_df
+
+# article fields stored in the embedding snapshot so the app can show recommendations it has not served yet
+SNAPSHOT_ARTICLE_FIELDS = ['title', 'description', 'content', 'url', 'urlToImage']
+
+def export_snapshot(store, news_df, fs, path):
+    """Writes the window's embeddings, topics and centroids to an .npz snapshot that the app
+    loads for nearest neighbour recommendations, with the fields needed to show each article
+    Args:
+        store: EmbeddingStore
+        news_df: dataframe with article_id, cluster and the article fields from the last run
+        fs: filesystem with an fsspec style `open`
+        path: path of the snapshot e.g. gs://bucket/embeddings/latest.npz
+    """
+    centroids, _ = store.load_topics()
+    article_ids = list(news_df['article_id'])
+    with fs.open(path, 'wb') as f:
+        numpy.savez(
+            f,
+            article_ids=numpy.array(article_ids, dtype=str),
+            embeddings=store.matrix(article_ids),
+            topics=news_df['cluster'].to_numpy(dtype=numpy.int32),
+            centroids=centroids.astype(numpy.float32),
+            published=news_df['publishedAt'].dt.strftime('%Y-%m-%d %H:%M:%S').to_numpy(dtype=str),
+            **{
+                field: news_df[field].fillna('').to_numpy(dtype=str)
+                for field in SNAPSHOT_ARTICLE_FIELDS if field in news_df
+            }
+        )
+    logger.info('exported embedding snapshot %s with %s articles', path, len(article_ids))
@@ -0,0 +1,165 @@
+import io
+import gzip
+import json
+import logging
+import datetime
+
+logger = logging.getLogger('app.writer')
+
+class _CountingWriter(io.RawIOBase):
+    def __init__(self, raw):
+        # counts the bytes that reach the underlying file after buffering and compression
+        self.raw = raw
+        self.bytes_written = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.raw.write(data)
+        self.bytes_written += len(data)
+        return len(data)
+
+
+def write_ndjson(fs, path, rows, compress=False, block_size=1024 * 1024, serialize=json.dumps):
+    """Streams rows to a newline delimited JSON file, buffering writes in large blocks.
+    Rows can come from a generator so memory stays flat regardless of the number of rows.
+    BigQuery loads gzip compressed NDJSON natively
+
+    Args:
+        fs: filesystem with an fsspec style `open`, e.g. a GCSFileSystem, or
+            `fsspec.filesystem('file')` for local tests
+        path: path of the output file
+        rows: iterable of JSON serializable rows
+        compress: gzip the output
+        block_size: bytes buffered before each write to the filesystem
+        serialize: function that turns a row into a JSON string
+    Returns:
+        (row_count, bytes_written): rows written and bytes written to the filesystem
+    """
+    row_count = 0
+    with fs.open(path, 'wb') as raw_file:
+        counter = _CountingWriter(raw_file)
+        buffered = io.BufferedWriter(counter, buffer_size=block_size)
+        output = gzip.GzipFile(fileobj=buffered, mode='wb') if compress else buffered
+        try:
+            for row in rows:
+                output.write(serialize(row).encode('utf-8'))
+                output.write(b'\n')
+                row_count += 1
+        finally:
+            # closing the gzip stream writes its trailer, flushing the buffer hands the rest to the file
+            if compress:
+                output.close()
+            buffered.flush()
+
+    logger.info('wrote %s rows and %s bytes to %s', row_count, counter.bytes_written, path)
+
+    return row_count, counter.bytes_written
+
+def ndjson_extension(compress=False):
+    """Returns the file extension for NDJSON files written with or without compression
+    """
+    return '.ndjson.gz' if compress else '.ndjson'
+
+def tracking_schema(table_id):
+    """Returns the Parquet schema of the rows of a tracking table. Timestamps are written as
+    UTC timestamps so they load into the TIMESTAMP columns, and articles are repeated records
+    with the article_id and sort of the compact events
+    Args:
+        table_id: 'impressions' or 'clicks'
+    """
+    import pyarrow
+
+    article = pyarrow.struct([('article_id', pyarrow.string()), ('sort', pyarrow.string())])
+    timestamp = pyarrow.timestamp('us', tz='UTC')
+    if table_id == 'impressions':
+        return pyarrow.schema([
+            ('user_id', pyarrow.string()),
+            ('impression_timestamp', timestamp),
+            ('articles', pyarrow.list_(article)),
+        ])
+    if table_id == 'clicks':
+        return pyarrow.schema([
+            ('user_id', pyarrow.string()),
+            ('click_timestamp', timestamp),
+            ('article_clicked', article),
+        ])
+    raise ValueError('no Parquet schema for table: {}'.format(table_id))
+
+def parse_timestamp(value):
+    """Parses 'YYYY-MM-DD HH:MM:SS' strings, which are in UTC like BigQuery assumes for NDJSON loads
+    """
+    if isinstance(value, str):
+        return datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return value
+
+def write_parquet(fs, path, rows, schema, chunk_size=10000):
+    """Writes rows to a Parquet file with dictionary encoded columns, one row group per chunk.
+    Every chunk is built against `schema`, so missing and null fields become nulls of the
+    declared type and unknown fields are dropped
+
+    Args:
+        fs: filesystem with an fsspec style `open`
+        path: path of the output file
+        rows: iterable of dictionaries, nested lists of dictionaries become repeated records
+        schema: pyarrow schema of the file, e.g. from `tracking_schema`
+        chunk_size: rows per row group
+    Returns:
+        (row_count, bytes_written): rows written and bytes written to the filesystem
+    """
+    # pyarrow is only needed for Parquet output so it is imported on first use
+    import pyarrow
+    import pyarrow.parquet
+
+    timestamp_fields = [field.name for field in schema if pyarrow.types.is_timestamp(field.type)]
+    row_count = 0
+    with fs.open(path, 'wb') as raw_file:
+        counter = _CountingWriter(raw_file)
+        parquet_writer = pyarrow.parquet.ParquetWriter(counter, schema, use_dictionary=True, compression='snappy')
+        chunk = []
+
+        def write_chunk():
+            for row in chunk:
+                for name in timestamp_fields:
+                    row[name] = parse_timestamp(row.get(name))
+            parquet_writer.write_table(pyarrow.Table.from_pylist(chunk, schema=schema))
+
+        try:
+            for row in rows:
+                chunk.append(dict(row))
+                row_count += 1
+                if len(chunk) >= chunk_size:
+                    write_chunk()
+                    chunk = []
+            if chunk:
+                write_chunk()
+        finally:
+            # the footer is written on close, a file left without it after an error is not readable
+            parquet_writer.close()
+
+    logger.info('wrote %s rows and %s bytes to %s', row_count, counter.bytes_written, path)
+
+    return row_count, counter.bytes_written
+
+def write_rows(fs, path_without_extension, rows, file_format='ndjson', compress=False, schema=None):
+    """Writes rows in the given file format and returns the path with its extension
+    Args:
+        fs: filesystem with an fsspec style `open`
+        path_without_extension: path of the output file without extension
+        rows: iterable of dictionaries
+        file_format: 'ndjson' or 'parquet'
+        compress: gzip NDJSON output, Parquet is always compressed
+        schema: pyarrow schema, required for Parquet output
+    Returns:
+        (path, row_count, bytes_written)
+    """
+    if file_format == 'parquet':
+        if schema is None:
+            raise ValueError('Parquet output needs a schema')
+        path = '{}.parquet'.format(path_without_extension)
+        return (path,) + write_parquet(fs, path, rows, schema)
+    if file_format != 'ndjson':
+        raise ValueError('unknown file format: {}'.format(file_format))
+    path = '{}{}'.format(path_without_extension, ndjson_extension(compress))
+    return (path,) + write_ndjson(fs, path, rows, compress=compress)
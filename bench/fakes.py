@@ -0,0 +1,303 @@
+import io
+import os
+import time
+import uuid
+import datetime
+import threading
+from types import SimpleNamespace
+from concurrent.futures import Future
+from workload import Corpus, Users, tracking_messages, count_rows
+
+# latency in seconds added to each call of a fake service
+BENCH_BIGQUERY_LATENCY = float(os.getenv('BENCH_BIGQUERY_LATENCY', 0.05))
+BENCH_PUBSUB_LATENCY = float(os.getenv('BENCH_PUBSUB_LATENCY', 0.01))
+BENCH_GCS_LATENCY = float(os.getenv('BENCH_GCS_LATENCY', 0.01))
+# messages waiting in each tracking subscription at the start of every drain
+BENCH_TRACKING_BACKLOG = int(os.getenv('BENCH_TRACKING_BACKLOG', 5000))
+BENCH_USERS = int(os.getenv('BENCH_USERS', 1000))
+
+PROJECT_ID = 'bench'
+
+_corpus = None
+_corpus_lock = threading.Lock()
+
+def corpus():
+    global _corpus
+    with _corpus_lock:
+        if _corpus is None:
+            _corpus = Corpus()
+        return _corpus
+
+
+class FakeBigQueryClient:
+    def __init__(self, *args, **kwargs):
+        """Answers the app's article queries from the synthetic corpus and completes load jobs
+        by counting the rows of the files in the fake object store
+        """
+        self.project = PROJECT_ID
+        self.corpus = corpus()
+        self.jobs = {}
+
+    def query(self, query, job_config=None):
+        time.sleep(BENCH_BIGQUERY_LATENCY)
+        parameters = {parameter.name: parameter for parameter in getattr(job_config, 'query_parameters', None) or []}
+        if 'article_ids' in parameters:
+            return self.corpus.lookup_rows(parameters['article_ids'].values)
+        if 'user_id' in parameters:
+            return self.corpus.personalized_rows(parameters['user_id'].value)
+        if 'QUALIFY' in query:
+            # snapshot export, every synthetic user's personalized articles
+            users = Users(self.corpus, BENCH_USERS)
+            return [dict(row, user_id=user_id) for user_id in users.user_ids for row in self.corpus.personalized_rows(user_id)]
+        return self.corpus.shared_rows()
+
+    def get_table(self, table):
+        time.sleep(BENCH_BIGQUERY_LATENCY)
+        return SimpleNamespace(
+            table_id=str(table).split('.')[-1],
+            num_rows=0,
+            modified=datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc)
+        )
+
+    def dataset(self, dataset_id):
+        return SimpleNamespace(table=lambda table_id: '{}.{}.{}'.format(PROJECT_ID, dataset_id, table_id))
+
+    def load_table_from_uri(self, source_uris, destination, job_id=None, job_config=None):
+        if isinstance(source_uris, str):
+            source_uris = [source_uris]
+        if job_id in self.jobs:
+            from google.api_core.exceptions import Conflict
+            raise Conflict('Already Exists: Job {}'.format(job_id))
+        load_job = FakeLoadJob(source_uris, job_id)
+        self.jobs[load_job.job_id] = load_job
+        return load_job
+
+    def get_job(self, job_id):
+        return self.jobs[job_id]
+
+
+class FakeLoadJob:
+    def __init__(self, source_uris, job_id=None):
+        self.job_id = job_id or str(uuid.uuid4())
+        self.source_uris = source_uris
+        self.output_rows = None
+        self.state = 'RUNNING'
+        self.error_result = None
+
+    def result(self, timeout=None):
+        if self.state != 'DONE':
+            time.sleep(BENCH_BIGQUERY_LATENCY)
+            self.output_rows = sum(count_rows(object_store.read(uri), uri) for uri in self.source_uris)
+            self.state = 'DONE'
+        return self
+
+
+class ObjectStore:
+    def __init__(self):
+        """In memory objects shared by the fake GCS client and the fake gcsfs filesystem
+        """
+        self._lock = threading.Lock()
+        self._objects = {}
+
+    @staticmethod
+    def key(path):
+        path = str(path)
+        for prefix in ('gs://', 'gcs://'):
+            if path.startswith(prefix):
+                path = path[len(prefix):]
+        return path.lstrip('/')
+
+    def read(self, path):
+        time.sleep(BENCH_GCS_LATENCY)
+        with self._lock:
+            try:
+                return self._objects[self.key(path)]
+            except KeyError:
+                raise FileNotFoundError(path)
+
+    def write(self, path, data):
+        time.sleep(BENCH_GCS_LATENCY)
+        with self._lock:
+            self._objects[self.key(path)] = data
+
+    def delete(self, path):
+        time.sleep(BENCH_GCS_LATENCY)
+        with self._lock:
+            self._objects.pop(self.key(path), None)
+
+    def list(self, bucket_name):
+        time.sleep(BENCH_GCS_LATENCY)
+        prefix = bucket_name + '/'
+        with self._lock:
+            return [(key[len(prefix):], len(data)) for key, data in self._objects.items() if key.startswith(prefix)]
+
+
+object_store = ObjectStore()
+
+
+class _ObjectWriter(io.BytesIO):
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+
+    def close(self):
+        if not self.closed:
+            object_store.write(self.path, self.getvalue())
+        super().close()
+
+
+class FakeFileSystem:
+    def __init__(self, *args, **kwargs):
+        """Stands in for gcsfs.GCSFileSystem with an fsspec style `open` over the object store
+        """
+
+    def open(self, path, mode='rb', **kwargs):
+        if 'w' in mode:
+            writer = _ObjectWriter(path)
+            return writer if 'b' in mode else io.TextIOWrapper(writer, encoding='utf-8')
+        data = io.BytesIO(object_store.read(path))
+        return data if 'b' in mode else io.TextIOWrapper(data, encoding='utf-8')
+
+
+class FakeBlob:
+    def __init__(self, bucket, name, size=None):
+        self.bucket = bucket
+        self.name = name
+        self.size = size
+
+    def delete(self):
+        object_store.delete('{}/{}'.format(self.bucket.name, self.name))
+
+    def download_as_string(self):
+        return object_store.read('{}/{}'.format(self.bucket.name, self.name))
+
+    download_as_bytes = download_as_string
+
+    def upload_from_string(self, data, content_type=None):
+        object_store.write('{}/{}'.format(self.bucket.name, self.name), data.encode('utf-8') if isinstance(data, str) else data)
+
+
+class FakeBucket:
+    def __init__(self, name):
+        self.name = name
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def get_blob(self, name):
+        return FakeBlob(self, name)
+
+    def list_blobs(self, prefix=None):
+        return [FakeBlob(self, name, size) for name, size in object_store.list(self.name) if name.startswith(prefix or '')]
+
+    def copy_blob(self, blob, destination_bucket, new_name=None):
+        data = object_store.read('{}/{}'.format(self.name, blob.name))
+        object_store.write('{}/{}'.format(destination_bucket.name, new_name or blob.name), data)
+        return FakeBlob(destination_bucket, new_name or blob.name, len(data))
+
+
+class FakeStorageClient:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def bucket(self, name):
+        return FakeBucket(name)
+
+    get_bucket = bucket
+
+    def list_blobs(self, bucket_name, prefix=None):
+        return FakeBucket(bucket_name).list_blobs(prefix)
+
+
+class FakePublisherClient:
+    def __init__(self, *args, **kwargs):
+        """Resolves published messages in batches, one simulated publish call every BENCH_PUBSUB_LATENCY seconds
+        """
+        self.published = 0
+        self._lock = threading.Lock()
+        self._pending = []
+        self._thread = threading.Thread(target=self._run, name='fake-publisher', daemon=True)
+        self._thread.start()
+
+    def topic_path(self, project, topic):
+        return 'projects/{}/topics/{}'.format(project, topic)
+
+    def publish(self, topic, data, **attributes):
+        future = Future()
+        with self._lock:
+            self._pending.append(future)
+        return future
+
+    def _run(self):
+        while True:
+            time.sleep(BENCH_PUBSUB_LATENCY)
+            with self._lock:
+                pending, self._pending = self._pending, []
+            for future in pending:
+                self.published += 1
+                future.set_result(str(self.published))
+
+
+class FakeSubscriberClient:
+    def __init__(self, *args, **kwargs):
+        """Serves a backlog of synthetic tracking messages from each subscription. Once a
+        subscription is drained it is refilled, so every run of the tracking route finds a full backlog
+        """
+        self._lock = threading.Lock()
+        self._backlogs = {}
+        self._messages = {}
+
+    def subscription_path(self, project, subscription):
+        return 'projects/{}/subscriptions/{}'.format(project, subscription)
+
+    def pull(self, request, timeout=None, **kwargs):
+        time.sleep(BENCH_PUBSUB_LATENCY)
+        subscription = request['subscription']
+        with self._lock:
+            if subscription not in self._messages:
+                kind = 'clicks' if subscription.endswith('clicks') else 'impressions'
+                self._messages[subscription] = tracking_messages(corpus(), Users(corpus(), BENCH_USERS), kind, BENCH_TRACKING_BACKLOG)
+            backlog = self._backlogs.get(subscription)
+            if backlog is None:
+                backlog = self._backlogs[subscription] = list(enumerate(self._messages[subscription]))
+            if not backlog:
+                # report the empty subscription once, the next pull starts a new backlog
+                self._backlogs[subscription] = None
+                return SimpleNamespace(received_messages=[])
+            batch = backlog[:request['max_messages']]
+            del backlog[:request['max_messages']]
+        return SimpleNamespace(received_messages=[
+            SimpleNamespace(
+                ack_id='{}-{}'.format(subscription, index),
+                message=SimpleNamespace(
+                    data=data, attributes=attributes, message_id=str(index),
+                    publish_time=datetime.datetime(2021, 1, 1)
+                )
+            )
+            for index, (data, attributes) in batch
+        ])
+
+    def modify_ack_deadline(self, request, **kwargs):
+        time.sleep(BENCH_PUBSUB_LATENCY)
+
+    def acknowledge(self, request, **kwargs):
+        time.sleep(BENCH_PUBSUB_LATENCY)
+
+
+def install():
+    """Replaces the GCP client classes and default credentials with the fakes. Must run before
+    the app or backend creates its clients, e.g. from the gunicorn config
+    """
+    import google.auth
+    from google.cloud import bigquery, storage, pubsub
+
+    google.auth.default = lambda *args, **kwargs: (None, PROJECT_ID)
+    bigquery.Client = FakeBigQueryClient
+    storage.Client = FakeStorageClient
+    pubsub.PublisherClient = FakePublisherClient
+    pubsub.SubscriberClient = FakeSubscriberClient
+    try:
+        import gcsfs
+        gcsfs.GCSFileSystem = FakeFileSystem
+    except ImportError:
+        pass
@@ -0,0 +1,20 @@
+# gunicorn config used by run.py. It installs the fake GCP services in the master process
+# before any worker is forked, then applies the target's own gunicorn.conf.py if it has one,
+# so hooks such as the app's post_fork warm up run against the fakes.
+# Settings passed on the command line, e.g. --workers and --threads, take precedence.
+import os
+import sys
+import runpy
+
+# the target directory is the working directory, its modules are imported by its config and app
+sys.path.insert(0, os.getcwd())
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fakes
+fakes.install()
+
+if os.path.exists('gunicorn.conf.py'):
+    globals().update({
+        name: value for name, value in runpy.run_path('gunicorn.conf.py').items()
+        if not name.startswith('__')
+    })
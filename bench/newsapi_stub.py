@@ -0,0 +1,72 @@
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+class NewsApiStub:
+    def __init__(self, corpus, latency=0.1, results_per_query=300, host='127.0.0.1', port=0, failing_domains=()):
+        """Serves /v2/everything like newsapi.org from the synthetic corpus, with a fixed delay per request
+        Args:
+            corpus: workload.Corpus the articles are taken from
+            latency: seconds each request waits before responding
+            results_per_query: totalResults reported for every query
+            host: interface to bind
+            port: port to bind, 0 picks a free port
+            failing_domains: queries for any of these domains get a 500 response, e.g. to test a failing shard
+        """
+        stub = self
+        self.corpus = corpus
+        self.latency = latency
+        self.results_per_query = results_per_query
+        self.failing_domains = set(failing_domains)
+        self.requests = 0
+        # (domains, page) of every query
+        self.queries = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.requests += 1
+                time.sleep(stub.latency)
+                url = urlsplit(self.path)
+                if url.path != '/v2/everything':
+                    self.send_error(404)
+                    return
+                params = {key: values[0] for key, values in parse_qs(url.query).items()}
+                domains = [domain.strip() for domain in params.get('domains', '').split(',')]
+                stub.queries.append((params.get('domains', ''), int(params.get('page', 1))))
+                if stub.failing_domains.intersection(domains):
+                    self.send_error(500)
+                    return
+                page_size = int(params.get('pageSize', 100))
+                page = int(params.get('page', 1))
+                start = (page - 1) * page_size
+                count = max(0, min(page_size, stub.results_per_query - start))
+                # each shard of domains gets its own slice of articles
+                offset = sum(ord(character) for character in params.get('domains', ''))
+                body = json.dumps({
+                    'status': 'ok',
+                    'totalResults': stub.results_per_query,
+                    'articles': stub.corpus.news_articles(offset + start, count)
+                }).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://{}:{}'.format(*self.server.server_address)
+        self._thread = threading.Thread(target=self.server.serve_forever, name='newsapi-stub', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,359 @@
+"""Offline benchmark of the app and backend routes against local stand-ins for BigQuery,
+Pub/Sub, GCS and newsapi.org. See bench/README.md
+
+Run from the target directory's environment, e.g.
+    cd app && pipenv run python ../bench/run.py --target app --workers 1,2 --threads 4,8
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import datetime
+import threading
+import subprocess
+import requests
+from workload import Corpus, Users
+from newsapi_stub import NewsApiStub
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+
+TARGET_ENV = {
+    'app': {
+        'FLASK_SESSION_SECRET': 'bench',
+        'ARTICLES_TABLE': 'bench.news.articles_view',
+        'PERSONALIZED_ARTICLES_TABLE': 'bench.topics.user_article_recommendations',
+    },
+    'backend': {
+        'ENV': 'bench',
+        'GCP_PROJECT_ID': 'bench',
+        'NEWS_API_KEY': 'bench',
+        'ARTICLES_BUCKET': 'articles',
+        'ARTICLES_PROCESSED_BUCKET': 'articles-processed',
+        'IMPRESSIONS_BUCKET': 'impressions',
+        'IMPRESSIONS_PROCESSED_BUCKET': 'impressions-processed',
+        'CLICKS_BUCKET': 'clicks',
+        'CLICKS_PROCESSED_BUCKET': 'clicks-processed',
+    },
+}
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def percentile(sorted_values, q):
+    """Returns the nearest rank percentile of a sorted list
+    """
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(q / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+def process_tree_rss(pid):
+    """Returns the resident memory in bytes of a process and its children, read from /proc
+    """
+    parents = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open('/proc/{}/stat'.format(entry)) as f:
+                    # the process name can contain spaces, the parent PID follows the closing parenthesis
+                    parents[int(entry)] = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                pass
+    tree, frontier = {pid}, [pid]
+    while frontier:
+        parent = frontier.pop()
+        children = [child for child, child_parent in parents.items() if child_parent == parent and child not in tree]
+        tree.update(children)
+        frontier.extend(children)
+
+    total = 0
+    for process in tree:
+        try:
+            with open('/proc/{}/status'.format(process)) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+
+class MemorySampler:
+    def __init__(self, pid, interval=0.5):
+        """Samples the resident memory of a process tree in a background thread and keeps the peak
+        """
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, process_tree_rss(self.pid))
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        if os.path.isdir('/proc'):
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+
+
+class Server:
+    def __init__(self, target, workers, threads, env):
+        """Runs the target's Flask app under gunicorn with the fake GCP services installed
+        Args:
+            target: 'app' or 'backend'
+            workers: gunicorn worker processes
+            threads: gunicorn threads per worker
+            env: environment variables added to the server's environment
+        """
+        self.port = free_port()
+        self.url = 'http://127.0.0.1:{}'.format(self.port)
+        self.process = subprocess.Popen(
+            [
+                sys.executable, '-m', 'gunicorn',
+                '--config', os.path.join(BENCH_DIR, 'gunicorn_bench.py'),
+                '--workers', str(workers), '--threads', str(threads),
+                '--bind', '127.0.0.1:{}'.format(self.port),
+                '--timeout', '600',
+                'main:app'
+            ],
+            cwd=os.path.join(ROOT_DIR, target),
+            env=dict(os.environ, **env)
+        )
+
+    def wait_ready(self, timeout=120):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError('server exited with code {}'.format(self.process.returncode))
+            try:
+                requests.get(self.url + '/', timeout=1)
+                return
+            except requests.RequestException:
+                time.sleep(0.2)
+        raise RuntimeError('server did not start within {} seconds'.format(timeout))
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+def app_load(url, users, concurrency, duration, warmup, seed):
+    """Runs a closed loop of synthetic visits and clicks from `concurrency` threads
+    Returns:
+        samples: list of (route, seconds, ok) recorded after the warm up
+    """
+    samples = []
+    lock = threading.Lock()
+    start_time = time.monotonic()
+    record_after = start_time + warmup
+    stop_at = record_after + duration
+
+    def request(session, route, path, **kwargs):
+        request_start = time.monotonic()
+        try:
+            response = session.get(url + path, timeout=60, **kwargs)
+            ok = response.status_code < 400
+        except requests.RequestException:
+            ok = False
+        if request_start >= record_after:
+            with lock:
+                samples.append((route, time.monotonic() - request_start, ok))
+
+    def visitor(index):
+        rng = random.Random('{}-{}'.format(seed, index))
+        session = requests.Session()
+        while time.monotonic() < stop_at:
+            user_id, article_id = users.visit(rng)
+            session.cookies.set('user_id', user_id)
+            request(session, '/home', '/home')
+            if article_id:
+                request(session, '/static/tracking/<article_id>', '/static/tracking/' + article_id, allow_redirects=False)
+
+    threads = [threading.Thread(target=visitor, args=(index,)) for index in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples
+
+def backend_load(url, iterations):
+    """Calls each batch route of the backend `iterations` times in turn
+    Returns:
+        samples: list of (route, seconds, ok)
+    """
+    samples = []
+    for _ in range(iterations):
+        for route in ('/get_and_load_tracking', '/get_and_load_news'):
+            request_start = time.monotonic()
+            try:
+                ok = requests.post(url + route, timeout=900).status_code < 400
+            except requests.RequestException:
+                ok = False
+            samples.append((route, time.monotonic() - request_start, ok))
+    return samples
+
+def summarize(samples, elapsed):
+    """Returns the count, errors, throughput and latency percentiles in milliseconds of each route
+    """
+    routes = {}
+    for route in sorted(set(sample[0] for sample in samples)):
+        latencies = sorted(seconds * 1000 for name, seconds, ok in samples if name == route)
+        routes[route] = {
+            'count': len(latencies),
+            'errors': sum(1 for name, seconds, ok in samples if name == route and not ok),
+            'throughput': round(len(latencies) / elapsed, 2) if elapsed else None,
+            'mean': round(sum(latencies) / len(latencies), 2),
+            'p50': round(percentile(latencies, 50), 2),
+            'p95': round(percentile(latencies, 95), 2),
+            'p99': round(percentile(latencies, 99), 2),
+        }
+    return routes
+
+def compare(report, baseline, tolerance):
+    """Returns a description of every route whose p95 latency or throughput regressed by more
+    than `tolerance` against the baseline run with the same workers and threads
+    """
+    baseline_runs = {(run['workers'], run['threads']): run for run in baseline['runs']}
+    regressions = []
+    for run in report['runs']:
+        baseline_run = baseline_runs.get((run['workers'], run['threads']))
+        if baseline_run is None:
+            continue
+        for route, stats in run['routes'].items():
+            before = baseline_run['routes'].get(route)
+            if before is None:
+                continue
+            label = '{} workers={} threads={}'.format(route, run['workers'], run['threads'])
+            if stats['p95'] > before['p95'] * (1 + tolerance):
+                regressions.append('{}: p95 {} ms, baseline {} ms'.format(label, stats['p95'], before['p95']))
+            if before['throughput'] and stats['throughput'] < before['throughput'] * (1 - tolerance):
+                regressions.append('{}: throughput {}/s, baseline {}/s'.format(label, stats['throughput'], before['throughput']))
+            if stats['errors'] > before['errors']:
+                regressions.append('{}: {} errors, baseline {}'.format(label, stats['errors'], before['errors']))
+    return regressions
+
+def print_report(report):
+    print('{:<34} {:>7} {:>7} {:>6} {:>9} {:>9} {:>9} {:>9} {:>8}'.format(
+        'route', 'workers', 'threads', 'count', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'rss MB'))
+    for run in report['runs']:
+        for route, stats in run['routes'].items():
+            print('{:<34} {:>7} {:>7} {:>6} {:>9} {:>9} {:>9} {:>9} {:>8}'.format(
+                route, run['workers'], run['threads'], stats['count'], stats['throughput'],
+                stats['p50'], stats['p95'], stats['p99'], run['peak_rss_mb']))
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target', choices=['app', 'backend'], default='app')
+    parser.add_argument('--workers', default='1', help='comma separated gunicorn worker counts')
+    parser.add_argument('--threads', default='8', help='comma separated gunicorn thread counts')
+    parser.add_argument('--concurrency', type=int, default=16, help='concurrent synthetic visitors (app)')
+    parser.add_argument('--duration', type=float, default=20, help='seconds of measured load per setting (app)')
+    parser.add_argument('--warmup', type=float, default=3, help='seconds of unmeasured load before each run (app)')
+    parser.add_argument('--iterations', type=int, default=3, help='calls of each batch route per setting (backend)')
+    parser.add_argument('--users', type=int, default=1000, help='distinct synthetic users')
+    parser.add_argument('--click-rate', type=float, default=0.2, help='probability that a visit clicks an article')
+    parser.add_argument('--articles', type=int, default=2000, help='articles in the synthetic corpus')
+    parser.add_argument('--backlog', type=int, default=5000, help='messages in each tracking subscription (backend)')
+    parser.add_argument('--news-results', type=int, default=300, help='results of each stub newsapi query (backend)')
+    parser.add_argument('--bigquery-latency', type=float, default=0.05)
+    parser.add_argument('--pubsub-latency', type=float, default=0.01)
+    parser.add_argument('--gcs-latency', type=float, default=0.01)
+    parser.add_argument('--newsapi-latency', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help='extra environment variable for the server, e.g. a feature flag')
+    parser.add_argument('--log-level', default='WARNING', help='LOG_LEVEL of the server')
+    parser.add_argument('--output', help='write the report to this JSON file')
+    parser.add_argument('--save-baseline', metavar='PATH', help='write the report as a baseline')
+    parser.add_argument('--baseline', metavar='PATH', help='compare against a baseline and exit 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative regression (default 0.2)')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    settings = {key: value for key, value in vars(args).items() if key not in ('output', 'save_baseline', 'baseline')}
+
+    # the fakes read their settings from the environment so the server processes see the same values
+    env = dict(TARGET_ENV[args.target], **{
+        'BENCH_SEED': str(args.seed),
+        'BENCH_ARTICLES': str(args.articles),
+        'BENCH_USERS': str(args.users),
+        'BENCH_TRACKING_BACKLOG': str(args.backlog),
+        'BENCH_BIGQUERY_LATENCY': str(args.bigquery_latency),
+        'BENCH_PUBSUB_LATENCY': str(args.pubsub_latency),
+        'BENCH_GCS_LATENCY': str(args.gcs_latency),
+        'LOG_LEVEL': args.log_level,
+    })
+    os.environ.update({key: value for key, value in env.items() if key.startswith('BENCH_')})
+    corpus = Corpus(args.articles, args.seed)
+    users = Users(corpus, args.users, click_rate=args.click_rate, seed=args.seed)
+
+    news_stub = None
+    if args.target == 'backend':
+        news_stub = NewsApiStub(corpus, args.newsapi_latency, args.news_results).start()
+        env['NEWS_API_URL'] = news_stub.url
+    for pair in args.env:
+        name, value = pair.split('=', 1)
+        env[name] = value
+
+    report = {'target': args.target, 'created': datetime.datetime.now().isoformat(timespec='seconds'), 'settings': settings, 'runs': []}
+    try:
+        for workers in [int(value) for value in args.workers.split(',')]:
+            for threads in [int(value) for value in args.threads.split(',')]:
+                server = Server(args.target, workers, threads, env)
+                try:
+                    server.wait_ready()
+                    with MemorySampler(server.process.pid) as memory:
+                        start_time = time.monotonic()
+                        if args.target == 'app':
+                            samples = app_load(server.url, users, args.concurrency, args.duration, args.warmup, args.seed)
+                            elapsed = args.duration
+                        else:
+                            samples = backend_load(server.url, args.iterations)
+                            elapsed = time.monotonic() - start_time
+                finally:
+                    server.stop()
+                report['runs'].append({
+                    'workers': workers,
+                    'threads': threads,
+                    'peak_rss_mb': round(memory.peak / 1024 / 1024, 1),
+                    'routes': summarize(samples, elapsed),
+                })
+    finally:
+        if news_stub is not None:
+            news_stub.stop()
+
+    print_report(report)
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION {}'.format(regression))
+        if regressions:
+            return 1
+        print('no regressions against {}'.format(args.baseline))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,181 @@
+import os
+import gzip
+import uuid
+import random
+import bisect
+import datetime
+import importlib.util
+
+# every process seeds its generator the same way so the app workers, the fake
+# services and the load generator all agree on the same articles
+BENCH_SEED = int(os.getenv('BENCH_SEED', 42))
+BENCH_ARTICLES = int(os.getenv('BENCH_ARTICLES', 2000))
+
+ARTICLE_NAMESPACE = uuid.UUID('6f1b0d4e-3c1a-4c59-9d9a-2b7d1c0e8f10')
+HOSTS = ['apnews.com', 'bbc.co.uk', 'reuters.com', 'theverge.com', 'wired.com', 'techcrunch.com', 'axios.com']
+WORDS = (
+    'market election climate league vaccine court startup rocket storm budget '
+    'senate player festival chip merger outbreak summit tariff trial launch'
+).split()
+
+def sentence(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize()
+
+
+class Corpus:
+    def __init__(self, size=BENCH_ARTICLES, seed=BENCH_SEED, feed_size=10, personalized_size=10):
+        """Generates a deterministic set of articles, the shared latest, popular and random feeds,
+        and the personalized articles of any user
+        Args:
+            size: number of articles
+            seed: random seed shared by every process
+            feed_size: articles in each shared feed
+            personalized_size: personalized articles per user
+        """
+        rng = random.Random(seed)
+        self.seed = seed
+        self.personalized_size = personalized_size
+        now = datetime.datetime(2021, 1, 1)
+        self.articles = []
+        for index in range(size):
+            host = rng.choice(HOSTS)
+            self.articles.append({
+                'article_id': str(uuid.uuid5(ARTICLE_NAMESPACE, '{}-{}'.format(seed, index))),
+                'title': sentence(rng, 8),
+                'author': sentence(rng, 2),
+                'description': sentence(rng, 30),
+                'content': sentence(rng, 60),
+                'url': 'https://{}/story/{}'.format(host, index),
+                'urlToImage': 'https://{}/image/{}.jpg'.format(host, index),
+                'url_host': host,
+                'publishedAt': now - datetime.timedelta(minutes=7 * index),
+            })
+        self.by_id = {article['article_id']: article for article in self.articles}
+
+        self.feeds = {
+            'latest': self.articles[:feed_size],
+            'popular': rng.sample(self.articles[:size // 4 or 1], min(feed_size, size // 4 or 1)),
+            'random': rng.sample(self.articles, min(feed_size, size)),
+        }
+
+    def shared_rows(self):
+        """Returns the rows of the shared feeds as the articles table would
+        """
+        return [dict(article, sort=sort) for sort, articles in self.feeds.items() for article in articles]
+
+    def personalized_rows(self, user_id):
+        """Returns the personalized rows of a user, the same user always gets the same articles
+        """
+        rng = random.Random('{}-{}'.format(self.seed, user_id))
+        return [dict(article, sort='personalized') for article in rng.sample(self.articles, self.personalized_size)]
+
+    def lookup_rows(self, article_ids):
+        return [dict(self.by_id[article_id], sort='latest') for article_id in article_ids if article_id in self.by_id]
+
+    def news_articles(self, start, count):
+        """Returns newsapi.org style articles, a page of the stub news API
+        """
+        articles = []
+        for index in range(start, start + count):
+            article = self.articles[index % len(self.articles)]
+            articles.append({
+                'source': {'id': None, 'name': article['url_host']},
+                'author': article['author'],
+                'title': article['title'],
+                'description': article['description'],
+                'url': '{}?page={}'.format(article['url'], index // len(self.articles)),
+                'urlToImage': article['urlToImage'],
+                'publishedAt': article['publishedAt'].strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'content': article['content'],
+            })
+        return articles
+
+
+class Users:
+    def __init__(self, corpus, count=1000, zipf=1.1, click_rate=0.2, seed=BENCH_SEED):
+        """Generates synthetic visits. A few users visit often and most rarely, following a Zipf
+        distribution, and each visit clicks one of the articles shown with `click_rate` probability
+        Args:
+            corpus: Corpus of articles
+            count: number of distinct users
+            zipf: Zipf exponent of user activity
+            click_rate: probability that a visit is followed by a click
+            seed: random seed
+        """
+        self.corpus = corpus
+        self.click_rate = click_rate
+        self.user_ids = [str(uuid.uuid5(ARTICLE_NAMESPACE, 'user-{}-{}'.format(seed, index))) for index in range(count)]
+        weights = [1 / (rank + 1) ** zipf for rank in range(count)]
+        total = sum(weights)
+        self.cumulative = []
+        running = 0
+        for weight in weights:
+            running += weight / total
+            self.cumulative.append(running)
+        self.shared_ids = [article['article_id'] for articles in corpus.feeds.values() for article in articles]
+
+    def visit(self, rng):
+        """Returns the user ID of a visit and the clicked article ID, or None without a click
+        """
+        user_id = self.user_ids[min(bisect.bisect_left(self.cumulative, rng.random()), len(self.user_ids) - 1)]
+        if rng.random() >= self.click_rate:
+            return user_id, None
+        shown = self.shared_ids + [row['article_id'] for row in self.corpus.personalized_rows(user_id)]
+        return user_id, rng.choice(shown)
+
+
+def load_app_events():
+    """Imports the app's event encoder under another name, the backend has its own events module
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app', 'events.py')
+    spec = importlib.util.spec_from_file_location('app_events', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def tracking_messages(corpus, users, kind, count, seed=BENCH_SEED):
+    """Encodes synthetic impression or click events the way the app publishes them
+    Args:
+        corpus: Corpus of articles
+        users: Users generating the events
+        kind: 'impressions' or 'clicks'
+        count: number of messages
+    Returns:
+        list of (data, attributes)
+    """
+    events = load_app_events()
+    rng = random.Random('{}-{}'.format(seed, kind))
+    timestamp = datetime.datetime(2021, 1, 1).strftime('%Y-%m-%d %H:%M:%S')
+    shared_rows = corpus.shared_rows()
+    messages = []
+    for _ in range(count):
+        user_id, _ = users.visit(rng)
+        if kind == 'clicks':
+            article = dict(rng.choice(shared_rows))
+            article['publishedAt'] = article['publishedAt'].strftime('%Y-%m-%d %H:%M:%S')
+            messages.append(events.encode_click({
+                'user_id': user_id, 'click_timestamp': timestamp,
+                'article_clicked': {field: article[field] for field in ['article_id', 'title', 'publishedAt', 'sort']}
+            }))
+        else:
+            rows = shared_rows + corpus.personalized_rows(user_id)
+            messages.append(events.encode_impression({
+                'user_id': user_id, 'impression_timestamp': timestamp,
+                'articles': [
+                    {'article_id': row['article_id'], 'title': row['title'], 'sort': row['sort'],
+                     'publishedAt': row['publishedAt'].strftime('%Y-%m-%d %H:%M:%S')}
+                    for row in rows
+                ]
+            }))
+    return messages
+
+def count_rows(data, name):
+    """Counts the rows of an NDJSON, gzipped NDJSON or Parquet file
+    """
+    if name.endswith('.parquet'):
+        import io
+        import pyarrow.parquet
+        return pyarrow.parquet.ParquetFile(io.BytesIO(data)).metadata.num_rows
+    if name.endswith('.gz'):
+        data = gzip.decompress(data)
+    return data.count(b'\n')